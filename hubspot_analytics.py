@@ -0,0 +1,215 @@
+import csv
+import os
+from dotenv import load_dotenv
+from termcolor import colored
+from hubspot_extract import (
+    CACHED_PROPERTIES,
+    get_history_cache,
+    get_store_path,
+    load_pipeline_index,
+)
+from hubspot_store import HistoryStore, write_history_store, read_store_meta
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+print(r"""
+  _    _       _                     _     ______      _                  _
+ | |  | |     | |                   | |   |  ____|    | |                | |
+ | |__| |_   _| |__  ___ _ __   ___ | |_  | |__  __  _| |_ _ __ __ _  ___| |_
+ |  __  | | | | '_ \/ __| '_ \ / _ \| __| |  __| \ \/ / __| '__/ _` |/ __| __|
+ | |  | | |_| | |_) \__ \ |_) | (_) | |_  | |____ >  <| |_| | | (_| | (__| |_
+ |_|  |_|\__,_|_.__/|___/ .__/ \___/ \__| |______/_/\_\\__|_|  \__,_|\___|\__|
+                        | |
+                        |_|
+    """)
+
+print(colored("HubSpot Deal Stage Analytics", "green"))
+print(colored("Par Jean-Baptiste Ronssin - @jbronssin", "blue"))
+print(colored("https://github.com/jbronssin/Hubspot_Extract_Deal_History", "blue"))
+print("###############################################")
+print(colored("This script reads the deal histories already downloaded by the other scripts (history store)", "yellow"))
+print("###############################################")
+
+DAY_MS = 24 * 3600 * 1000
+PERCENTILES = [25, 50, 75, 90]
+PERCENTILE_HEADER = [f"P{percentile} (days)" for percentile in PERCENTILES]
+
+
+# The dealstage versions of every deal in the history store as three aligned arrays, sorted by deal then by date.
+# The arrays are read from the memory-mapped columns without a copy, the stages are the interned codes of the store.
+def load_stage_versions(store):
+    deal_ids = np.frombuffer(store.deal_id, dtype=np.int64)
+    properties = np.frombuffer(store.property, dtype=np.int8)
+    stages = np.frombuffer(store.value, dtype=np.int32)
+    timestamps = np.frombuffer(store.timestamp, dtype=np.int64)
+    is_stage = properties == store.properties.index("dealstage")
+    deal_ids, stages, timestamps = deal_ids[is_stage], stages[is_stage], timestamps[is_stage]
+
+    # A deal set again to the stage it is already in did not move
+    repeated = np.zeros(len(deal_ids), dtype=bool)
+    repeated[1:] = (deal_ids[1:] == deal_ids[:-1]) & (stages[1:] == stages[:-1])
+    return deal_ids[~repeated], stages[~repeated], timestamps[~repeated]
+
+
+# Count, mean and percentiles of values for every group code at once: the values are sorted by group,
+# so each group is a slice and its percentiles are read at the same relative positions in every slice
+def group_stats(groups, values, group_count):
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+
+    means = np.full(group_count, np.nan)
+    means[present] = np.bincount(groups, weights=values, minlength=group_count)[present] / counts[present]
+
+    percentiles = np.full((group_count, len(PERCENTILES)), np.nan)
+    for column, percentile in enumerate(PERCENTILES):
+        position = starts[present] + (counts[present] - 1) * percentile / 100
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        percentiles[present, column] = values[low] + (values[high] - values[low]) * (position - low)
+    return counts, means, percentiles
+
+
+def round_days(values):
+    return ["" if np.isnan(value) else round(float(value), 2) for value in values]
+
+
+def write_csv(file_name, header, rows):
+    with open(file_name, mode="w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+    print(f"File saved : {file_name}")
+
+
+def main():
+
+    # Folder creation if not exist
+    if not os.path.exists("extract"):
+        os.makedirs("extract")
+
+    load_dotenv()
+
+    if np is None:
+        print(colored("The analytics need NumPy, install it with: pip install numpy", "red"))
+        sys.exit(0)
+
+    # The analytics only read the extract folder, they need neither the token nor the network. The stages are named
+    # with the pipelines saved by the last extraction, and the histories are those of its portal.
+    pipeline_index = load_pipeline_index()
+    account = pipeline_index["account"] if pipeline_index else None
+    cache = get_history_cache(account) if account else None
+    store_path = get_store_path()
+    meta = read_store_meta(store_path)
+    if store_path.lower() == "off" or (meta is None and not cache):
+        print(colored("There is nothing to analyze: run one of the extraction scripts first, with the history cache and the history store on (HUBSPOT_CACHE and HUBSPOT_STORE).", "red"))
+        sys.exit(0)
+
+    # The store is built from the cache the first time, then again only once the extractions downloaded new histories
+    # or extracted another portal (or with python3 hubspot_analytics.py --rebuild-store, to drop the deals evicted
+    # from the cache since)
+    if cache and (meta is None or "--rebuild-store" in sys.argv or meta.get("account") != account or cache.get_last_fetched() > meta["built_at"]):
+        print("Building the history store from the history cache...")
+        rows = write_history_store(store_path, cache.iter_all(), CACHED_PROPERTIES, account)
+        print(f"History store: {rows} versions in {store_path}")
+    if cache:
+        cache.close()
+    store = HistoryStore(store_path)
+
+    # Pipeline and display order of each stage, the stages deleted since then go in an "Unknown pipeline"
+    if pipeline_index is None:
+        print(colored("No pipelines saved by an extraction (extract/pipelines.json), the stages are shown by their id.", "yellow"))
+        pipeline_index = {"pipelines": [], "stages": {}}
+    pipelines = pipeline_index["pipelines"] + [{"id": None, "label": "Unknown pipeline"}]
+    pipeline_codes = {pipeline["id"]: code for code, pipeline in enumerate(pipelines)}
+
+    deal_ids, stages, timestamps = load_stage_versions(store)
+    if not len(deal_ids):
+        print(colored("The history store is empty, run one of the extraction scripts first.", "red"))
+        sys.exit(0)
+
+    stage_ids = store.values
+    stage_info = [pipeline_index["stages"].get(stage_id, (None, stage_id, None)) for stage_id in stage_ids]
+    stage_pipelines = np.array([pipeline_codes.get(info[0], len(pipelines) - 1) for info in stage_info], dtype=np.int32)
+    stage_count = len(stage_ids)
+    pipeline_count = len(pipelines)
+
+    # Stages in the order of the pipelines, then of their display order
+    stage_order = sorted(range(stage_count), key=lambda code: (stage_pipelines[code], stage_info[code][2] is None, stage_info[code][2] or 0))
+
+    def stage_columns(code):
+        pipeline_id, label, display_order = stage_info[code]
+        return [pipelines[stage_pipelines[code]]["label"], label, "" if display_order is None else display_order]
+
+    # Row i and row i + 1 are the same deal: the deal left stages[i] for stages[i + 1]
+    moved = deal_ids[1:] == deal_ids[:-1]
+    from_stages = stages[:-1][moved]
+    to_stages = stages[1:][moved]
+    days_in_stage = (timestamps[1:] - timestamps[:-1])[moved] / DAY_MS
+
+    # Time spent in each stage, for the stays that are over
+    stays, means, percentiles = group_stats(from_stages, days_in_stage, stage_count)
+    write_csv(
+        "extract/analytics_time_in_stage.csv",
+        ["Pipeline", "Deal Stage", "Display Order", "Stays", "Mean (days)"] + PERCENTILE_HEADER,
+        [stage_columns(code) + [int(stays[code])] + round_days([means[code]]) + round_days(percentiles[code]) for code in stage_order if stays[code]],
+    )
+
+    # Transition matrix: transitions[a, b] is the number of times a deal went from stage a to stage b
+    transitions = np.bincount(from_stages.astype(np.int64) * stage_count + to_stages, minlength=stage_count * stage_count).reshape(stage_count, stage_count)
+    exits = transitions.sum(axis=1)
+    write_csv(
+        "extract/analytics_transitions.csv",
+        ["From Pipeline", "From Deal Stage", "To Pipeline", "To Deal Stage", "Transitions", "Share of Exits"],
+        [
+            stage_columns(a)[:2] + stage_columns(b)[:2] + [int(transitions[a, b]), round(float(transitions[a, b] / exits[a]), 4)]
+            for a in stage_order for b in stage_order if transitions[a, b]
+        ],
+    )
+
+    # Conversion: share of the deals that went through a pipeline that reached each of its stages
+    deal_codes = np.concatenate(([0], np.cumsum(deal_ids[1:] != deal_ids[:-1])))
+    reached = np.bincount(np.unique(deal_codes * stage_count + stages) % stage_count, minlength=stage_count)
+    in_pipeline = np.bincount(np.unique(deal_codes * pipeline_count + stage_pipelines[stages]) % pipeline_count, minlength=pipeline_count)
+    write_csv(
+        "extract/analytics_conversion.csv",
+        ["Pipeline", "Deal Stage", "Display Order", "Deals in Pipeline", "Deals Reaching Stage", "Conversion Rate"],
+        [
+            stage_columns(code) + [int(in_pipeline[stage_pipelines[code]]), int(reached[code]), round(float(reached[code] / in_pipeline[stage_pipelines[code]]), 4)]
+            for code in stage_order if reached[code]
+        ],
+    )
+
+    # Velocity: days between the first and the last stage of each deal, by pipeline of its current stage
+    first = np.flatnonzero(np.concatenate(([True], deal_ids[1:] != deal_ids[:-1])))
+    last = np.concatenate((first[1:] - 1, [len(deal_ids) - 1]))
+    deal_pipelines = stage_pipelines[stages[last]]
+    deals = np.bincount(deal_pipelines, minlength=pipeline_count)
+    changed = last > first
+    moving_deals, _, percentiles = group_stats(deal_pipelines[changed], (timestamps[last] - timestamps[first])[changed] / DAY_MS, pipeline_count)
+    write_csv(
+        "extract/analytics_velocity.csv",
+        ["Pipeline", "Deals", "Deals with Stage Changes"] + PERCENTILE_HEADER,
+        [[pipelines[code]["label"], int(deals[code]), int(moving_deals[code])] + round_days(percentiles[code]) for code in range(pipeline_count) if deals[code]],
+    )
+
+    print(f"{len(first)} deals and {int(moved.sum())} stage changes analyzed")
+    store.close()
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
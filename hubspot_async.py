@@ -0,0 +1,91 @@
+import json
+import time
+import atexit
+import asyncio
+import threading
+import requests
+from datetime import timedelta
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Asyncio engine of the hubspot_history_*.py scripts (HUBSPOT_ASYNC=on in the .env file).
+# Every HubSpot call runs as a coroutine on one event loop thread, so hundreds of requests
+# can be in flight at the same time without a thread for each one. Needs aiohttp (pip install aiohttp).
+
+
+class AsyncResponse:
+    # The parts of requests.Response used by the scripts, the rate limiter and the metrics,
+    # plus waited: seconds spent waiting for a free slot and for the rate limiter before it was sent
+
+    def __init__(self, url, status_code, headers, content, elapsed, waited):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.elapsed = elapsed
+        self.waited = waited
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class AsyncClient:
+
+    def __init__(self, headers, concurrency, timeout):
+        if aiohttp is None:
+            raise ImportError("HUBSPOT_ASYNC=on needs aiohttp, install it with: pip install aiohttp")
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.run(self.open(headers, concurrency, timeout))
+        # Also close the connections when the script stops on an error or a Ctrl+C
+        atexit.register(self.close)
+
+    # The session, the semaphore and the lock belong to the event loop, they are created on its thread
+    async def open(self, headers, concurrency, timeout):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pacing = asyncio.Lock()
+        # Like the timeout of requests: to connect, then between two reads of the answer
+        self.session = aiohttp.ClientSession(
+            headers=headers,
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout),
+        )
+
+    # Run a coroutine on the event loop and wait for its result, from any other thread
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    # One request, once the shared rate limiter lets it go and while fewer than concurrency requests are in flight.
+    # The network errors are raised as the errors of requests, so api_request_async() handles them like api_request().
+    async def request(self, rate_limiter, method, url, params=None, json=None):
+        started = time.perf_counter()
+        async with self.semaphore:
+            # The requests wait for the rate limiter one after the other, so they go out in the order they were made
+            async with self.pacing:
+                delay = rate_limiter.reserve()
+                while delay > 0:
+                    await asyncio.sleep(delay)
+                    delay = rate_limiter.reserve()
+            sent = time.perf_counter()
+            try:
+                async with self.session.request(method, url, params=params, json=json) as response:
+                    # Like requests, elapsed stops when the headers come in
+                    elapsed = timedelta(seconds=time.perf_counter() - sent)
+                    return AsyncResponse(url, response.status, response.headers, await response.read(), elapsed, sent - started)
+            except asyncio.TimeoutError as error:
+                raise requests.Timeout(f"Timeout on {url}") from error
+            except aiohttp.ClientError as error:
+                raise requests.ConnectionError(f"{type(error).__name__} on {url}: {error}") from error
+
+    def close(self):
+        if self.session.closed:
+            return
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
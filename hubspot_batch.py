@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import requests
+from dotenv import load_dotenv
+from termcolor import colored
+
+
+print(r"""
+  _    _       _                     _     ______      _                  _
+ | |  | |     | |                   | |   |  ____|    | |                | |
+ | |__| |_   _| |__  ___ _ __   ___ | |_  | |__  __  _| |_ _ __ __ _  ___| |_
+ |  __  | | | | '_ \/ __| '_ \ / _ \| __| |  __| \ \/ / __| '__/ _` |/ __| __|
+ | |  | | |_| | |_) \__ \ |_) | (_) | |_  | |____ >  <| |_| | | (_| | (__| |_
+ |_|  |_|\__,_|_.__/|___/ .__/ \___/ \__| |______/_/\_\\__|_|  \__,_|\___|\__|
+                        | |
+                        |_|
+    """)
+
+print(colored("HubSpot Deal History Extractor - batch extraction of several portals", "green"))
+print(colored("Par Jean-Baptiste Ronssin - @jbronssin", "blue"))
+print(colored("https://github.com/jbronssin/Hubspot_Extract_Deal_History", "blue"))
+print("###############################################")
+print(colored("You can interupt the script when you want by pressing Ctrl+C", "red"))
+print("###############################################")
+
+# Extracts the portals of a manifest (portals.json) at the same time, without any question:
+# {
+#   "max_connections": 64,
+#   "portals": [
+#     {"name": "acme", "token_env": "HUBSPOT_TOKEN_ACME", "pipeline": "all" or a pipeline id, "dates": "all" or "first",
+#      "reports": ["deal_stage_history", "deal_pipeline_history"], "output": "portals/acme", "env": {"HUBSPOT_ENGINE": "v3"}}
+#   ]
+# }
+# Each portal runs the script of its reports in its own process, in its output folder (output/extract/...), with
+# its own token and rate limits. The connections are shared between the portals in proportion to their deals, so
+# the small portals do not finish early while the big ones are short of connections.
+
+REPORT_SCRIPTS = {
+    "deal_stage_history": "hubspot_history.py",
+    "deal_stage_changes": "hubspot_history_all_pipes.py",
+    "deal_pipeline_history": "hubspot_history_date_pipeline.py",
+}
+
+# Several reports are written in one pass, each deal is fetched once
+COMBINED_SCRIPT = "hubspot_history_combined.py"
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Extracts the deal histories of several HubSpot portals")
+    parser.add_argument("manifest", nargs="?", default="portals.json", help="JSON file listing the portals")
+    parser.add_argument("--max-connections", type=int, help="connections shared by all the portals (default: max_connections of the manifest, or 64)")
+    parser.add_argument("--only", action="append", help="only extract this portal, can be repeated")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--incremental", action="store_true", help="only extract the deals modified since the previous extraction of each portal")
+    mode.add_argument("--resume", action="store_true", help="continue the interrupted extractions")
+    return parser.parse_args()
+
+
+# Reads the manifest and fills the defaults of each portal, returns None with the errors printed if it is not valid
+def load_portals(manifest, only):
+    portals = []
+    errors = []
+    for index, portal in enumerate(manifest.get("portals", [])):
+        name = portal.get("name") or f"portal_{index + 1}"
+        if only and name not in only:
+            continue
+        token_env = portal.get("token_env", "HUBSPOT_TOKEN")
+        reports = portal.get("reports", list(REPORT_SCRIPTS))
+        unknown_reports = [report for report in reports if report not in REPORT_SCRIPTS]
+        pipeline = portal.get("pipeline", "all")
+        dates = portal.get("dates", "first")
+        concurrency = portal.get("concurrency")
+        if not os.environ.get(token_env):
+            errors.append(f"{name}: {token_env} is not set in the environment or the .env file")
+        if not reports or unknown_reports:
+            errors.append(f"{name}: reports must be taken from {', '.join(REPORT_SCRIPTS)}")
+        # The scripts take "all", a pipeline id or the number of the pipeline in their list
+        if isinstance(pipeline, bool) or not isinstance(pipeline, (str, int)) or not str(pipeline).strip():
+            errors.append(f"{name}: pipeline must be \"all\", a pipeline id or the number of the pipeline, not {json.dumps(pipeline)}")
+        if dates not in ("all", "first"):
+            errors.append(f"{name}: dates must be \"all\" or \"first\", not {json.dumps(dates)}")
+        if concurrency is not None and not str(concurrency).isdigit():
+            errors.append(f"{name}: concurrency must be a number of connections, not {json.dumps(concurrency)}")
+        if name in [other["name"] for other in portals]:
+            errors.append(f"{name}: two portals have this name")
+        portals.append({
+            "name": name,
+            "token": os.environ.get(token_env),
+            "pipeline": str(pipeline).strip(),
+            "dates": dates,
+            "script": REPORT_SCRIPTS[reports[0]] if len(reports) == 1 and not unknown_reports else COMBINED_SCRIPT,
+            "output": portal.get("output", os.path.join("portals", name)),
+            "concurrency": concurrency,
+            "env": {key: str(value) for key, value in portal.get("env", {}).items()},
+        })
+
+    if not portals:
+        errors.append("the manifest lists no portal to extract")
+    for error in errors:
+        print(colored(error, "red"))
+    return None if errors else portals
+
+
+def get_api_url(portal):
+    return portal["env"].get("HUBSPOT_API_URL", os.environ.get("HUBSPOT_API_URL", "https://api.hubapi.com"))
+
+
+# The pipeline of a portal must be one of its pipelines (one request), the script would pick another one.
+# Returns the error, None if the pipeline is valid or the pipelines could not be read.
+def check_pipeline(portal):
+    if portal["pipeline"].lower() == "all":
+        return None
+    try:
+        response = requests.get(f"{get_api_url(portal)}/crm/v3/pipelines/deals", headers={"Authorization": f"Bearer {portal['token']}"}, timeout=60)
+        response.raise_for_status()
+        pipeline_ids = [pipeline["id"] for pipeline in response.json()["results"]]
+    except requests.RequestException:
+        # The extraction of the portal will show the error
+        return None
+    if portal["pipeline"] in pipeline_ids or (portal["pipeline"].isdigit() and 1 <= int(portal["pipeline"]) <= len(pipeline_ids)):
+        return None
+    return f"{portal['name']}: the pipeline {portal['pipeline']} is not one of its pipelines ({', '.join(pipeline_ids)}) nor their number (1 to {len(pipeline_ids)})"
+
+
+# Number of deals of a portal (one search request), the share of the connections it gets
+def count_deals(portal):
+    url = get_api_url(portal)
+    filters = [] if portal["pipeline"].lower() == "all" else [{"propertyName": "pipeline", "operator": "EQ", "value": portal["pipeline"]}]
+    try:
+        response = requests.post(
+            f"{url}/crm/v3/objects/deals/search",
+            headers={"Authorization": f"Bearer {portal['token']}"},
+            json={"filterGroups": [{"filters": filters}] if filters else [], "limit": 1},
+            timeout=60,
+        )
+        response.raise_for_status()
+        return response.json()["total"]
+    except requests.RequestException as error:
+        # The extraction of the portal will show the error
+        print(colored(f"{portal['name']}: the deals could not be counted ({error}).", "yellow"))
+        return 0
+
+
+# Connections a portal opens for its searches next to its HUBSPOT_CONCURRENCY ones, at most one less than the cap.
+# The asyncio engine runs the searches on the same connections.
+def get_search_connections(portal, max_connections):
+    environment = dict(os.environ, **portal["env"])
+    if environment.get("HUBSPOT_ASYNC", "off").lower() == "on":
+        return 0
+    return max(1, min(int(environment.get("HUBSPOT_SEARCH_CONCURRENCY", "3")), max_connections - 1))
+
+
+# Each portal gets its search connections and a history connection, the other history connections go to the
+# portals in proportion to their deals. A portal never gets more than max_connections, even with its concurrency.
+def share_connections(portals, max_connections):
+    for portal in portals:
+        portal["search_connections"] = get_search_connections(portal, max_connections)
+    total_deals = sum(portal["deals"] for portal in portals)
+    spare_connections = max(0, max_connections - sum(1 + portal["search_connections"] for portal in portals))
+    for portal in portals:
+        if portal["concurrency"]:
+            concurrency = int(portal["concurrency"])
+        elif total_deals:
+            concurrency = 1 + spare_connections * portal["deals"] // total_deals
+        else:
+            concurrency = 1 + spare_connections // len(portals)
+        portal["concurrency"] = max(1, min(concurrency, max_connections - portal["search_connections"]))
+        portal["connections"] = portal["concurrency"] + portal["search_connections"]
+
+
+def start_portal(portal, arguments):
+    os.makedirs(portal["output"], exist_ok=True)
+    environment = dict(os.environ, **portal["env"])
+    environment.update({
+        "HUBSPOT_TOKEN": portal["token"],
+        "HUBSPOT_PIPELINE": portal["pipeline"],
+        "HUBSPOT_DATES": portal["dates"],
+        "HUBSPOT_CONCURRENCY": str(portal["concurrency"]),
+        "PYTHONUNBUFFERED": "1",
+    })
+    if portal["search_connections"]:
+        environment["HUBSPOT_SEARCH_CONCURRENCY"] = str(portal["search_connections"])
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), portal["script"])]
+    if arguments.incremental:
+        command.append("--incremental")
+    if arguments.resume:
+        command.append("--resume")
+
+    # The output of the script goes to output/batch.log, it gets no keyboard: a question it could not answer stops it
+    portal["log"] = open(os.path.join(portal["output"], "batch.log"), mode="w", encoding="utf-8")
+    portal["process"] = subprocess.Popen(command, cwd=portal["output"], env=environment, stdin=subprocess.DEVNULL, stdout=portal["log"], stderr=subprocess.STDOUT)
+    portal["started"] = time.perf_counter()
+    print(f"{portal['name']}: {portal['script']} started with {portal['connections']} connections ({portal['deals']} deals)")
+
+
+def finish_portal(portal):
+    portal["log"].close()
+    portal["seconds"] = time.perf_counter() - portal["started"]
+    portal["returncode"] = portal["process"].returncode
+    duration = f"{int(portal['seconds'] // 3600)}:{int(portal['seconds'] % 3600 // 60):02d}:{int(portal['seconds'] % 60):02d}"
+
+    # The deals written, from the metrics saved by the script
+    metrics_path = os.path.join(portal["output"], "extract", f"{os.path.splitext(portal['script'])[0]}.metrics.json")
+    deals = ""
+    if os.path.exists(metrics_path):
+        with open(metrics_path, encoding="utf-8") as file:
+            deals = f", {json.load(file)['deals']['processed']} deals"
+
+    if portal["returncode"] == 0:
+        print(colored(f"{portal['name']}: done in {duration}{deals}", "green"))
+    else:
+        print(colored(f"{portal['name']}: failed after {duration} (exit code {portal['returncode']}), see {os.path.join(portal['output'], 'batch.log')}", "red"))
+
+
+# Starts the biggest portals first, they decide when the batch ends. A portal waits for free connections
+# if the portals need more than max_connections together (more portals than connections).
+def run_portals(portals, max_connections, arguments):
+    pending = sorted(portals, key=lambda portal: portal["deals"], reverse=True)
+    running = []
+    free_connections = max_connections
+    try:
+        while pending or running:
+            while pending and (pending[0]["connections"] <= free_connections or not running):
+                portal = pending.pop(0)
+                start_portal(portal, arguments)
+                free_connections -= portal["connections"]
+                running.append(portal)
+
+            time.sleep(1)
+            for portal in [portal for portal in running if portal["process"].poll() is not None]:
+                finish_portal(portal)
+                free_connections += portal["connections"]
+                running.remove(portal)
+    except KeyboardInterrupt:
+        # The scripts got the Ctrl+C too and save their checkpoint, --resume continues them
+        for portal in running:
+            portal["process"].wait()
+            portal["log"].close()
+        raise
+
+
+def main():
+    load_dotenv()
+    arguments = get_arguments()
+
+    if not os.path.exists(arguments.manifest):
+        print(colored(f"The manifest {arguments.manifest} does not exist, see the README for its format.", "red"))
+        sys.exit(1)
+    with open(arguments.manifest, encoding="utf-8") as file:
+        manifest = json.load(file)
+
+    portals = load_portals(manifest, arguments.only)
+    if portals is None:
+        sys.exit(1)
+    max_connections = arguments.max_connections or manifest.get("max_connections", 64)
+
+    # Every portal is checked before any starts
+    errors = [error for error in map(check_pipeline, portals) if error]
+    for error in errors:
+        print(colored(error, "red"))
+    if errors:
+        sys.exit(1)
+
+    for portal in portals:
+        portal["deals"] = count_deals(portal)
+    share_connections(portals, max_connections)
+
+    started = time.perf_counter()
+    run_portals(portals, max_connections, arguments)
+
+    failed = [portal["name"] for portal in portals if portal["returncode"] != 0]
+    seconds = time.perf_counter() - started
+    print(f"{len(portals) - len(failed)}/{len(portals)} portals extracted in {int(seconds // 3600)}:{int(seconds % 3600 // 60):02d}:{int(seconds % 60):02d}")
+    # A failed portal fails the batch, for the schedulers (cron...) running it
+    if failed:
+        print(colored(f"Failed: {', '.join(failed)}. Run the batch again with --resume --only NAME to continue them.", "red"))
+        sys.exit(1)
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
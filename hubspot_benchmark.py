@@ -0,0 +1,187 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+from datetime import datetime
+from termcolor import colored
+
+# Throughput benchmark of the hubspot_history_*.py scripts against the local mock portal of hubspot_mock.py.
+# Every script runs from scratch in its own temporary folder, once per date mode, and reports:
+#   deals/s            deals written per second of the whole run
+#   requests/deal      HubSpot requests counted by the mock server (search, histories, pipelines, 429s)
+#   peak RSS           maximum resident memory of the script
+#   first row          seconds until the first page of deals is written
+# The results are appended to extract/benchmark_results.csv and compared with the previous run of each script and mode.
+# The engine options of the .env file are passed through (HUBSPOT_ENGINE=v3, HUBSPOT_ASYNC=on...), the history cache is off.
+
+SCRIPTS = {
+    "hubspot_history.py": ["all", "{all_dates}"],
+    "hubspot_history_all_pipes.py": ["all"],
+    "hubspot_history_date_pipeline.py": ["all", "{all_dates}"],
+    "hubspot_history_combined.py": ["all", "{all_dates}"],
+}
+RESULTS_FILE = "extract/benchmark_results.csv"
+RESULTS_HEADER = ["Date", "Label", "Script", "All Dates", "Deals", "Seconds", "Deals/s", "Requests/Deal", "429s", "Peak RSS (MB)", "First Row (s)"]
+
+
+def get_stats(url):
+    with urllib.request.urlopen(f"{url}/mock/stats") as response:
+        return json.load(response)
+
+
+def start_mock(arguments):
+    command = [
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "hubspot_mock.py"),
+        "--port", str(arguments.port),
+        "--deals", str(arguments.deals),
+        "--history", str(arguments.history),
+        "--latency", str(arguments.latency),
+        "--rate-limit", str(arguments.rate_limit),
+        "--seed", str(arguments.seed),
+    ]
+    mock = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{arguments.port}"
+    for _ in range(100):
+        try:
+            get_stats(url)
+            return mock, url
+        except OSError:
+            time.sleep(0.1)
+    mock.kill()
+    raise RuntimeError(f"The mock server did not start on {url}")
+
+
+# Peak RSS of a finished child process, ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def wait_peak_rss(process):
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_script(script, inputs, url):
+    folder = tempfile.mkdtemp(prefix="hubspot_benchmark_")
+    env = dict(os.environ, HUBSPOT_TOKEN="benchmark", HUBSPOT_API_URL=url, HUBSPOT_CACHE="off", PYTHONUNBUFFERED="1")
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, script_path], cwd=folder, env=env, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+    )
+    process.stdin.write("".join(f"{answer}\n" for answer in inputs))
+    process.stdin.close()
+
+    # The scripts print "N deals processed until now..." (or "so far") once a page of deals is written
+    result = {"first_row": None, "deals": 0, "output": []}
+
+    def read_output():
+        for line in process.stdout:
+            if " deals processed " in line:
+                if result["first_row"] is None:
+                    result["first_row"] = time.perf_counter() - started
+                result["deals"] = int(line.split()[0])
+            result["output"].append(line)
+
+    reader = threading.Thread(target=read_output)
+    reader.start()
+    peak_rss = wait_peak_rss(process)
+    seconds = time.perf_counter() - started
+    reader.join()
+    shutil.rmtree(folder, ignore_errors=True)
+
+    if process.returncode:
+        print("".join(result["output"][-20:]))
+        raise RuntimeError(f"{script} stopped with the exit code {process.returncode}")
+    return result["deals"], seconds, peak_rss, result["first_row"]
+
+
+def load_previous_results():
+    previous = {}
+    if os.path.exists(RESULTS_FILE):
+        with open(RESULTS_FILE, newline="", encoding="utf-8") as file:
+            for row in csv.DictReader(file):
+                previous[(row["Script"], row["All Dates"])] = row
+    return previous
+
+
+def save_results(rows):
+    new_file = not os.path.exists(RESULTS_FILE)
+    with open(RESULTS_FILE, mode="a", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(RESULTS_HEADER)
+        writer.writerows(rows)
+    print(f"File saved : {RESULTS_FILE}")
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Throughput benchmark of the extraction scripts against the mock HubSpot portal")
+    parser.add_argument("--deals", type=int, default=2000)
+    parser.add_argument("--history", type=int, default=5, help="maximum number of dealstage versions per deal")
+    parser.add_argument("--latency", type=float, default=50, help="milliseconds added to every answer of the mock")
+    # No limit by default, so the results measure the scripts rather than the limit (HubSpot allows 190 requests per 10 seconds)
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per 10 seconds, 0 for no limit")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--scripts", nargs="+", default=list(SCRIPTS), choices=list(SCRIPTS))
+    parser.add_argument("--label", default="", help="saved with the results, for example the branch or the option tried")
+    return parser.parse_args()
+
+
+def main():
+
+    # Folder creation if not exist
+    if not os.path.exists("extract"):
+        os.makedirs("extract")
+
+    arguments = get_arguments()
+    mock, url = start_mock(arguments)
+    previous = load_previous_results()
+    rows = []
+    try:
+        print(colored(f"Mock portal of {arguments.deals} deals, {arguments.latency:g} ms of latency, {arguments.rate_limit} requests per 10 seconds", "green"))
+        for script in arguments.scripts:
+            modes = ["on", "off"] if "{all_dates}" in SCRIPTS[script] else ["-"]
+            for mode in modes:
+                inputs = [answer.replace("{all_dates}", "all" if mode == "on" else "") for answer in SCRIPTS[script]]
+                stats = get_stats(url)
+                deals, seconds, peak_rss, first_row = run_script(script, inputs, url)
+                new_stats = get_stats(url)
+                requests = new_stats.get("requests", 0) - stats.get("requests", 0)
+                rate_limited = new_stats.get("429", 0) - stats.get("429", 0)
+
+                row = [
+                    datetime.now().strftime("%Y-%m-%d %H:%M"), arguments.label, script, mode, deals, round(seconds, 2),
+                    round(deals / seconds, 1), round(requests / max(deals, 1), 3), rate_limited, round(peak_rss, 1),
+                    "" if first_row is None else round(first_row, 2),
+                ]
+                rows.append(row)
+
+                change = ""
+                last = previous.get((script, mode))
+                if last and float(last["Deals/s"]):
+                    change = f" ({(float(row[6]) / float(last['Deals/s']) - 1) * 100:+.1f}% deals/s since {last['Date']})"
+                print(f"{script} all dates {mode}: {row[6]} deals/s, {row[7]} requests/deal, {rate_limited} 429s, {row[9]} MB peak RSS, first row after {row[10]} s{change}")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    save_results(rows)
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
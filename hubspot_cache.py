@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+
+# On-disk cache of the deal property versions, shared by all the hubspot_history_*.py scripts.
+# Each entry is stored with the hs_lastmodifieddate of the deal: once a deal is modified
+# its date changes, so its old versions are never read again and end up evicted.
+# The deal ids are only unique within a portal: the entries are keyed by the account of the token too, so the
+# portals extracted in the same folder (hubspot_batch.py, another .env file) never read each other's deals.
+
+
+class HistoryCache:
+
+    def __init__(self, path, account, max_bytes, max_age):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.account = account
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+
+        # The cache of the previous versions has no account, its deals may be those of another portal: it starts again
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(history)")]
+        if columns and "account" not in columns:
+            self.connection.execute("DROP TABLE history")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "account TEXT, deal_id TEXT, last_modified TEXT, fetched_at REAL, accessed_at REAL, size INTEGER, data BLOB, "
+            "PRIMARY KEY (account, deal_id))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS history_accessed_at ON history (accessed_at)")
+        self.connection.commit()
+
+    # keys: list of (deal_id, last_modified), returns {key: histories} for the keys found in the cache
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                deal_id, last_modified = key
+                row = None
+                if last_modified:
+                    row = self.connection.execute(
+                        "SELECT data FROM history WHERE account = ? AND deal_id = ? AND last_modified = ? AND fetched_at >= ?",
+                        (self.account, deal_id, last_modified, now - self.max_age),
+                    ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                found[key] = json.loads(zlib.decompress(row[0]))
+
+            if found:
+                self.connection.executemany(
+                    "UPDATE history SET accessed_at = ? WHERE account = ? AND deal_id = ?",
+                    [(now, self.account, deal_id) for deal_id, last_modified in found],
+                )
+                self.connection.commit()
+        return found
+
+    # entries: list of ((deal_id, last_modified), histories)
+    def set_many(self, entries):
+        now = time.time()
+        rows = []
+        for (deal_id, last_modified), histories in entries:
+            if not last_modified:
+                continue
+            data = zlib.compress(json.dumps(histories).encode("utf-8"))
+            rows.append((self.account, deal_id, last_modified, now, now, len(data), data))
+
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    # Yields (deal_id, histories) for every entry of the account younger than max_age in the order of the deal ids, read by chunks
+    # so the cache is never loaded whole, used by the history store of hubspot_analytics.py
+    def iter_all(self):
+        with self.lock:
+            cursor = self.connection.execute(
+                "SELECT deal_id, data FROM history WHERE account = ? AND fetched_at >= ? ORDER BY CAST(deal_id AS INTEGER)",
+                (self.account, time.time() - self.max_age),
+            )
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for deal_id, data in rows:
+                yield deal_id, json.loads(zlib.decompress(data))
+
+    # When the newest entry of the account was downloaded, 0 without any
+    def get_last_fetched(self):
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(MAX(fetched_at), 0) FROM history WHERE account = ?", (self.account,)).fetchone()[0]
+
+    # Drop the entries older than max_age, then the least recently used ones until the cache fits in max_bytes
+    def evict(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM history WHERE fetched_at < ?", (time.time() - self.max_age,))
+            total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM history").fetchone()[0]
+            if total_size > self.max_bytes:
+                evicted = []
+                for account, deal_id, size in self.connection.execute("SELECT account, deal_id, size FROM history ORDER BY accessed_at"):
+                    if total_size <= self.max_bytes:
+                        break
+                    evicted.append((account, deal_id))
+                    total_size -= size
+                self.connection.executemany("DELETE FROM history WHERE account = ? AND deal_id = ?", evicted)
+            self.connection.commit()
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+from hubspot_extract import (
+    get_api,
+    close_api,
+    get_pipeline_index,
+    get_all_pipeline_stages,
+    get_deal_windows,
+    iter_deal_pages,
+    iter_page_histories,
+    stage_history_rows,
+    stage_changes_rows,
+    pipeline_history_rows,
+    CACHED_PROPERTIES,
+)
+from hubspot_store import write_history_store
+
+# Extraction client for other Python programs (an Airflow task, a notebook...): importing it prints nothing and asks
+# nothing. It keeps its session, its pipelines and stages and its history cache from one call to the next:
+#
+#   with HubSpotClient() as client:
+#       for row in client.iter_stage_history(pipeline="default", all_dates=True):
+#           ...
+#
+# The rows are those of the report files (STAGE_HISTORY_HEADER...), with the timestamps in epoch milliseconds.
+# The options are read from the environment like the scripts (HUBSPOT_ENGINE, HUBSPOT_CACHE...), and the cache and
+# the metrics go to the extract folder of the current directory. The messages of the calls (retries, rate limits,
+# failed deals, summary at close) go to the "hubspot_client" logger instead of the terminal.
+
+logger = logging.getLogger("hubspot_client")
+
+# The colors of the scripts' messages give the levels of the log
+LOG_LEVELS = {None: logging.INFO, "green": logging.INFO, "yellow": logging.WARNING, "red": logging.ERROR}
+
+
+def log_message(message, color=None):
+    logger.log(LOG_LEVELS.get(color, logging.INFO), message)
+
+
+class HubSpotClient:
+
+    def __init__(self, token=None):
+        token = token or os.environ.get("HUBSPOT_TOKEN")
+        if not token:
+            raise ValueError("No HubSpot token: pass it to HubSpotClient or set HUBSPOT_TOKEN")
+        os.makedirs("extract", exist_ok=True)
+        self.api = get_api(token)
+        self.api["metrics"].script = "hubspot_client"
+        self.api["log"] = log_message
+        self.api["rate_limiter"].log = log_message
+        self.api["search_rate_limiter"].log = log_message
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # The pipelines and stages, downloaded again once HUBSPOT_METADATA_TTL has passed or with refresh
+    def get_pipeline_index(self, refresh=False):
+        pipeline_index = self.api["pipeline_index"]
+        expired = pipeline_index is not None and pipeline_index["fetched_at"] + self.api["metadata_ttl"] < time.time()
+        return get_pipeline_index(self.api, refresh=refresh or expired)
+
+    # [{"id": ..., "label": ...}]
+    def get_pipelines(self, refresh=False):
+        return self.get_pipeline_index(refresh)["pipelines"]
+
+    # ({stage_id: stage_label}, {pipeline_id: pipeline_label})
+    def get_stages(self, refresh=False):
+        self.get_pipeline_index(refresh)
+        return get_all_pipeline_stages(self.api)
+
+    # The deals of a pipeline (all of them with None) as returned by the search, by pages of page_size deals.
+    # modified_after (epoch milliseconds) only keeps the deals modified since then.
+    def iter_deal_pages(self, pipeline=None, modified_after=None, page_size=20):
+        windows = get_deal_windows(self.api, pipeline, modified_after)
+        for deals, cursor in iter_deal_pages(self.api, pipeline, windows, limit=page_size, modified_after=modified_after):
+            yield deals
+
+    def iter_deals(self, pipeline=None, modified_after=None):
+        for deals in self.iter_deal_pages(pipeline, modified_after):
+            yield from deals
+
+    # (deal, {property: [versions]}) for each deal, the histories of the next pages are fetched while a deal is used.
+    # A deal whose history cannot be fetched raises its error, unless a DeadLetter is given to keep it aside.
+    def iter_histories(self, pipeline=None, properties=("dealstage", "pipeline"), modified_after=None, dead_letter=None):
+        pages = ((deals, None) for deals in self.iter_deal_pages(pipeline, modified_after))
+        for deals, all_histories, cursor in iter_page_histories(self.api, pages, list(properties), dead_letter=dead_letter):
+            yield from zip(deals, all_histories)
+
+    # Rows of deal_stage_history: [deal id, deal name, stage, pipeline, timestamp]
+    def iter_stage_history(self, pipeline=None, all_dates=False, modified_after=None, dead_letter=None):
+        stage_dict, pipeline_dict = self.get_stages()
+        for deal, histories in self.iter_histories(pipeline, ["dealstage"], modified_after, dead_letter):
+            yield from stage_history_rows(deal, histories["dealstage"], all_dates, stage_dict, pipeline_dict)
+
+    # Rows of deal_stage_changes: [deal id, deal name, number of stage changes]
+    def iter_stage_changes(self, pipeline=None, modified_after=None, dead_letter=None):
+        for deal, histories in self.iter_histories(pipeline, ["dealstage"], modified_after, dead_letter):
+            yield from stage_changes_rows(deal, histories["dealstage"])
+
+    # Rows of deal_pipeline_history: [deal id, deal name, pipeline, timestamp]
+    def iter_pipeline_history(self, pipeline=None, all_dates=False, modified_after=None, dead_letter=None):
+        stage_dict, pipeline_dict = self.get_stages()
+        for deal, histories in self.iter_histories(pipeline, ["pipeline"], modified_after, dead_letter):
+            yield from pipeline_history_rows(deal, histories["pipeline"], all_dates, pipeline_dict)
+
+    # Columnar copy of the history cache for hubspot_analytics.py (HUBSPOT_STORE), only built when asked: returns the
+    # number of versions written, None when the cache or the store is off
+    def build_store(self):
+        if not self.api["cache"] or self.api["store_path"].lower() == "off":
+            return None
+        rows = write_history_store(self.api["store_path"], self.api["cache"].iter_all(), CACHED_PROPERTIES, self.api["account"])
+        logger.info(f"History store: {rows} versions in {self.api['store_path']}")
+        return rows
+
+    # Trims the cache and saves the metrics of all the calls made by the client
+    def close(self):
+        close_api(self.api)
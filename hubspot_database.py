@@ -0,0 +1,94 @@
+import os
+import re
+import time
+import sqlite3
+
+# SQLite output of the hubspot_history_*.py scripts (HUBSPOT_OUTPUT_FORMAT=sqlite in the .env file).
+# Each report is a table of the database, with the columns of its CSV file in snake_case and the timestamps
+# in epoch milliseconds, plus a deals table with the name of every extracted deal.
+# Each page of deals is written in one transaction that replaces the previous rows of its deals, so a deal
+# extracted again (--incremental, --resume, another full extraction) is updated instead of duplicated.
+# With append (the live changes of hubspot_webhook.py), a page only replaces the rows of its deals at the same dates.
+
+SQL_TYPES = {"int64": "INTEGER", "string": "TEXT", "dictionary": "TEXT", "timestamp": "INTEGER"}
+
+
+def get_column_name(name):
+    return re.sub(r"\W+", "_", name.strip().lower())
+
+
+class DatabaseWriter:
+    # Same methods as hubspot_output.ReportWriter, the scripts use both the same way
+
+    def __init__(self, path, report_name, header, types, append=False):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.table = report_name
+        self.columns = [get_column_name(name) for name in header]
+        self.types = types
+        self.append = append
+        self.file_counter = 1
+        self.rows = 0
+
+        # WAL mode: the analysts can query the database while an extraction writes to it.
+        # The writer of hubspot_webhook.py is created by the main thread and used by its writer thread.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS deals (deal_id INTEGER PRIMARY KEY, deal_name TEXT, extracted_at INTEGER)")
+            columns = ", ".join(f"{column} {SQL_TYPES[column_type]}" for column, column_type in zip(self.columns, types))
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({columns})")
+
+            # The rows of a deal by date, and the deals that entered a stage or a pipeline by date
+            if "timestamp" in self.columns:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_deal_id ON {self.table} (deal_id, timestamp)")
+                for column, column_type in zip(self.columns, types):
+                    if column_type == "dictionary":
+                        self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_{column} ON {self.table} ({column}, timestamp)")
+            else:
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_deal_id ON {self.table} (deal_id)")
+
+    # Nothing to cut on resume: the pages written after the checkpoint are written again and replace their rows
+    def get_state(self):
+        return {"file_counter": self.file_counter, "part_rows": 0, "part_bytes": 0}
+
+    def resume(self, state):
+        self.file_counter = state["file_counter"]
+
+    # A page is one transaction, a failed one left nothing
+    def rollback(self, state):
+        self.file_counter = state["file_counter"]
+
+    def write_page(self, rows):
+        rows = [
+            [int(value) if column_type in ("int64", "timestamp") else value for value, column_type in zip(row, self.types)]
+            for row in rows
+        ]
+        deals = {row[0]: row[1] for row in rows}
+        extracted_at = int(time.time() * 1000)
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO deals VALUES (?, ?, ?) ON CONFLICT (deal_id) DO UPDATE SET deal_name = excluded.deal_name, extracted_at = excluded.extracted_at",
+                [(deal_id, deal_name, extracted_at) for deal_id, deal_name in deals.items()],
+            )
+            if self.append:
+                timestamp = self.columns.index("timestamp")
+                self.connection.executemany(f"DELETE FROM {self.table} WHERE deal_id = ? AND timestamp = ?", [(row[0], row[timestamp]) for row in rows])
+            else:
+                self.connection.executemany(f"DELETE FROM {self.table} WHERE deal_id = ?", [(deal_id,) for deal_id in deals])
+            placeholders = ", ".join("?" for column in self.columns)
+            self.connection.executemany(f"INSERT INTO {self.table} VALUES ({placeholders})", rows)
+        self.rows += len(rows)
+
+    # Every page is committed on its own, there is no file to complete
+    def finish_expired(self):
+        pass
+
+    def close(self):
+        if self.connection is None:
+            return
+        self.connection.close()
+        self.connection = None
+        print(f"Database saved : {self.path} ({self.table}, {self.rows} rows written)")
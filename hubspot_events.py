@@ -0,0 +1,126 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import sqlite3
+import threading
+
+# Journal of the deal changes received by hubspot_webhook.py (extract/webhook_events.db).
+# HubSpot delivers a webhook again until it gets a 2xx answer, and does not guarantee unique event ids:
+# a change is stored once, keyed by its deal, property, new value and date. The receiver only answers once
+# the changes are committed, the writer thread then appends them to the reports by batches and marks them
+# written in the same transaction that saves the state of the report writers.
+
+# Properties followed by the receiver, the reconciliation crawl fetches their versions
+WEBHOOK_PROPERTIES = ["dealstage", "pipeline"]
+
+# HubSpot signs the date of each request, an older signature is a replayed request
+SIGNATURE_MAX_AGE = 300
+
+# A version found by the reconciliation crawl and a webhook are the same change if they are this close (milliseconds)
+CHANGE_TOLERANCE = 60000
+
+
+def get_signature(secret, method, uri, body, timestamp):
+    message = f"{method}{uri}".encode("utf-8") + body + str(timestamp).encode("utf-8")
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), message, hashlib.sha256).digest()).decode("ascii")
+
+
+# X-HubSpot-Signature-v3 (HMAC SHA-256 of the method, URI, body and date), or the older v1 and v2 signatures
+def verify_signature(secret, method, uri, body, headers):
+    if headers.get("X-HubSpot-Signature-v3"):
+        timestamp = headers.get("X-HubSpot-Request-Timestamp", "")
+        if not timestamp.isdigit() or abs(time.time() * 1000 - int(timestamp)) > SIGNATURE_MAX_AGE * 1000:
+            return False
+        return hmac.compare_digest(get_signature(secret, method, uri, body, timestamp), headers["X-HubSpot-Signature-v3"])
+    if headers.get("X-HubSpot-Signature"):
+        if headers.get("X-HubSpot-Signature-Version") == "v2":
+            source = f"{secret}{method}{uri}".encode("utf-8") + body
+        else:
+            source = secret.encode("utf-8") + body
+        return hmac.compare_digest(hashlib.sha256(source).hexdigest(), headers["X-HubSpot-Signature"])
+    return False
+
+
+# The dealstage and pipeline changes of a webhook batch as (deal_id, property, value, date, event_id), the other events are ignored
+def get_changes(events):
+    changes = []
+    for event in events:
+        if event.get("subscriptionType") != "deal.propertyChange" or event.get("propertyName") not in WEBHOOK_PROPERTIES:
+            continue
+        changes.append((str(event["objectId"]), event["propertyName"], event.get("propertyValue") or "", int(event["occurredAt"]), str(event.get("eventId", ""))))
+    return changes
+
+
+class EventJournal:
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # A change answered to HubSpot must survive a power cut
+        self.connection.execute("PRAGMA synchronous=FULL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "deal_id TEXT, property TEXT, value TEXT, occurred_at INTEGER, event_id TEXT, source TEXT, received_at INTEGER, "
+                "written INTEGER DEFAULT 0, PRIMARY KEY (deal_id, property, value, occurred_at))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS events_pending ON events (written, occurred_at)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    # Returns the number of new changes. A change brought by the other source (webhook or reconciliation)
+    # within CHANGE_TOLERANCE is already known: the date of a version can differ a little from the date of its event.
+    def add(self, changes, source):
+        now = int(time.time() * 1000)
+        added = 0
+        with self.lock, self.connection:
+            for deal_id, property_name, value, occurred_at, event_id in changes:
+                known = self.connection.execute(
+                    "SELECT 1 FROM events WHERE deal_id = ? AND property = ? AND value = ? AND occurred_at BETWEEN ? AND ? AND source != ? LIMIT 1",
+                    (deal_id, property_name, value, occurred_at - CHANGE_TOLERANCE, occurred_at + CHANGE_TOLERANCE, source),
+                ).fetchone()
+                if known:
+                    continue
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO events (deal_id, property, value, occurred_at, event_id, source, received_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (deal_id, property_name, value, occurred_at, event_id, source, now),
+                )
+                added += cursor.rowcount
+        return added
+
+    # The oldest changes not written yet: (rowid, deal_id, property, value, occurred_at)
+    def get_pending(self, limit):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT rowid, deal_id, property, value, occurred_at FROM events WHERE written = 0 ORDER BY occurred_at LIMIT ?", (limit,)
+            ).fetchall()
+
+    # The changes of a page are written and the report writers are at states
+    def commit_written(self, rowids, states):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE events SET written = 1 WHERE rowid = ?", [(rowid,) for rowid in rowids])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", [(f"writer:{name}", json.dumps(state)) for name, state in states.items()]
+            )
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    # HubSpot stops delivering a webhook again after a few days, older written changes are not needed to spot duplicates
+    def prune(self, before):
+        with self.lock, self.connection:
+            return self.connection.execute("DELETE FROM events WHERE written = 1 AND received_at < ?", (before,)).rowcount
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,1253 @@
+import requests
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import calendar
+import queue
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from termcolor import colored
+from hubspot_cache import HistoryCache
+from hubspot_async import AsyncClient
+from hubspot_metrics import Metrics
+from hubspot_output import (
+    get_report_files,
+    read_report_rows,
+    write_report_rows,
+    remove_deals_from_parquet,
+    lock_reports,
+    get_report_writer,
+    get_next_file_number,
+    remove_report_files,
+)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Shared HubSpot calls and report rows used by all the hubspot_history_*.py scripts
+
+STAGE_HISTORY_HEADER = ["Deal ID", "Deal Name", "Deal Stage", "Pipeline", "Timestamp"]
+STAGE_CHANGES_HEADER = ["Deal ID", "Deal Name", "Number of Stage Changes"]
+PIPELINE_HISTORY_HEADER = ["Deal ID", "Deal Name", "Pipeline Name", "Timestamp"]
+
+# Column types of the reports, used by the Parquet output (the CSV files write the timestamps as "%Y-%m-%d %H:%M")
+STAGE_HISTORY_TYPES = ["int64", "string", "dictionary", "dictionary", "timestamp"]
+STAGE_CHANGES_TYPES = ["int64", "string", "int64"]
+PIPELINE_HISTORY_TYPES = ["int64", "string", "dictionary", "timestamp"]
+
+# The pipelines and stages of the portal, saved by get_pipeline_index
+PIPELINE_INDEX_PATH = "extract/pipelines.json"
+
+# The search endpoint returns at most 10,000 results, bigger searches are split by createdate windows
+SEARCH_MAX_RESULTS = 10000
+
+# Deals per search request, the maximum allowed by HubSpot
+SEARCH_PAGE_SIZE = 100
+
+# Versions kept in the history cache, so every script can reuse them whatever property it extracts
+CACHED_PROPERTIES = ["dealstage", "pipeline"]
+
+# Answers of a HubSpot server in trouble, the request is sent again after a pause growing with each attempt
+RETRY_STATUSES = [500, 502, 503, 504]
+
+
+# The messages of the calls (retries, rate limits, failed deals, summary of the run) are printed by the scripts,
+# hubspot_client.py sends them to the logging of the program it runs in (api["log"])
+def print_message(message, color=None):
+    print(colored(message, color) if color else message)
+
+
+class RateLimiter:
+    # Paces the requests to stay just under the limits sent back by HubSpot in the X-HubSpot-RateLimit-* headers
+
+    def __init__(self, safety=0.9, daily_reserve=0, max_requests=None, interval=1.0):
+        self.lock = threading.Lock()
+        self.log = print_message
+        self.safety = safety
+        self.daily_reserve = daily_reserve
+        self.interval = interval
+        self.max_requests = max_requests
+        self.sent = deque()
+        self.in_flight = 0
+        self.paused_until = 0
+
+    # Book a request if it can be sent without going over the limits, else return the seconds to wait before trying again.
+    # HubSpot counts a request when it gets it, somewhere between its sending and its answer: a request counts in the
+    # window from its answer (update), and until then it takes a place in every window.
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.paused_until - now
+            if delay <= 0 and self.max_requests:
+                while self.sent and self.sent[0] <= now - self.interval:
+                    self.sent.popleft()
+                if len(self.sent) + self.in_flight >= max(1, int(self.max_requests * self.safety)):
+                    # All the places are taken by requests in flight: try again once some are answered
+                    delay = self.sent[0] + self.interval - now if self.sent else self.interval / 10
+            if delay <= 0:
+                self.in_flight += 1
+                return 0
+            return delay
+
+    # Block until a request can be sent without going over the limits
+    def wait(self):
+        delay = self.reserve()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.reserve()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # The answer of a booked request, None when it failed before its answer
+    def update(self, response):
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.sent.append(time.monotonic())
+        if response is None:
+            return
+
+        headers = response.headers
+        with self.lock:
+            if "X-HubSpot-RateLimit-Max" in headers:
+                self.max_requests = int(headers["X-HubSpot-RateLimit-Max"])
+                self.interval = int(headers.get("X-HubSpot-RateLimit-Interval-Milliseconds", 10000)) / 1000
+            elif "X-HubSpot-RateLimit-Secondly" in headers:
+                self.max_requests = int(headers["X-HubSpot-RateLimit-Secondly"])
+                self.interval = 1.0
+            remaining = headers.get("X-HubSpot-RateLimit-Remaining", headers.get("X-HubSpot-RateLimit-Secondly-Remaining"))
+            interval = self.interval
+            daily_remaining = headers.get("X-HubSpot-RateLimit-Daily-Remaining")
+            daily_exhausted = daily_remaining is not None and int(daily_remaining) <= self.daily_reserve and self.paused_until < time.monotonic()
+
+        # The other processes using the same app already consumed the budget of this interval
+        if remaining is not None and int(remaining) <= 0:
+            self.pause(interval)
+
+        if response.status_code == 429:
+            retry_after = headers.get("Retry-After")
+            self.pause(float(retry_after) if retry_after else interval)
+
+        if daily_exhausted:
+            # HubSpot resets the daily limit at midnight
+            now = datetime.now()
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            self.log(f"The daily API limit is reached, waiting until {midnight}...", "red")
+            self.pause((midnight - now).total_seconds())
+
+
+# The search endpoint has its own limit of 5 requests per second and sends no rate limit headers to share it between
+# processes: each process sends one search in turn, 4.5 per second together like the safety margin of RateLimiter
+def get_search_rate_limiter(processes):
+    if processes == 1:
+        return RateLimiter(max_requests=5, interval=1.0)
+    return RateLimiter(max_requests=1, interval=processes / 4.5)
+
+
+# Identifies the portal of the token without keeping the token in the files of the extract folder
+def get_account(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()[:16]
+
+
+# Local cache of the deal histories of the account (HUBSPOT_CACHE in the .env file, "off" to disable it), None when disabled
+def get_history_cache(account):
+    cache_path = os.environ.get("HUBSPOT_CACHE", "extract/history_cache.db")
+    if cache_path.lower() == "off":
+        return None
+    return HistoryCache(
+        cache_path,
+        account,
+        max_bytes=int(os.environ.get("HUBSPOT_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+        max_age=int(os.environ.get("HUBSPOT_CACHE_MAX_DAYS", "30")) * 24 * 3600,
+    )
+
+
+def get_store_path():
+    return os.environ.get("HUBSPOT_STORE", "extract/history_store")
+
+
+def get_api(token):
+    # Asyncio engine: the calls run as coroutines instead of one thread per call (HUBSPOT_ASYNC=on in the .env file)
+    use_async = os.environ.get("HUBSPOT_ASYNC", "off").lower() == "on"
+
+    # Number of deal histories fetched in parallel (HUBSPOT_CONCURRENCY in the .env file)
+    concurrency = int(os.environ.get("HUBSPOT_CONCURRENCY", "100" if use_async else "8"))
+
+    # Processes extracting the portal at the same time (set by hubspot_sharded.py for its workers, HUBSPOT_PROCESSES in
+    # the .env file for workers on several hosts): each one gets its share of the connections and of the searches
+    processes = max(1, int(os.environ.get("HUBSPOT_PROCESSES", "1")))
+    concurrency = max(1, concurrency // processes)
+
+    # Seconds without an answer before a request is sent again, and number of times a failed request is sent again
+    # (HUBSPOT_TIMEOUT and HUBSPOT_MAX_RETRIES in the .env file)
+    timeout = int(os.environ.get("HUBSPOT_TIMEOUT", "60"))
+    max_retries = int(os.environ.get("HUBSPOT_MAX_RETRIES", "5"))
+
+    # Number of createdate windows searched in parallel (HUBSPOT_SEARCH_CONCURRENCY in the .env file)
+    search_concurrency = int(os.environ.get("HUBSPOT_SEARCH_CONCURRENCY", "3"))
+
+    # One keep-alive session for the whole extraction, with a connection per worker and per search thread.
+    # The pool blocks a request until a connection is free instead of opening more, so the process never holds
+    # more than HUBSPOT_CONCURRENCY + HUBSPOT_SEARCH_CONCURRENCY connections (hubspot_batch.py shares them).
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency + search_concurrency, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    account = get_account(token)
+    return {
+        "url": os.environ.get("HUBSPOT_API_URL", "https://api.hubapi.com"),
+        "account": account,
+        "cache": get_history_cache(account),
+        # Columnar copy of the cache, built by the analytics (HUBSPOT_STORE in the .env file)
+        "store_path": get_store_path(),
+        "session": session,
+        "async_client": AsyncClient(headers, concurrency, timeout) if use_async else None,
+        "rate_limiter": RateLimiter(daily_reserve=int(os.environ.get("HUBSPOT_DAILY_RESERVE", "0"))),
+        "search_rate_limiter": get_search_rate_limiter(processes),
+        "concurrency": concurrency,
+        "timeout": timeout,
+        "max_retries": max_retries,
+        "executor": ThreadPoolExecutor(max_workers=concurrency),
+        "search_concurrency": search_concurrency,
+        # History engine: "v1" fetches one deal per request, "v3" uses the CRM v3 batch read (HUBSPOT_ENGINE in the .env file)
+        "engine": os.environ.get("HUBSPOT_ENGINE", "v1").lower(),
+        "batch_size": int(os.environ.get("HUBSPOT_BATCH_SIZE", "50")),
+        # Minutes during which the pipelines and stages saved by a previous run are reused (HUBSPOT_METADATA_TTL in the .env file)
+        "metadata_ttl": int(os.environ.get("HUBSPOT_METADATA_TTL", "60")) * 60,
+        "pipeline_index": None,
+        "log": print_message,
+        # Request and page counters, saved in the extract folder at the end (HUBSPOT_METRICS in the .env file, "off" to disable it)
+        "metrics": Metrics(os.path.splitext(os.path.basename(sys.argv[0]))[0] or "hubspot"),
+        "metrics_folder": os.environ.get("HUBSPOT_METRICS", "extract"),
+    }
+
+
+# End of the extraction: trim the cache, show how much it saved and save the metrics of the run
+def close_api(api):
+    cache = api["cache"]
+    if cache:
+        api["log"](f"History cache: {cache.hits} hits, {cache.misses} misses")
+        cache.close()
+    api["executor"].shutdown()
+    api["session"].close()
+    if api["async_client"]:
+        api["async_client"].close()
+
+    summary = api["metrics"].get_summary()
+    for endpoint, metrics in summary["endpoints"].items():
+        api["log"](f"{endpoint}: {metrics['requests']} requests ({metrics['rate_limited']} rate limited), p50 {metrics['p50'] * 1000:.0f} ms, p95 {metrics['p95'] * 1000:.0f} ms, {metrics['bytes'] / 1048576:.2f} MB")
+    if api["metrics_folder"].lower() != "off":
+        json_file, prometheus_file = api["metrics"].save(api["metrics_folder"])
+        api["log"](f"Metrics saved : {json_file} and {prometheus_file}")
+
+
+# 1, 2, 4, 8... seconds (at most a minute) before sending a failed request again, with some jitter
+# so the workers that failed together do not all come back at the same time
+def get_retry_delay(attempt):
+    return min(60, 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+
+# Every call goes through here: paced by the rate limiter, retried after a 429, and retried with a growing pause
+# after a timeout, a lost connection or a 5xx, up to HUBSPOT_MAX_RETRIES times
+def api_request(api, method, url, rate_limiter=None, **kwargs):
+    if api["async_client"]:
+        return api["async_client"].run(api_request_async(api, method, url, rate_limiter, **kwargs))
+
+    rate_limiter = rate_limiter or api["rate_limiter"]
+    kwargs.setdefault("timeout", api["timeout"])
+    retry = False
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        rate_limiter.wait()
+        waited = time.perf_counter() - started
+        try:
+            response = api["session"].request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            rate_limiter.update(None)
+            api["metrics"].record_error(method, url, error, waited, retry)
+            if attempt >= api["max_retries"]:
+                raise
+            attempt += 1
+            delay = get_retry_delay(attempt)
+            api["log"](f"{type(error).__name__} on {url}, retrying in {delay:.1f} s...", "yellow")
+            time.sleep(delay)
+            retry = True
+            continue
+
+        rate_limiter.update(response)
+        api["metrics"].record_request(method, url, response, response.elapsed.total_seconds(), waited, retry, kwargs.get("stream", False))
+        if response.status_code == 429:
+            response.close()
+            api["log"](f"Rate limit reached on {url}, retrying...", "yellow")
+        elif response.status_code in RETRY_STATUSES and attempt < api["max_retries"]:
+            response.close()
+            attempt += 1
+            delay = get_retry_delay(attempt)
+            api["log"](f"Error {response.status_code} on {url}, retrying in {delay:.1f} s...", "yellow")
+            time.sleep(delay)
+        else:
+            response.raise_for_status()
+            return response
+        retry = True
+
+
+# Same as api_request on the event loop of the asyncio engine, sharing the same rate limiters
+async def api_request_async(api, method, url, rate_limiter=None, **kwargs):
+    rate_limiter = rate_limiter or api["rate_limiter"]
+    retry = False
+    attempt = 0
+    while True:
+        try:
+            response = await api["async_client"].request(rate_limiter, method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            rate_limiter.update(None)
+            api["metrics"].record_error(method, url, error, 0, retry)
+            if attempt >= api["max_retries"]:
+                raise
+            attempt += 1
+            delay = get_retry_delay(attempt)
+            api["log"](f"{type(error).__name__} on {url}, retrying in {delay:.1f} s...", "yellow")
+            await asyncio.sleep(delay)
+            retry = True
+            continue
+
+        rate_limiter.update(response)
+        api["metrics"].record_request(method, url, response, response.elapsed.total_seconds(), response.waited, retry)
+        if response.status_code == 429:
+            api["log"](f"Rate limit reached on {url}, retrying...", "yellow")
+        elif response.status_code in RETRY_STATUSES and attempt < api["max_retries"]:
+            attempt += 1
+            delay = get_retry_delay(attempt)
+            api["log"](f"Error {response.status_code} on {url}, retrying in {delay:.1f} s...", "yellow")
+            await asyncio.sleep(delay)
+        else:
+            response.raise_for_status()
+            return response
+        retry = True
+
+
+# Get all the pipelines
+def get_pipelines(api):
+    return get_pipeline_index(api)["pipelines"]
+
+
+# Answer to a question of the scripts, from the .env file when it is set there (HUBSPOT_PIPELINE: 'all', a pipeline
+# number or id, HUBSPOT_DATES: 'all' or 'first') so they can run without anyone to answer, as with hubspot_batch.py
+def get_answer(variable):
+    answer = os.environ.get(variable)
+    if answer is None:
+        return input()
+    print(f"{answer} ({variable})")
+    return answer
+
+
+# Start of an extraction script: --resume continues the interrupted extraction from its checkpoint, --incremental
+# only extracts the deals modified since the previous one. Returns (checkpoint, state), None when not continued.
+def start_run(name, report_names):
+    # Another process writing the same reports (hubspot_webhook.py, another extraction) would take the same file numbers
+    busy_reports = lock_reports(report_names)
+    if busy_reports:
+        print(colored(f"{', '.join(busy_reports)} is being written by hubspot_webhook.py or another extraction, stop it first: the receiver continues where it stopped once restarted.", "red"))
+        sys.exit(1)
+
+    checkpoint = load_checkpoint(name) if "--resume" in sys.argv else None
+    if "--resume" in sys.argv and not checkpoint:
+        print(colored("No checkpoint found, starting a new extraction.", "yellow"))
+
+    state = load_state(name) if "--incremental" in sys.argv and not checkpoint else None
+    if "--incremental" in sys.argv and not checkpoint and not state:
+        print(colored("No previous extraction found, starting a full extraction.", "yellow"))
+    return checkpoint, state
+
+
+# Make the user choose a pipeline, unless the extraction continued (previous_run) had one. None for all the pipelines.
+def choose_pipeline(api, previous_run=None):
+    if previous_run:
+        return previous_run["pipeline_id"]
+
+    pipelines = get_pipelines(api)
+    print(f"Your pipelines list between 1 and {len(pipelines)}:")
+    for index, pipeline in enumerate(pipelines):
+        print(f"{index + 1}. {pipeline['label']} (ID: {pipeline['id']})")
+
+    print(colored(f"Enter the Pipeline number from 1 to {len(pipelines)} or 'all' for all your pipelines: ", "red"))
+    choice = get_answer("HUBSPOT_PIPELINE")
+
+    if choice.lower() == "all":
+        return None
+    if choice in [pipeline["id"] for pipeline in pipelines]:
+        return choice
+    if choice.isdigit() and 1 <= int(choice) <= len(pipelines):
+        return pipelines[int(choice) - 1]["id"]
+    print("Your choice is not valid, using the first pipeline in the list as default.")
+    return pipelines[0]["id"]
+
+
+# Ask the user if they want all the dates or only the first one, unless the extraction continued had the answer
+def choose_all_dates(question, previous_run=None):
+    if previous_run:
+        return previous_run["all_dates"]
+
+    print(colored(question, "blue"))
+    date_choice = get_answer("HUBSPOT_DATES")
+    return date_choice.lower() == "all"
+
+
+def get_pipeline_stages(api, pipeline_id):
+    url = f"{api['url']}/crm/v3/pipelines/deals/{pipeline_id}"
+    response = api_request(api, "GET", url)
+    return response.json()["stages"]
+
+
+async def get_pipeline_stages_async(api, pipeline_id):
+    url = f"{api['url']}/crm/v3/pipelines/deals/{pipeline_id}"
+    response = await api_request_async(api, "GET", url)
+    return response.json()["stages"]
+
+
+# Get all the stages for all the pipelines: ({stage_id: stage_label}, {pipeline_id: pipeline_label})
+def get_all_pipeline_stages(api):
+    pipeline_index = get_pipeline_index(api)
+    all_stage_dict = {stage_id: stage[1] for stage_id, stage in pipeline_index["stages"].items()}
+    all_pipeline_dict = {pipeline["id"]: pipeline["label"] for pipeline in pipeline_index["pipelines"]}
+    return all_stage_dict, all_pipeline_dict
+
+
+# The pipelines and stages of the portal, built once per run and kept in extract/pipelines.json for the next runs
+# of every script until HUBSPOT_METADATA_TTL expires. "stages" maps a stage id to (pipeline id, stage label, display order).
+# refresh downloads them again, for a stage or a pipeline created since
+def get_pipeline_index(api, refresh=False):
+    if api["pipeline_index"] and not refresh:
+        return api["pipeline_index"]
+
+    pipeline_index = None if refresh else load_pipeline_index()
+    if pipeline_index and (pipeline_index.get("account") != api["account"] or pipeline_index["fetched_at"] + api["metadata_ttl"] < time.time()):
+        pipeline_index = None
+
+    if pipeline_index is None:
+        pipeline_index = fetch_pipeline_index(api)
+        save_json(PIPELINE_INDEX_PATH, pipeline_index)
+        pipeline_index["stages"] = {stage_id: tuple(stage) for stage_id, stage in pipeline_index["stages"].items()}
+
+    api["pipeline_index"] = pipeline_index
+    return pipeline_index
+
+
+# The pipelines and stages saved by the last run whatever their age, None before the first one.
+# hubspot_analytics.py names the stages with them without a token.
+def load_pipeline_index():
+    if not os.path.exists(PIPELINE_INDEX_PATH):
+        return None
+
+    with open(PIPELINE_INDEX_PATH, encoding="utf-8") as file:
+        pipeline_index = json.load(file)
+    pipeline_index["stages"] = {stage_id: tuple(stage) for stage_id, stage in pipeline_index["stages"].items()}
+    return pipeline_index
+
+
+def fetch_pipeline_index(api):
+    url = f"{api['url']}/crm/v3/pipelines/deals"
+    response = api_request(api, "GET", url)
+    pipelines_data = response.json()["results"]
+
+    # The pipelines usually come with their stages, the stages missing from the list are requested in parallel
+    missing = [pipeline["id"] for pipeline in pipelines_data if "stages" not in pipeline]
+    if api["async_client"]:
+        async def get_missing_stages():
+            return await asyncio.gather(*[get_pipeline_stages_async(api, pipeline_id) for pipeline_id in missing])
+        missing_stages = api["async_client"].run(get_missing_stages())
+    else:
+        missing_stages = api["executor"].map(lambda pipeline_id: get_pipeline_stages(api, pipeline_id), missing)
+    missing_stages = dict(zip(missing, missing_stages))
+
+    stages = {}
+    for pipeline in pipelines_data:
+        for stage in missing_stages.get(pipeline["id"], pipeline.get("stages", [])):
+            stages[stage["id"]] = [pipeline["id"], stage["label"], stage.get("displayOrder")]
+
+    return {
+        "account": api["account"],
+        "fetched_at": time.time(),
+        "pipelines": [{"id": pipeline["id"], "label": pipeline["label"]} for pipeline in pipelines_data],
+        "stages": stages,
+    }
+
+
+# modified_after (epoch milliseconds) restricts the search to the deals modified since then,
+# window ([start, end[ in epoch milliseconds, None for no bound) to the deals created in it
+def get_deals(api, pipeline_id, after=None, limit=20, modified_after=None, window=None, direction="ASCENDING"):
+    url = f"{api['url']}/crm/v3/objects/deals/search"
+    filters = []
+    if pipeline_id:
+        filters.append({
+            "propertyName": "pipeline",
+            "operator": "EQ",
+            "value": pipeline_id,
+        })
+    if modified_after:
+        filters.append({
+            "propertyName": "hs_lastmodifieddate",
+            "operator": "GT",
+            "value": str(modified_after),
+        })
+    if window and window[0] is not None:
+        filters.append({"propertyName": "createdate", "operator": "GTE", "value": str(window[0])})
+    if window and window[1] is not None:
+        filters.append({"propertyName": "createdate", "operator": "LT", "value": str(window[1])})
+
+    json = {
+        "filterGroups": [{"filters": filters}] if filters else [],
+        "properties": ["dealstage", "dealname", "pipeline", "createdate", "hs_lastmodifieddate"],
+        "sort": [{"propertyName": "createdate", "direction": direction}],
+        "limit": limit,
+    }
+
+    if after:
+        json["after"] = after
+
+    response = api_request(api, "POST", url, rate_limiter=api["search_rate_limiter"], json=json)
+    return response.json()
+
+
+# Split the deals to extract into createdate windows of at most max_deals deals (SEARCH_MAX_RESULTS by default)
+def get_deal_windows(api, pipeline_id, modified_after=None, max_deals=SEARCH_MAX_RESULTS):
+    # A search never returns more than SEARCH_MAX_RESULTS deals, a bigger window would be cut silently
+    max_deals = min(max_deals, SEARCH_MAX_RESULTS)
+    first_deals = get_deals(api, pipeline_id, limit=1, modified_after=modified_after)
+    # The number of deals to extract, for the ETA of the progress lines
+    api["metrics"].set_deals_total(first_deals["total"])
+    if not first_deals["results"]:
+        return []
+    if first_deals["total"] <= max_deals:
+        return [[None, None]]
+
+    last_deals = get_deals(api, pipeline_id, limit=1, modified_after=modified_after, direction="DESCENDING")
+    start = iso_to_timestamp(first_deals["results"][0]["properties"]["createdate"])
+    end = iso_to_timestamp(last_deals["results"][0]["properties"]["createdate"]) + 1
+
+    def count_deals(window):
+        return get_deals(api, pipeline_id, limit=1, modified_after=modified_after, window=window)["total"]
+
+    # Cut the windows in half until each one fits under the search limit, one level at a time
+    windows = []
+    pending = [[start, end]]
+    with ThreadPoolExecutor(max_workers=api["search_concurrency"]) as executor:
+        while pending:
+            totals = list(executor.map(count_deals, pending))
+            next_pending = []
+            for window, total in zip(pending, totals):
+                if total > max_deals and window[1] - window[0] > 1:
+                    middle = (window[0] + window[1]) // 2
+                    next_pending += [[window[0], middle], [middle, window[1]]]
+                elif total > SEARCH_MAX_RESULTS:
+                    # Only a window of one millisecond gets here: more deals were created in it than a search returns
+                    api["log"](f"{total} deals were created at {window[0]}, only the first {SEARCH_MAX_RESULTS} can be extracted.", "red")
+                    windows.append(window)
+                elif total:
+                    windows.append(window)
+            pending = next_pending
+
+    # The deals were deleted while they were counted
+    if not windows:
+        return []
+
+    # Open the first and last windows so the deals created during the extraction are not missed
+    windows.sort()
+    windows[0][0] = None
+    windows[-1][1] = None
+    return windows
+
+
+# Yields (deals, cursor) for each page of limit deals of each window, in the createdate order of a single search.
+# The windows are searched in parallel by pages of SEARCH_PAGE_SIZE deals, each one running ahead in a small queue until it is read.
+# cursor ({"window": index, "after": search cursor}) is where to start again after this page, None at the end.
+# Inside a search page, it is the start of that search page: the deals already written have to be skipped.
+def iter_deal_pages(api, pipeline_id, windows, cursor=None, limit=20, modified_after=None):
+    cursor = cursor or {"window": 0, "after": None}
+    stop = threading.Event()
+    page_queues = {index: queue.Queue(maxsize=2) for index in range(cursor["window"], len(windows))}
+    pending_windows = queue.Queue()
+    for index in page_queues:
+        pending_windows.put(index)
+
+    def put(page_queue, item):
+        while not stop.is_set():
+            try:
+                page_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    # Daemon threads: an interrupted extraction never waits for them to exit
+    def search_windows():
+        while not stop.is_set():
+            try:
+                index = pending_windows.get_nowait()
+            except queue.Empty:
+                return
+            after = cursor["after"] if index == cursor["window"] else None
+            try:
+                while not stop.is_set():
+                    deals_data = get_deals(api, pipeline_id, after, limit=SEARCH_PAGE_SIZE, modified_after=modified_after, window=windows[index])
+                    after = deals_data.get("paging", {}).get("next", {}).get("after")
+                    put(page_queues[index], (deals_data["results"], after))
+                    if not after:
+                        break
+            except Exception as error:
+                put(page_queues[index], (error, None))
+
+    for _ in range(api["search_concurrency"]):
+        threading.Thread(target=search_windows, daemon=True).start()
+
+    try:
+        for index, page_queue in page_queues.items():
+            page_cursor = {"window": index, "after": cursor["after"] if index == cursor["window"] else None}
+            while True:
+                deals, after = page_queue.get()
+                if isinstance(deals, Exception):
+                    raise deals
+                if after:
+                    next_cursor = {"window": index, "after": after}
+                elif index + 1 < len(windows):
+                    next_cursor = {"window": index + 1, "after": None}
+                else:
+                    next_cursor = None
+                for start in range(0, len(deals), limit):
+                    yield deals[start:start + limit], next_cursor if start + limit >= len(deals) else page_cursor
+                if not after:
+                    break
+                page_cursor = next_cursor
+    finally:
+        stop.set()
+
+
+# includePropertyVersions is the documented parameter of /deals/v1/deal/{id}: the answer holds the versions of every
+# property of the deal, HubSpot has no parameter to trim it (the v3 engine only downloads the versions asked for)
+PROPERTY_HISTORY_PARAMS = {"includePropertyVersions": "true"}
+
+
+# One v1 call per deal. With ijson installed, the body is parsed while it downloads and only the versions
+# asked for are built, the rest of the deal is skipped without being loaded in memory.
+def get_property_history(api, deal_id, property_names):
+    url = f"{api['url']}/deals/v1/deal/{deal_id}"
+    response = api_request(api, "GET", url, params=PROPERTY_HISTORY_PARAMS, stream=ijson is not None)
+    if ijson is None:
+        return parse_property_history(response.json(), property_names)
+
+    with response:
+        response.raw.decode_content = True
+        return parse_property_history_stream(response.raw, property_names)
+
+
+async def get_property_history_async(api, deal_id, property_names):
+    url = f"{api['url']}/deals/v1/deal/{deal_id}"
+    response = await api_request_async(api, "GET", url, params=PROPERTY_HISTORY_PARAMS)
+    return parse_property_history(response.json(), property_names)
+
+
+def parse_property_history(deal_data, property_names):
+    properties = deal_data["properties"]
+    return {property_name: properties[property_name]["versions"] for property_name in property_names}
+
+
+def parse_property_history_stream(stream, property_names):
+    prefixes = {f"properties.{property_name}.versions": property_name for property_name in property_names}
+    histories = {}
+    builder = None
+    builder_prefix = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder:
+            builder.event(event, value)
+            if event == "end_array" and prefix == builder_prefix:
+                histories[prefixes[prefix]] = builder.value
+                builder = None
+        elif event == "start_array" and prefix in prefixes:
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            builder_prefix = prefix
+    return {property_name: histories[property_name] for property_name in property_names}
+
+
+def iso_to_timestamp(value):
+    # "2023-01-31T10:15:00.123Z" -> 1675160100123, the epoch milliseconds used by the v1 API
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return calendar.timegm(date.utctimetuple()) * 1000 + date.microsecond // 1000
+
+
+def get_property_histories_batch(api, deal_ids, property_names):
+    url = f"{api['url']}/crm/v3/objects/deals/batch/read"
+    response = api_request(api, "POST", url, json=get_batch_read_json(deal_ids, property_names))
+    return parse_property_histories_batch(response.json(), deal_ids, property_names, url)
+
+
+async def get_property_histories_batch_async(api, deal_ids, property_names):
+    url = f"{api['url']}/crm/v3/objects/deals/batch/read"
+    response = await api_request_async(api, "POST", url, json=get_batch_read_json(deal_ids, property_names))
+    return parse_property_histories_batch(response.json(), deal_ids, property_names, url)
+
+
+# The current properties of the deals, by deal id (a deleted deal is missing)
+def get_deals_by_id(api, deal_ids, property_names):
+    url = f"{api['url']}/crm/v3/objects/deals/batch/read"
+    deals = {}
+    for start in range(0, len(deal_ids), api["batch_size"]):
+        json = {"inputs": [{"id": deal_id} for deal_id in deal_ids[start:start + api["batch_size"]]], "properties": list(property_names)}
+        response = api_request(api, "POST", url, json=json)
+        for deal in response.json()["results"]:
+            deals[deal["id"]] = deal
+    return deals
+
+
+def get_batch_read_json(deal_ids, property_names):
+    return {
+        "inputs": [{"id": deal_id} for deal_id in deal_ids],
+        "properties": list(property_names),
+        "propertiesWithHistory": list(property_names),
+    }
+
+
+def parse_property_histories_batch(batch_data, deal_ids, property_names, url):
+    # Convert the versions to the v1 format so both engines write the same rows
+    histories = {}
+    for result in batch_data["results"]:
+        properties_with_history = result.get("propertiesWithHistory", {})
+        histories[result["id"]] = {
+            property_name: [
+                {"value": version["value"], "timestamp": iso_to_timestamp(version["timestamp"]), "source": version.get("sourceType")}
+                for version in properties_with_history.get(property_name, [])
+            ]
+            for property_name in property_names
+        }
+    # A deal missing from the results (deleted, merged) gets the error of a 404 on the v1 API: it goes to the
+    # dead letter like with the v1 engine and is never cached with an empty history
+    return [histories[deal_id] if deal_id in histories else get_not_found_error(url, deal_id) for deal_id in deal_ids]
+
+
+def get_not_found_error(url, deal_id):
+    response = requests.Response()
+    response.status_code = 404
+    response.reason = "Not Found"
+    response.url = url
+    return requests.HTTPError(f"404 Client Error: Not Found for url: {url} (deal {deal_id})", response=response)
+
+
+# A deal whose history cannot be fetched, even after the retries of api_request(), gets the error instead of its
+# versions: the other deals of the page are still written, see iter_page_histories()
+def call_or_error(function, *args):
+    try:
+        return function(*args)
+    except Exception as error:
+        return error
+
+
+async def await_or_error(coroutine):
+    try:
+        return await coroutine
+    except Exception as error:
+        return error
+
+
+# A failed batch is an error for each of its deals
+def flatten_batches(batches, results):
+    return [histories for deal_ids, batch in zip(batches, results) for histories in ([batch] * len(deal_ids) if isinstance(batch, Exception) else batch)]
+
+
+def fetch_property_histories(api, deals, property_names):
+    if api["async_client"]:
+        return api["async_client"].run(fetch_property_histories_async(api, deals, property_names))
+
+    # Fetch the histories on the shared worker pool, map() keeps the search order of the deals
+    executor = api["executor"]
+    if api["engine"] == "v3":
+        batch_size = api["batch_size"]
+        batches = [[deal["id"] for deal in deals[i:i + batch_size]] for i in range(0, len(deals), batch_size)]
+        results = executor.map(lambda deal_ids: call_or_error(get_property_histories_batch, api, deal_ids, property_names), batches)
+        return flatten_batches(batches, results)
+    return list(executor.map(lambda deal: call_or_error(get_property_history, api, deal["id"], property_names), deals))
+
+
+# One coroutine per deal (or per batch), gather() keeps the search order of the deals
+async def fetch_property_histories_async(api, deals, property_names):
+    if api["engine"] == "v3":
+        batch_size = api["batch_size"]
+        batches = [[deal["id"] for deal in deals[i:i + batch_size]] for i in range(0, len(deals), batch_size)]
+        results = await asyncio.gather(*[await_or_error(get_property_histories_batch_async(api, deal_ids, property_names)) for deal_ids in batches])
+        return flatten_batches(batches, results)
+    return list(await asyncio.gather(*[await_or_error(get_property_history_async(api, deal["id"], property_names)) for deal in deals]))
+
+
+# Returns one {property_name: versions} dict per deal (or the error that stopped it), in the order of the deals
+def get_property_histories(api, deals, property_names):
+    cache = api["cache"]
+    if not cache:
+        return fetch_property_histories(api, deals, property_names)
+
+    # Only the deals missing from the cache, or modified since they were cached, are fetched
+    keys = [(deal["id"], deal["properties"].get("hs_lastmodifieddate")) for deal in deals]
+    histories = cache.get_many(keys)
+    missing = [(key, deal) for key, deal in zip(keys, deals) if key not in histories]
+    if missing:
+        fetched = fetch_property_histories(api, [deal for key, deal in missing], CACHED_PROPERTIES)
+        entries = [(key, deal_histories) for (key, deal), deal_histories in zip(missing, fetched)]
+        cache.set_many([(key, deal_histories) for key, deal_histories in entries if not isinstance(deal_histories, Exception)])
+        histories.update(entries)
+
+    return [
+        histories[key] if isinstance(histories[key], Exception) else {property_name: histories[key][property_name] for property_name in property_names}
+        for key in keys
+    ]
+
+
+# Yields (deals, histories, cursor) for the pages of iter_deal_pages(), skipping the deals in skip_deals.
+# The histories of the next pages are already queued on the worker pool while a page is written,
+# so the pool never runs dry between two pages. By default enough fetches are queued to keep the
+# HUBSPOT_CONCURRENCY requests busy (2 pages with the default threads, more with the asyncio engine).
+# The v1 engine fetches each page on its own. The v3 engine takes the deals of the pages in order by batches
+# of HUBSPOT_BATCH_SIZE deals, a batch holding the end of a page and the start of the next ones, so every
+# batch read is full whatever the size of the pages.
+# With a dead_letter, the deals whose history cannot be fetched are left out of their page and saved in it,
+# then fetched again once all the pages are written (with the deals left by a previous run).
+def iter_page_histories(api, pages, property_names, skip_deals=(), ahead=None, dead_letter=None):
+    batch_size = api["batch_size"] if api["engine"] == "v3" else None
+    ahead = ahead or max(2, api["concurrency"] if batch_size else api["concurrency"] // 20)
+    last_cursor = None
+    with ThreadPoolExecutor(max_workers=ahead) as executor:
+        # Pages waiting for their histories: (deals, cursor, [(fetch, start, end)]), with their slice of each fetch
+        pending = deque()
+        fetches = deque()
+        fetch = None
+        for deals, cursor in pages:
+            last_cursor = cursor
+            deals = [deal for deal in deals if deal["id"] not in skip_deals]
+            if not deals:
+                continue
+            parts = []
+            taken = 0
+            while taken < len(deals):
+                fetch = fetch or {"deals": [], "future": None, "pages": 0}
+                size = min(len(deals) - taken, batch_size - len(fetch["deals"]) if batch_size else len(deals))
+                parts.append((fetch, len(fetch["deals"]), len(fetch["deals"]) + size))
+                fetch["deals"] += deals[taken:taken + size]
+                fetch["pages"] += 1
+                taken += size
+                if not batch_size or len(fetch["deals"]) >= batch_size:
+                    submit_fetch(api, executor, fetch, property_names, fetches)
+                    fetch = None
+            pending.append((deals, cursor, parts))
+
+            # The pages whose deals are all queued, once enough fetches run ahead of them
+            while len(fetches) > ahead and pending[0][2][-1][0]["future"] is not None:
+                deals, histories, cursor = pop_page_histories(api, pending, fetches, dead_letter)
+                if deals:
+                    yield deals, histories, cursor
+
+        if fetch:
+            submit_fetch(api, executor, fetch, property_names, fetches)
+        while pending:
+            deals, histories, cursor = pop_page_histories(api, pending, fetches, dead_letter)
+            if deals:
+                yield deals, histories, cursor
+
+    if dead_letter is not None:
+        yield from iter_dead_letter_histories(api, property_names, skip_deals, dead_letter, last_cursor)
+
+
+def submit_fetch(api, executor, fetch, property_names, fetches):
+    fetch["future"] = executor.submit(get_property_histories, api, fetch["deals"], property_names)
+    fetches.append(fetch)
+
+
+# The first pending page with its histories, the fetches it was the last page of are no longer running ahead
+def pop_page_histories(api, pending, fetches, dead_letter):
+    deals, cursor, parts = pending.popleft()
+    histories = []
+    for fetch, start, end in parts:
+        histories += fetch["future"].result()[start:end]
+        fetch["pages"] -= 1
+    while fetches and not fetches[0]["pages"]:
+        fetches.popleft()
+    deals, histories = remove_failed_deals(api, deals, histories, dead_letter)
+    return deals, histories, cursor
+
+
+def remove_failed_deals(api, deals, histories, dead_letter):
+    failed = [(deal, error) for deal, error in zip(deals, histories) if isinstance(error, Exception)]
+    if not failed:
+        return deals, histories
+    if dead_letter is None:
+        raise failed[0][1]
+
+    # Saved before the page is written, so the failed deals are not lost if the extraction stops after its checkpoint
+    for deal, error in failed:
+        api["log"](f"The history of the deal {deal['id']} could not be fetched ({error}), it will be retried at the end.", "red")
+        dead_letter.add(deal, error)
+    dead_letter.save()
+    kept = [(deal, deal_histories) for deal, deal_histories in zip(deals, histories) if not isinstance(deal_histories, Exception)]
+    return [deal for deal, deal_histories in kept], [deal_histories for deal, deal_histories in kept]
+
+
+# Fetch again the deals of the dead letter, the ones that fail again stay in it for the next run
+def iter_dead_letter_histories(api, property_names, skip_deals, dead_letter, cursor):
+    # Deals written before the extraction stopped, or found again by this run's search
+    dead_letter.remove([deal_id for deal_id in dead_letter.deals if deal_id in skip_deals])
+    dead_letter.save()
+    deals = [entry["deal"] for entry in dead_letter.deals.values()]
+    if deals:
+        api["log"](f"Retrying the {len(deals)} deals whose history could not be fetched...", "yellow")
+
+    for start in range(0, len(deals), SEARCH_PAGE_SIZE):
+        page = deals[start:start + SEARCH_PAGE_SIZE]
+        histories = get_property_histories(api, page, property_names)
+        fetched = []
+        for deal, deal_histories in zip(page, histories):
+            if not isinstance(deal_histories, Exception):
+                fetched.append((deal, deal_histories))
+            elif getattr(getattr(deal_histories, "response", None), "status_code", None) == 404:
+                api["log"](f"The deal {deal['id']} no longer exists in HubSpot, it is skipped.", "yellow")
+                dead_letter.remove([deal["id"]])
+            else:
+                api["log"](f"The history of the deal {deal['id']} still could not be fetched ({deal_histories}).", "red")
+                dead_letter.add(deal, deal_histories)
+        dead_letter.save()
+
+        if fetched:
+            yield [deal for deal, deal_histories in fetched], [deal_histories for deal, deal_histories in fetched], cursor
+            # The page is written and its checkpoint saved
+            dead_letter.remove([deal["id"] for deal, deal_histories in fetched])
+            dead_letter.save()
+
+
+# Rows of extract/deal_stage_history_*.csv, the timestamps stay in epoch milliseconds until the rows are written
+def stage_history_rows(deal, histories, all_dates, stage_dict, pipeline_dict):
+    deal_id = deal["id"]
+    deal_name = deal["properties"]["dealname"]
+    pipeline_id = deal["properties"]["pipeline"]
+    pipeline_name = pipeline_dict.get(pipeline_id, pipeline_id)
+    rows = []
+
+    # A deal without versions has no row
+    if not histories:
+        return rows
+
+    if all_dates:
+        for history in histories:
+            if 'value' in history:
+                timestamp = history["timestamp"]
+                value = history["value"]
+                stage_name = stage_dict.get(value, value)
+
+                rows.append([deal_id, deal_name, stage_name, pipeline_name, int(timestamp)])
+
+    else:
+        stage_changes = defaultdict(lambda: {"timestamp": float("inf"), "source": ""})
+        for history in histories:
+            if 'value' in history:
+                timestamp = history["timestamp"]
+                value = history["value"]
+                stage_name = stage_dict.get(value, value)
+
+                if int(timestamp) < stage_changes[stage_name]["timestamp"]:
+                    stage_changes[stage_name] = {"timestamp": int(timestamp), "source": deal_name}
+
+        for stage_name, change_info in stage_changes.items():
+            rows.append([deal_id, deal_name, stage_name, pipeline_name, change_info["timestamp"]])
+
+    return rows
+
+
+# Rows of extract/deal_stage_changes_*.csv
+def stage_changes_rows(deal, histories):
+    stage_changes_count = 0
+    for history in histories:
+        if 'value' in history:
+            stage_changes_count += 1
+
+    return [[deal["id"], deal["properties"]["dealname"], stage_changes_count]]
+
+
+# Rows of extract/deal_pipeline_history_*.csv
+def pipeline_history_rows(deal, histories, all_dates, pipelines_dict):
+    deal_id = deal["id"]
+    deal_name = deal["properties"]["dealname"]
+    rows = []
+
+    if all_dates:
+        for history in histories:
+            if 'value' in history:
+                pipeline_name = pipelines_dict[history["value"]]
+                rows.append([deal_id, deal_name, pipeline_name, int(history["timestamp"])])
+    elif histories:
+        first_entry = min(histories, key=lambda x: x['timestamp'])
+        if 'value' in first_entry:
+            pipeline_name = pipelines_dict[deal["properties"]["pipeline"]]
+            rows.append([deal_id, deal_name, pipeline_name, int(first_entry["timestamp"])])
+
+    return rows
+
+
+# Property whose versions give the rows of each report
+REPORT_PROPERTIES = {"deal_stage_history": "dealstage", "deal_stage_changes": "dealstage", "deal_pipeline_history": "pipeline"}
+
+
+# The three reports written by hubspot_history.py, hubspot_history_all_pipes.py and hubspot_history_date_pipeline.py
+def get_reports(all_dates, stage_dict, pipeline_dict):
+    return [
+        ("deal_stage_history", STAGE_HISTORY_HEADER, STAGE_HISTORY_TYPES, lambda deal, histories: stage_history_rows(deal, histories["dealstage"], all_dates, stage_dict, pipeline_dict)),
+        ("deal_stage_changes", STAGE_CHANGES_HEADER, STAGE_CHANGES_TYPES, lambda deal, histories: stage_changes_rows(deal, histories["dealstage"])),
+        ("deal_pipeline_history", PIPELINE_HISTORY_HEADER, PIPELINE_HISTORY_TYPES, lambda deal, histories: pipeline_history_rows(deal, histories["pipeline"], all_dates, pipeline_dict)),
+    ]
+
+
+# A checkpoint lets an interrupted extraction continue where it stopped (--resume)
+def get_checkpoint_paths(name):
+    return f"extract/{name}.checkpoint.json", f"extract/{name}.checkpoint.deals"
+
+
+def load_checkpoint(name):
+    checkpoint_path, deals_path = get_checkpoint_paths(name)
+    if not os.path.exists(checkpoint_path):
+        return None
+
+    with open(checkpoint_path, encoding="utf-8") as file:
+        checkpoint = json.load(file)
+
+    # The ids written after the last checkpoint belong to a page that was not committed, they are cut
+    checkpoint["deals"] = set()
+    if os.path.exists(deals_path):
+        with open(deals_path, mode="r+b") as file:
+            if "deals_bytes" in checkpoint:
+                file.truncate(checkpoint["deals_bytes"])
+            checkpoint["deals"] = {line.strip() for line in file.read().decode("utf-8").splitlines() if line.strip()}
+    return checkpoint
+
+
+def save_json(path, data):
+    # Write a temporary file then rename it, a crash never leaves a half written file
+    with open(f"{path}.tmp", mode="w", encoding="utf-8") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+# Called once a page is written: the ids of its deals are appended first, then the atomic replace of the json file
+# commits the page with the size of the ids file. A crash in between leaves ids past that size, load_checkpoint cuts them.
+def save_checkpoint(name, checkpoint, deal_ids):
+    checkpoint_path, deals_path = get_checkpoint_paths(name)
+    with open(deals_path, mode="ab") as file:
+        file.write("".join(f"{deal_id}\n" for deal_id in deal_ids).encode("utf-8"))
+        file.flush()
+        os.fsync(file.fileno())
+        deals_bytes = file.tell()
+    save_json(checkpoint_path, dict(checkpoint, deals_bytes=deals_bytes))
+
+
+# Deals whose history could not be fetched, kept in extract/{name}.dead_letter.json until a run fetches them
+class DeadLetter:
+
+    def __init__(self, name):
+        self.path = f"extract/{name}.dead_letter.json"
+        self.deals = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as file:
+                self.deals = json.load(file)
+
+    def add(self, deal, error):
+        response = getattr(error, "response", None)
+        self.deals[deal["id"]] = {
+            "deal": deal,
+            "error": f"{type(error).__name__}: {error}",
+            "status": getattr(response, "status_code", None),
+            "attempts": self.deals.get(deal["id"], {}).get("attempts", 0) + 1,
+            "failed_at": int(time.time() * 1000),
+        }
+
+    def remove(self, deal_ids):
+        for deal_id in deal_ids:
+            self.deals.pop(deal_id, None)
+
+    def save(self):
+        if self.deals:
+            save_json(self.path, self.deals)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def clear(self):
+        self.deals = {}
+        self.save()
+
+
+def clear_checkpoint(name):
+    for path in get_checkpoint_paths(name):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# The state of the last complete extraction, used by --incremental
+def load_state(name):
+    state_path = f"extract/{name}.state.json"
+    if not os.path.exists(state_path):
+        return None
+
+    with open(state_path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_state(name, state):
+    save_json(f"extract/{name}.state.json", state)
+
+
+# Drop the rows of the given deals from extract/{report_name}_N.csv (.gz, .zst, .parquet) for every N < before_file
+def remove_deals_from_csv(report_name, deal_ids, before_file):
+    for file_number, file_name in get_report_files(report_name):
+        if file_number >= before_file:
+            continue
+
+        if file_name.endswith(".parquet"):
+            remove_deals_from_parquet(file_name, deal_ids)
+            continue
+
+        rows = read_report_rows(file_name)
+        kept_rows = rows[:1] + [row for row in rows[1:] if row[0] not in deal_ids]
+        if len(kept_rows) == len(rows):
+            continue
+
+        write_report_rows(file_name, kept_rows)
+
+
+# The extraction of the hubspot_history*.py scripts: writes the reports of report_names for the deals of pipeline_id
+# (None for all the pipelines), saves a checkpoint after each page and the state of the run at the end.
+def run_extraction(api, name, report_names, pipeline_id, all_dates, checkpoint=None, state=None, page_size=20):
+    # Get all the stages for all the pipelines and store it in stage_dict
+    stage_dict, pipeline_dict = get_all_pipeline_stages(api)
+    reports = [report for report in get_reports(all_dates, stage_dict, pipeline_dict) if report[0] in report_names]
+    properties = list(dict.fromkeys(REPORT_PROPERTIES[report_name] for report_name in report_names))
+    report_writers = {report_name: get_report_writer(report_name, header, types) for report_name, header, types, get_rows in reports}
+
+    def save_deals_to_csv(deals, all_histories):
+        for report_name, header, types, get_rows in reports:
+            rows = []
+            for deal, histories in zip(deals, all_histories):
+                rows.extend(get_rows(deal, histories))
+            report_writers[report_name].write_page(rows)
+
+    windows = None
+    cursor = None
+    total_deals_processed = 0
+    dead_letter = DeadLetter(name)
+    completed_deals = set()
+    started_at = int(time.time() * 1000)
+    modified_after = None
+    first_files = None
+
+    if checkpoint:
+        windows = checkpoint["windows"]
+        cursor = checkpoint["cursor"]
+        total_deals_processed = checkpoint["total_deals_processed"]
+        completed_deals = checkpoint["deals"]
+        started_at = checkpoint["started_at"]
+        modified_after = checkpoint["modified_after"]
+        if "outputs" in checkpoint:
+            outputs = checkpoint["outputs"]
+            first_files = checkpoint["first_files"]
+        else:
+            # Checkpoint of a single report script before they shared run_extraction
+            outputs = {report_names[0]: checkpoint["output"]}
+            first_files = {report_names[0]: checkpoint["first_file"]} if checkpoint["first_file"] > 1 else None
+        for report_name, report_writer in report_writers.items():
+            report_writer.resume(outputs[report_name])
+        print(colored(f"Resuming the extraction after {total_deals_processed} deals...", "yellow"))
+    elif state:
+        # Keep the previous files, the modified deals are written in new files after them
+        modified_after = state["last_modified"]
+        # The state of a single report script before they shared run_extraction had one file counter
+        file_counters = state.get("file_counters") or {report_names[0]: state["file_counter"]}
+        # hubspot_webhook.py may have written files after them
+        for report_name, report_writer in report_writers.items():
+            report_writer.file_counter = max(file_counters[report_name], get_next_file_number(report_name))
+        first_files = {report_name: report_writer.file_counter for report_name, report_writer in report_writers.items()}
+        clear_checkpoint(name)
+        print(colored(f"Extracting the deals modified since {datetime.fromtimestamp(modified_after // 1000)}...", "yellow"))
+    else:
+        # Delete the previous files
+        for report_name in report_writers:
+            remove_report_files(report_name)
+        clear_checkpoint(name)
+        dead_letter.clear()
+
+    print("Starting the extraction script...")
+    print(r"""
+            --.
+         ._// <>
+         |_|_
+        (o___o) Deals
+    """)
+    print("###############################################")
+
+    # Split the search in createdate windows to get past the 10,000 results limit of the search endpoint
+    if windows is None:
+        windows = get_deal_windows(api, pipeline_id, modified_after)
+    print(f"Digging -  ({len(windows)} search windows)...")
+
+    # The search runs ahead by pages of 100 deals and the histories of the next pages are fetched while a page is written.
+    # The deals already written before an interruption are skipped. One fetch per deal gives the versions of all the properties.
+    pages = iter_deal_pages(api, pipeline_id, windows, cursor, limit=page_size, modified_after=modified_after)
+    for deals, all_histories, cursor in iter_page_histories(api, pages, properties, skip_deals=completed_deals, dead_letter=dead_letter):
+        print(f"Getting {len(deals)} deals...")
+        started = time.perf_counter()
+        save_deals_to_csv(deals, all_histories)
+        api["metrics"].record_page(len(deals), time.perf_counter() - started)
+
+        total_deals_processed += len(deals)
+        print(f"{total_deals_processed} deals processed until now... ({api['metrics'].get_progress()})")
+
+        checkpoint = {
+            "pipeline_id": pipeline_id,
+            "all_dates": all_dates,
+            "windows": windows,
+            "cursor": cursor,
+            "outputs": {report_name: report_writer.get_state() for report_name, report_writer in report_writers.items()},
+            "total_deals_processed": total_deals_processed,
+            "started_at": started_at,
+            "modified_after": modified_after,
+            "first_files": first_files,
+        }
+        save_checkpoint(name, checkpoint, [deal["id"] for deal in deals])
+        completed_deals.update(deal["id"] for deal in deals)
+
+    for report_writer in report_writers.values():
+        report_writer.close()
+
+    # Incremental extraction: the modified deals are now in the new files, drop their previous rows
+    if first_files:
+        for report_name in report_writers:
+            remove_deals_from_csv(report_name, completed_deals, first_files[report_name])
+
+    # The extraction is complete, nothing left to resume
+    save_state(name, {
+        "pipeline_id": pipeline_id,
+        "all_dates": all_dates,
+        "last_modified": started_at,
+        "file_counters": {report_name: report_writer.file_counter for report_name, report_writer in report_writers.items()},
+    })
+    clear_checkpoint(name)
+    # The deals that still failed are fetched again by the next run
+    if dead_letter.deals:
+        print(colored(f"{len(dead_letter.deals)} deals could not be extracted, they are listed in {dead_letter.path} and will be retried by the next --incremental or --resume run.", "red"))
@@ -0,0 +1,83 @@
+import os
+from dotenv import load_dotenv
+from termcolor import colored
+from hubspot_extract import (
+    get_api,
+    start_run,
+    choose_pipeline,
+    choose_all_dates,
+    close_api,
+    run_extraction,
+)
+import sys
+
+
+print(r""" 
+  _    _       _                     _     ______      _                  _   
+ | |  | |     | |                   | |   |  ____|    | |                | |  
+ | |__| |_   _| |__  ___ _ __   ___ | |_  | |__  __  _| |_ _ __ __ _  ___| |_ 
+ |  __  | | | | '_ \/ __| '_ \ / _ \| __| |  __| \ \/ / __| '__/ _` |/ __| __|
+ | |  | | |_| | |_) \__ \ |_) | (_) | |_  | |____ >  <| |_| | | (_| | (__| |_ 
+ |_|  |_|\__,_|_.__/|___/ .__/ \___/ \__| |______/_/\_\\__|_|  \__,_|\___|\__|
+                        | |                                                   
+                        |_|                                                   
+    """)
+
+print(colored("HubSpot Deal History Extractor - all reports in one pass", "green"))
+print(colored("Par Jean-Baptiste Ronssin - @jbronssin", "blue"))
+print(colored("https://github.com/jbronssin/Hubspot_Extract_Deal_History", "blue"))
+print("###############################################")
+print(colored("You can interupt the script when you want by pressing Ctrl+C", "red"))
+print("###############################################")
+print(colored("This script will create a folder named 'extract' in the same folder as the script", "yellow"))
+print("###############################################")
+
+def main():
+
+    # Folder creation if not exist
+    if not os.path.exists("extract"):
+        os.makedirs("extract")
+
+    load_dotenv()
+    TOKEN = os.environ["HUBSPOT_TOKEN"]
+
+    # Check if the .env file is present and if the API key is set
+    if not TOKEN:
+        print(" ")
+        print(" ")
+        print("###############################################")
+        print(" ")
+        print("¯\_(ツ)_/¯")
+        print(" ")
+        print(colored("It seems you have not set your Hubspot API key in the .env file or the .env file is missing.", "red", attrs=["blink"]))
+        print(colored("Please read the README and follow the process to set up your Hubspot API key.", "blue"))
+        sys.exit(0)
+
+    # The three reports written by hubspot_history.py, hubspot_history_all_pipes.py and hubspot_history_date_pipeline.py
+    report_names = ["deal_stage_history", "deal_stage_changes", "deal_pipeline_history"]
+
+    # Continue an interrupted extraction (--resume) or only extract the deals modified since the previous one (--incremental)
+    checkpoint, state = start_run("combined", report_names)
+    previous_run = checkpoint or state
+
+    api = get_api(TOKEN)
+
+    # Make the user choose a pipeline
+    PIPELINE_ID = choose_pipeline(api, previous_run)
+
+    # Ask the user if he wants to extract all the history or only the oldest date (used by the stage and the pipeline reports)
+    all_dates = choose_all_dates("Do you want to extract the full history of your deals (enter 'all') or exclusively the first oldest date for each stage and pipeline? (press ENTER)", previous_run)
+
+    run_extraction(api, "combined", report_names, PIPELINE_ID, all_dates, checkpoint, state)
+    close_api(api)
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
@@ -0,0 +1,230 @@
+import os
+import re
+import json
+import time
+import threading
+from urllib.parse import urlparse
+
+# Counters of an extraction, filled by api_request() for every HubSpot call and by the scripts for every page written.
+# close_api() saves them as a JSON summary and as a Prometheus textfile (node_exporter --collector.textfile),
+# extract/{script}.metrics.json and extract/{script}.prom, to see where the time of a slow run went.
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")]
+
+
+# Routes of the HubSpot API called by the scripts, {id} stands for any path segment (deal id, pipeline id...)
+ROUTES = [
+    "/crm/v3/objects/deals/search",
+    "/crm/v3/objects/deals/batch/read",
+    "/crm/v3/pipelines/deals",
+    "/crm/v3/pipelines/deals/{id}",
+    "/deals/v1/deal/{id}",
+]
+ROUTE_PATTERNS = [(re.compile("^" + re.escape(route).replace(re.escape("{id}"), "[^/]+") + "$"), route) for route in ROUTES]
+
+
+# "https://api.hubapi.com/deals/v1/deal/123" -> "GET /deals/v1/deal/{id}", so the endpoint labels stay a short list
+def get_endpoint(method, url):
+    path = urlparse(url).path.rstrip("/")
+    for pattern, route in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return f"{method} {route}"
+    # Any other path could hold ids, they are all counted together
+    return f"{method} other"
+
+
+class Metrics:
+
+    def __init__(self, script):
+        self.script = script
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.endpoints = {}
+        self.rate_limit_wait = 0.0
+        self.rate_limit_remaining = None
+        self.daily_remaining = None
+        self.deals_total = None
+        self.deals = 0
+        self.pages = 0
+        self.write_seconds = 0.0
+
+    def get_endpoint_metrics(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                "requests": 0, "statuses": {}, "errors": {}, "retries": 0, "rate_limited": 0, "bytes": 0,
+                "seconds": 0.0, "max_seconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS),
+            }
+        return self.endpoints[endpoint]
+
+    # One answer of HubSpot: seconds until its headers came in, waited before it was sent (rate limiter, free slot)
+    def record_request(self, method, url, response, seconds, waited, retry=False, streamed=False):
+        # A streamed answer has not been read yet, its size is only known from its Content-Length
+        if "Content-Length" in response.headers:
+            size = int(response.headers["Content-Length"])
+        else:
+            size = 0 if streamed else len(response.content)
+        remaining = response.headers.get("X-HubSpot-RateLimit-Remaining", response.headers.get("X-HubSpot-RateLimit-Secondly-Remaining"))
+        daily_remaining = response.headers.get("X-HubSpot-RateLimit-Daily-Remaining")
+
+        with self.lock:
+            metrics = self.get_endpoint_metrics(get_endpoint(method, url))
+            metrics["requests"] += 1
+            status = str(response.status_code)
+            metrics["statuses"][status] = metrics["statuses"].get(status, 0) + 1
+            metrics["retries"] += retry
+            metrics["rate_limited"] += response.status_code == 429
+            metrics["bytes"] += size
+            metrics["seconds"] += seconds
+            metrics["max_seconds"] = max(metrics["max_seconds"], seconds)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metrics["buckets"][index] += 1
+                    break
+            self.rate_limit_wait += waited
+            if remaining is not None:
+                self.rate_limit_remaining = int(remaining)
+            if daily_remaining is not None:
+                self.daily_remaining = int(daily_remaining)
+
+    # A request that got no answer (timeout, lost connection), counted apart under the name of the error: the
+    # requests and the latency histogram only hold the answers
+    def record_error(self, method, url, error, waited, retry=False):
+        with self.lock:
+            metrics = self.get_endpoint_metrics(get_endpoint(method, url))
+            name = type(error).__name__
+            metrics["errors"][name] = metrics["errors"].get(name, 0) + 1
+            metrics["retries"] += retry
+            self.rate_limit_wait += waited
+
+    def set_deals_total(self, total):
+        with self.lock:
+            self.deals_total = total
+
+    def record_page(self, deals, seconds):
+        with self.lock:
+            self.deals += deals
+            self.pages += 1
+            self.write_seconds += seconds
+
+    # "84.2 deals/s, ETA 0:02:15" for the progress lines of the scripts, no ETA when the total is unknown (--resume)
+    def get_progress(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.deals / elapsed if elapsed else 0
+        progress = f"{rate:.1f} deals/s"
+        if self.deals_total is not None and rate:
+            seconds_left = max(0, self.deals_total - self.deals) / rate
+            progress += f", ETA {int(seconds_left // 3600)}:{int(seconds_left % 3600 // 60):02d}:{int(seconds_left % 60):02d}"
+        return progress
+
+    # Latency under which fraction of the requests were answered, interpolated inside its histogram bucket
+    def get_percentile(self, metrics, fraction):
+        rank = metrics["requests"] * fraction
+        count = 0
+        lower = 0.0
+        for bound, bucket in zip(LATENCY_BUCKETS, metrics["buckets"]):
+            if bucket and count + bucket >= rank:
+                upper = min(bound, metrics["max_seconds"])
+                return round(lower + (upper - lower) * (rank - count) / bucket, 4)
+            count += bucket
+            lower = bound
+        return 0.0
+
+    def get_summary(self):
+        with self.lock:
+            seconds = time.perf_counter() - self.started
+            return {
+                "script": self.script,
+                "started_at": self.started_at,
+                "seconds": round(seconds, 3),
+                "deals": {
+                    "processed": self.deals,
+                    "total": self.deals_total,
+                    "per_second": round(self.deals / seconds, 2) if seconds else 0,
+                },
+                "write": {"pages": self.pages, "seconds": round(self.write_seconds, 3)},
+                "rate_limit": {
+                    "wait_seconds": round(self.rate_limit_wait, 3),
+                    "remaining": self.rate_limit_remaining,
+                    "daily_remaining": self.daily_remaining,
+                },
+                "endpoints": {
+                    endpoint: dict(
+                        metrics,
+                        seconds=round(metrics["seconds"], 3),
+                        p50=self.get_percentile(metrics, 0.5),
+                        p95=self.get_percentile(metrics, 0.95),
+                        p99=self.get_percentile(metrics, 0.99),
+                    )
+                    for endpoint, metrics in sorted(self.endpoints.items())
+                },
+            }
+
+    def get_prometheus(self):
+        summary = self.get_summary()
+        script = f'script="{self.script}"'
+        lines = []
+
+        def add(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{','.join([script] + labels)}}} {value}")
+
+        endpoints = summary["endpoints"]
+        add("hubspot_requests_total", "counter", "HubSpot API answers by endpoint and status.", [
+            ([f'endpoint="{endpoint}"', f'status="{status}"'], count)
+            for endpoint, metrics in endpoints.items() for status, count in sorted(metrics["statuses"].items())
+        ])
+        add("hubspot_request_errors_total", "counter", "HubSpot API requests without an answer (timeout, lost connection) by endpoint and error.", [
+            ([f'endpoint="{endpoint}"', f'error="{name}"'], count)
+            for endpoint, metrics in endpoints.items() for name, count in sorted(metrics["errors"].items())
+        ])
+        add("hubspot_retries_total", "counter", "HubSpot API requests sent again.", [([f'endpoint="{endpoint}"'], metrics["retries"]) for endpoint, metrics in endpoints.items()])
+        add("hubspot_rate_limited_total", "counter", "HubSpot API answers with a 429 status.", [([f'endpoint="{endpoint}"'], metrics["rate_limited"]) for endpoint, metrics in endpoints.items()])
+        add("hubspot_response_bytes_total", "counter", "Bytes of the HubSpot API answers.", [([f'endpoint="{endpoint}"'], metrics["bytes"]) for endpoint, metrics in endpoints.items()])
+
+        histogram = []
+        for endpoint, metrics in endpoints.items():
+            count = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, metrics["buckets"]):
+                count += bucket
+                histogram.append(([f'endpoint="{endpoint}"', f'le="{"+Inf" if bound == float("inf") else bound}"'], count))
+        lines.append("# HELP hubspot_request_duration_seconds Seconds until the headers of a HubSpot API answer came in.")
+        lines.append("# TYPE hubspot_request_duration_seconds histogram")
+        for labels, value in histogram:
+            lines.append(f"hubspot_request_duration_seconds_bucket{{{','.join([script] + labels)}}} {value}")
+        for endpoint, metrics in endpoints.items():
+            lines.append(f'hubspot_request_duration_seconds_sum{{{script},endpoint="{endpoint}"}} {metrics["seconds"]}')
+            lines.append(f'hubspot_request_duration_seconds_count{{{script},endpoint="{endpoint}"}} {metrics["requests"]}')
+
+        rate_limit = summary["rate_limit"]
+        add("hubspot_rate_limit_wait_seconds_total", "counter", "Seconds the requests waited before being sent, summed over the workers.", [([], rate_limit["wait_seconds"])])
+        if rate_limit["remaining"] is not None:
+            add("hubspot_rate_limit_remaining", "gauge", "Requests left in the rate limit interval, from the last answer.", [([], rate_limit["remaining"])])
+        if rate_limit["daily_remaining"] is not None:
+            add("hubspot_rate_limit_daily_remaining", "gauge", "Requests left for the day, from the last answer.", [([], rate_limit["daily_remaining"])])
+
+        deals = summary["deals"]
+        add("hubspot_deals_processed_total", "counter", "Deals written by this run.", [([], deals["processed"])])
+        if deals["total"] is not None:
+            add("hubspot_deals", "gauge", "Deals found by the search of this run.", [([], deals["total"])])
+        add("hubspot_deals_per_second", "gauge", "Deals written per second over the whole run.", [([], deals["per_second"])])
+        add("hubspot_write_seconds_total", "counter", "Seconds spent writing the pages of deals.", [([], summary["write"]["seconds"])])
+        add("hubspot_run_seconds", "gauge", "Duration of the run.", [([], summary["seconds"])])
+        add("hubspot_run_started_timestamp_seconds", "gauge", "Start of the run.", [([], round(summary["started_at"], 3))])
+        return "\n".join(lines) + "\n"
+
+    # Both files are replaced at once, the textfile collector never reads half a file
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        json_file = os.path.join(folder, f"{self.script}.metrics.json")
+        prometheus_file = os.path.join(folder, f"{self.script}.prom")
+        with open(f"{json_file}.tmp", mode="w", encoding="utf-8") as file:
+            json.dump(self.get_summary(), file, indent=2)
+        os.replace(f"{json_file}.tmp", json_file)
+        with open(f"{prometheus_file}.tmp", mode="w", encoding="utf-8") as file:
+            file.write(self.get_prometheus())
+        os.replace(f"{prometheus_file}.tmp", prometheus_file)
+        return json_file, prometheus_file
@@ -0,0 +1,452 @@
+import sys
+import json
+import time
+import bisect
+import random
+import argparse
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from termcolor import colored
+
+# Local stand-in for the HubSpot API, serving a synthetic portal to the hubspot_history_*.py scripts:
+#   GET  /crm/v3/pipelines/deals               pipelines with their stages
+#   GET  /crm/v3/pipelines/deals/{id}          one pipeline
+#   POST /crm/v3/objects/deals/search          filters, createdate sort, "after" paging, 10,000 results at most
+#   GET  /deals/v1/deal/{id}                   property versions of every property (includePropertyVersions)
+#   POST /crm/v3/objects/deals/batch/read      propertiesWithHistory of up to 50 deals
+#   GET  /mock/stats                           requests served so far, read by hubspot_benchmark.py
+#   POST /mock/touch/{id}                      moves a deal to its next stage now, to try --incremental and hubspot_webhook.py
+#   POST /mock/delete/{id}                     deletes a deal: its history is gone but the search still finds it for a while
+# Point the scripts at it with HUBSPOT_API_URL=http://127.0.0.1:8765 in the .env file (any HUBSPOT_TOKEN works).
+# Every deal is generated from the seed and its index, so a portal of a million deals costs a few lists of integers.
+
+SEARCH_MAX_RESULTS = 10000
+DEFAULT_STAGES = ["appointmentscheduled", "qualifiedtobuy", "presentationscheduled", "decisionmakerboughtin", "contractsent", "closedwon", "closedlost"]
+BATCH_MAX_INPUTS = 50
+PORTAL_START = 1577836800000  # 2020-01-01
+DAY_MS = 24 * 3600 * 1000
+
+
+def iso(timestamp):
+    date = datetime.fromtimestamp(timestamp / 1000, tz=timezone.utc)
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + f"{timestamp % 1000:03d}Z"
+
+
+class Portal:
+
+    def __init__(self, deals, pipelines, stages, history, extra_properties, seed):
+        self.seed = seed
+        self.history = history
+        self.pipelines = ["default"] + [str(1000 + index) for index in range(1, pipelines)]
+        # The default pipeline has the stage ids of a new portal, the stages of the other ones are numbered
+        self.stages = {}
+        for pipeline_id in self.pipelines:
+            stage_ids = DEFAULT_STAGES[:stages] if pipeline_id == "default" else []
+            self.stages[pipeline_id] = stage_ids + [f"{pipeline_id}{index:02d}" for index in range(len(stage_ids), stages)]
+
+        # One deal created every few minutes, the deals of each pipeline sorted by createdate like the whole portal
+        rng = random.Random(seed)
+        self.createdates = []
+        self.deal_pipelines = []
+        createdate = PORTAL_START
+        for index in range(deals):
+            createdate += rng.randint(1, 600000)
+            self.createdates.append(createdate)
+            self.deal_pipelines.append(rng.randrange(len(self.pipelines)))
+        self.pipeline_deals = {pipeline_id: [] for pipeline_id in self.pipelines}
+        for index, pipeline_code in enumerate(self.deal_pipelines):
+            self.pipeline_deals[self.pipelines[pipeline_code]].append(index)
+        self.pipeline_createdates = {
+            pipeline_id: [self.createdates[index] for index in indexes] for pipeline_id, indexes in self.pipeline_deals.items()
+        }
+        self.lock = threading.Lock()
+        self.touched = {}
+        # Deleted deals, left in the search index like HubSpot does until it is updated
+        self.deleted = set()
+        # hs_lastmodifieddate of each deal, computed the first time a search filters on it
+        self.last_modified = None
+
+        # The other properties of a v1 deal, the same for every deal: they only add weight to the answers
+        self.extra_properties = {}
+        for index in range(extra_properties):
+            name = f"custom_property_{index}"
+            versions = [{"name": name, "value": "x" * 40, "timestamp": PORTAL_START + version, "source": "CRM_UI", "sourceId": None} for version in range(history)]
+            self.extra_properties[name] = {"value": "x" * 40, "timestamp": PORTAL_START, "source": "CRM_UI", "sourceId": None, "versions": versions}
+
+    def deal_index(self, deal_id):
+        index = int(deal_id) - 100000
+        if not 0 <= index < len(self.createdates):
+            return None
+        return index
+
+    # The dealstage and pipeline versions of a deal, newest first like the v1 API
+    def get_versions(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        createdate = self.createdates[index]
+        pipeline_id = self.pipelines[self.deal_pipelines[index]]
+        stage_ids = self.stages[pipeline_id]
+
+        pipeline_versions = [{"name": "pipeline", "value": pipeline_id, "timestamp": createdate, "source": "CRM_UI", "sourceId": "userId:1"}]
+        if len(self.pipelines) > 1 and rng.random() < 0.15:
+            # Moved from another pipeline a few hours after its creation
+            previous_pipeline = self.pipelines[(self.deal_pipelines[index] + 1) % len(self.pipelines)]
+            pipeline_versions[0]["timestamp"] = createdate + rng.randint(1, 48) * 3600000
+            pipeline_versions.append({"name": "pipeline", "value": previous_pipeline, "timestamp": createdate, "source": "CRM_UI", "sourceId": "userId:1"})
+
+        stage_versions = []
+        stage = 0
+        timestamp = createdate
+        for version in range(rng.randint(1, self.history)):
+            if version:
+                stage = max(0, min(len(stage_ids) - 1, stage + rng.choice((-1, 1, 1, 2))))
+                timestamp += rng.randint(3600000, 30 * DAY_MS)
+            stage_versions.append({"name": "dealstage", "value": stage_ids[stage], "timestamp": timestamp, "source": "CRM_UI", "sourceId": "userId:1"})
+        stage_versions.reverse()
+
+        with self.lock:
+            stage_versions = self.touched.get(index, []) + stage_versions
+        return {"dealstage": stage_versions, "pipeline": pipeline_versions}
+
+    def get_properties(self, index, versions):
+        return {
+            "dealname": f"Deal {index}",
+            "pipeline": self.pipelines[self.deal_pipelines[index]],
+            "dealstage": versions["dealstage"][0]["value"],
+            "createdate": iso(self.createdates[index]),
+            "hs_lastmodifieddate": iso(self.get_last_modified(index, versions)),
+        }
+
+    def get_last_modified(self, index, versions):
+        return max(versions["dealstage"][0]["timestamp"], versions["pipeline"][0]["timestamp"]) + 60000
+
+    def touch(self, index):
+        versions = self.get_versions(index)
+        stage_ids = self.stages[self.pipelines[self.deal_pipelines[index]]]
+        next_stage = stage_ids[(stage_ids.index(versions["dealstage"][0]["value"]) + 1) % len(stage_ids)]
+        version = {"name": "dealstage", "value": next_stage, "timestamp": int(time.time() * 1000), "source": "CRM_UI", "sourceId": "userId:1"}
+        with self.lock:
+            self.touched.setdefault(index, []).insert(0, version)
+            if self.last_modified is not None:
+                self.last_modified[index] = version["timestamp"] + 60000
+        return version
+
+    # Indexes of the deals matching the filters of a search, in createdate order
+    def search(self, filters):
+        indexes = range(len(self.createdates))
+        createdates = self.createdates
+        for search_filter in filters:
+            if search_filter["propertyName"] == "pipeline":
+                indexes = self.pipeline_deals.get(search_filter["value"], [])
+                createdates = self.pipeline_createdates.get(search_filter["value"], [])
+
+        start, end = 0, len(indexes)
+        for search_filter in filters:
+            if search_filter["propertyName"] == "createdate":
+                value = int(search_filter["value"])
+                if search_filter["operator"] == "GTE":
+                    start = max(start, bisect.bisect_left(createdates, value))
+                elif search_filter["operator"] == "GT":
+                    start = max(start, bisect.bisect_right(createdates, value))
+                elif search_filter["operator"] == "LT":
+                    end = min(end, bisect.bisect_left(createdates, value))
+                elif search_filter["operator"] == "LTE":
+                    end = min(end, bisect.bisect_right(createdates, value))
+        indexes = indexes[start:end]
+
+        for search_filter in filters:
+            if search_filter["propertyName"] == "hs_lastmodifieddate":
+                value = int(search_filter["value"])
+                last_modified = self.get_all_last_modified()
+                indexes = [index for index in indexes if last_modified[index] > value]
+        return indexes
+
+    def get_all_last_modified(self):
+        if self.last_modified is None:
+            last_modified = [self.get_last_modified(index, self.get_versions(index)) for index in range(len(self.createdates))]
+            with self.lock:
+                if self.last_modified is None:
+                    self.last_modified = last_modified
+        return self.last_modified
+
+
+class RateLimit:
+    # Sliding window of max_requests per interval seconds, max_requests 0 for no limit
+
+    def __init__(self, max_requests, interval, daily):
+        self.max_requests = max_requests
+        self.interval = interval
+        self.daily = daily
+        self.sent = deque()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Remaining requests of the window after this one, None when the limit is reached
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.sent and self.sent[0] <= now - self.interval:
+                self.sent.popleft()
+            if (self.max_requests and len(self.sent) >= self.max_requests) or self.count >= self.daily:
+                return None
+            self.sent.append(now)
+            self.count += 1
+            return self.max_requests - len(self.sent)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, with Nagle each keep-alive answer would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self, name):
+        server = self.server
+        with server.stats_lock:
+            server.stats[name] = server.stats.get(name, 0) + 1
+
+    # Same limits and headers as HubSpot: the search endpoint has its own limit and sends no rate limit headers
+    def rate_limit(self, search):
+        server = self.server
+        if search:
+            if server.search_rate_limit.take() is None:
+                self.count("429")
+                self.send_json({"status": "error", "message": "You have reached your secondly limit.", "category": "RATE_LIMITS"}, 429)
+                return None
+            return {}
+
+        remaining = server.rate_limit.take()
+        if remaining is None:
+            self.count("429")
+            self.send_json({"status": "error", "message": "You have reached your ten_secondly_rolling limit.", "errorType": "RATE_LIMIT", "policyName": "TEN_SECONDLY_ROLLING"}, 429)
+            return None
+        if not server.rate_limit.max_requests:
+            return {}
+        return {
+            "X-HubSpot-RateLimit-Max": server.rate_limit.max_requests,
+            "X-HubSpot-RateLimit-Interval-Milliseconds": int(server.rate_limit.interval * 1000),
+            "X-HubSpot-RateLimit-Remaining": remaining,
+            "X-HubSpot-RateLimit-Daily": server.rate_limit.daily,
+            "X-HubSpot-RateLimit-Daily-Remaining": server.rate_limit.daily - server.rate_limit.count,
+        }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        portal = self.server.portal
+
+        if path == "/mock/stats":
+            with self.server.stats_lock:
+                return self.send_json(dict(self.server.stats))
+
+        self.count("requests")
+        headers = self.rate_limit(search=False)
+        if headers is None:
+            return
+        time.sleep(self.server.latency)
+
+        if path == "/crm/v3/pipelines/deals":
+            self.count("pipelines")
+            return self.send_json({"results": [self.get_pipeline(portal, pipeline_id) for pipeline_id in portal.pipelines]}, headers=headers)
+
+        if path.startswith("/crm/v3/pipelines/deals/"):
+            self.count("pipelines")
+            pipeline_id = path.rsplit("/", 1)[1]
+            if pipeline_id not in portal.stages:
+                return self.send_json({"status": "error", "message": "Pipeline not found", "category": "OBJECT_NOT_FOUND"}, 404, headers)
+            return self.send_json(self.get_pipeline(portal, pipeline_id), headers=headers)
+
+        if path.startswith("/deals/v1/deal/"):
+            self.count("deals_v1")
+            index = portal.deal_index(path.rsplit("/", 1)[1])
+            if index is None or index in portal.deleted:
+                return self.send_json({"status": "error", "message": "Deal does not exist", "category": "OBJECT_NOT_FOUND"}, 404, headers)
+            return self.send_json(self.get_v1_deal(portal, index, parse_qs(url.query)), headers=headers)
+
+        self.send_json({"status": "error", "message": f"Unknown path {path}"}, 404, headers)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        portal = self.server.portal
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        if path.startswith("/mock/touch/"):
+            index = portal.deal_index(path.rsplit("/", 1)[1])
+            if index is None:
+                return self.send_json({"status": "error", "message": "Deal does not exist"}, 404)
+            version = portal.touch(index)
+            return self.send_json({"id": path.rsplit("/", 1)[1], "propertyName": "dealstage", "propertyValue": version["value"], "timestamp": version["timestamp"]})
+
+        if path.startswith("/mock/delete/"):
+            index = portal.deal_index(path.rsplit("/", 1)[1])
+            if index is None:
+                return self.send_json({"status": "error", "message": "Deal does not exist"}, 404)
+            with portal.lock:
+                portal.deleted.add(index)
+            return self.send_json({"id": path.rsplit("/", 1)[1], "deleted": True})
+
+        self.count("requests")
+        search = path == "/crm/v3/objects/deals/search"
+        headers = self.rate_limit(search)
+        if headers is None:
+            return
+        time.sleep(self.server.latency)
+
+        if search:
+            self.count("search")
+            return self.search(portal, body, headers)
+
+        if path == "/crm/v3/objects/deals/batch/read":
+            self.count("batch_read")
+            if len(body.get("inputs", [])) > BATCH_MAX_INPUTS:
+                return self.send_json({"status": "error", "message": f"Batch size over {BATCH_MAX_INPUTS}", "category": "VALIDATION_ERROR"}, 400, headers)
+            return self.send_json(self.get_batch(portal, body), headers=headers)
+
+        self.send_json({"status": "error", "message": f"Unknown path {path}"}, 404, headers)
+
+    def get_pipeline(self, portal, pipeline_id):
+        return {
+            "id": pipeline_id,
+            "label": "Sales Pipeline" if pipeline_id == "default" else f"Pipeline {pipeline_id}",
+            "displayOrder": portal.pipelines.index(pipeline_id),
+            "stages": [
+                {"id": stage_id, "label": f"Stage {stage_id}", "displayOrder": display_order}
+                for display_order, stage_id in enumerate(portal.stages[pipeline_id])
+            ],
+        }
+
+    def get_v1_deal(self, portal, index, query):
+        versions = portal.get_versions(index)
+        # Like HubSpot, the versions of every property or none, whatever the other parameters
+        with_versions = query.get("includePropertyVersions", ["false"])[0] == "true"
+
+        properties = {}
+        for name, value in portal.get_properties(index, versions).items():
+            if name in ("createdate", "hs_lastmodifieddate"):
+                continue
+            history = versions.get(name, [{"name": name, "value": value, "timestamp": portal.createdates[index], "source": "CRM_UI", "sourceId": None}])
+            properties[name] = {"value": value, "timestamp": history[0]["timestamp"], "source": "CRM_UI", "sourceId": None}
+            if with_versions:
+                properties[name]["versions"] = history
+        for name, extra in portal.extra_properties.items():
+            if with_versions:
+                properties[name] = extra
+            else:
+                properties[name] = {key: value for key, value in extra.items() if key != "versions"}
+        return {"portalId": 1, "dealId": 100000 + index, "isDeleted": False, "properties": properties}
+
+    def search(self, portal, body, headers):
+        filters = [search_filter for group in body.get("filterGroups", [])[:1] for search_filter in group.get("filters", [])]
+        indexes = portal.search(filters)
+        if body.get("sort") and body["sort"][0].get("direction") == "DESCENDING":
+            indexes = indexes[::-1]
+
+        after = int(body.get("after") or 0)
+        limit = min(int(body.get("limit", 10)), 200)
+        if after + limit > SEARCH_MAX_RESULTS:
+            return self.send_json({"status": "error", "message": f"Paging past {SEARCH_MAX_RESULTS} results is not supported", "category": "VALIDATION_ERROR"}, 400, headers)
+
+        results = []
+        for index in indexes[after:after + limit]:
+            properties = portal.get_properties(index, portal.get_versions(index))
+            results.append({
+                "id": str(100000 + index),
+                "properties": {name: properties.get(name) for name in body.get("properties", [])},
+                "createdAt": properties["createdate"],
+                "updatedAt": properties["hs_lastmodifieddate"],
+                "archived": False,
+            })
+        data = {"total": len(indexes), "results": results}
+        if after + limit < len(indexes):
+            data["paging"] = {"next": {"after": str(after + limit)}}
+        self.send_json(data, headers=headers)
+
+    def get_batch(self, portal, body):
+        results = []
+        for deal in body.get("inputs", []):
+            index = portal.deal_index(deal["id"])
+            if index is None or index in portal.deleted:
+                continue
+            versions = portal.get_versions(index)
+            properties = portal.get_properties(index, versions)
+            results.append({
+                "id": deal["id"],
+                "properties": {name: properties.get(name) for name in body.get("properties", [])},
+                "propertiesWithHistory": {
+                    name: [{"value": version["value"], "timestamp": iso(version["timestamp"]), "sourceType": version["source"]} for version in versions.get(name, [])]
+                    for name in body.get("propertiesWithHistory", [])
+                },
+                "archived": False,
+            })
+        return {"status": "COMPLETE", "results": results}
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Hundreds of connections can be opened at once by the asyncio engine
+    request_queue_size = 1024
+
+    def __init__(self, address, portal, latency, rate_limit, search_rate_limit):
+        super().__init__(address, MockHandler)
+        self.portal = portal
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.search_rate_limit = search_rate_limit
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+
+def get_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the HubSpot API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--deals", type=int, default=1000, help="number of deals of the portal")
+    parser.add_argument("--pipelines", type=int, default=2)
+    parser.add_argument("--stages", type=int, default=7, help="stages per pipeline")
+    parser.add_argument("--history", type=int, default=5, help="maximum number of dealstage versions per deal")
+    parser.add_argument("--extra-properties", type=int, default=20, help="other properties of each deal, with --history versions each")
+    parser.add_argument("--latency", type=float, default=50, help="milliseconds added to every answer")
+    parser.add_argument("--rate-limit", type=int, default=190, help="requests per --rate-interval, 0 for no limit")
+    parser.add_argument("--rate-interval", type=float, default=10, help="seconds")
+    parser.add_argument("--daily-limit", type=int, default=1000000)
+    parser.add_argument("--search-rate-limit", type=int, default=5, help="search requests per second, 0 for no limit")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(arguments)
+
+
+def main():
+    arguments = get_arguments()
+    portal = Portal(arguments.deals, arguments.pipelines, arguments.stages, arguments.history, arguments.extra_properties, arguments.seed)
+    server = MockServer(
+        ("127.0.0.1", arguments.port),
+        portal,
+        latency=arguments.latency / 1000,
+        rate_limit=RateLimit(arguments.rate_limit, arguments.rate_interval, arguments.daily_limit),
+        search_rate_limit=RateLimit(arguments.search_rate_limit, 1.0, float("inf")),
+    )
+    print(colored(f"Mock HubSpot portal of {arguments.deals} deals on http://127.0.0.1:{arguments.port}", "green"), flush=True)
+    server.serve_forever()
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nMock server stopped.")
+        sys.exit(0)
@@ -0,0 +1,353 @@
+import io
+import os
+import re
+import csv
+import glob
+import gzip
+import time
+from datetime import datetime
+from hubspot_database import DatabaseWriter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Report files of the hubspot_history_*.py scripts: extract/{report_name}_{N}.csv, .csv.gz, .csv.zst or .parquet.
+# Each page of deals is appended to the file being written (extract/..._{N}.csv.part), compressed on its own as
+# a gzip member or a zstd frame. A file is only renamed to its final name once complete, so the other tools never
+# see a partial file, and a resumed extraction cuts the .part file back to the last page saved in its checkpoint.
+# A Parquet file is written as the pages come, by row groups of row_group_size rows, through a ParquetWriter kept
+# open on its .part file. Its footer is only written once complete, so the raw rows of the pages are also appended to
+# a .rows journal: a resumed extraction cuts the journal back to its checkpoint and writes the .part file again from it.
+
+EXTENSIONS = {"none": ".csv", "gzip": ".csv.gz", "zstd": ".csv.zst"}
+
+# Parquet files default to snappy, the usual codec of the warehouses
+PARQUET_CODECS = {"none": "snappy", "gzip": "gzip", "zstd": "zstd"}
+
+# Locks of the reports written by this process, held until it exits
+REPORT_LOCKS = {}
+
+
+def get_report_files(report_name):
+    files = []
+    for file_name in glob.glob(f"extract/{report_name}_*"):
+        match = re.search(r"_(\d+)\.(csv|csv\.gz|csv\.zst|parquet)$", file_name)
+        if match:
+            files.append((int(match.group(1)), file_name))
+    return sorted(files)
+
+
+# Number of the file after the last one of the report, finished or being written
+def get_next_file_number(report_name):
+    numbers = [0]
+    for file_name in glob.glob(f"extract/{report_name}_*"):
+        match = re.search(r"_(\d+)\.(csv|parquet)", file_name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return max(numbers) + 1
+
+
+# A report is written by one process at a time, an extraction script or hubspot_webhook.py: two processes would take
+# the same file numbers and write the same changes. The lock (extract/{report_name}.lock) goes away with the process,
+# even a killed one. Returns the reports another process is writing (none without fcntl, on Windows).
+def lock_reports(report_names):
+    busy_reports = []
+    for report_name in report_names:
+        if fcntl is None or report_name in REPORT_LOCKS:
+            continue
+        file = open(f"extract/{report_name}.lock", mode="a")
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            busy_reports.append(report_name)
+            continue
+        REPORT_LOCKS[report_name] = file
+    return busy_reports
+
+
+def remove_report_files(report_name):
+    for file_name in glob.glob(f"extract/{report_name}_*"):
+        if re.search(r"_\d+\.(csv|parquet)", file_name):
+            os.remove(file_name)
+
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(int(timestamp) // 1000).strftime("%Y-%m-%d %H:%M")
+
+
+def compress(data, compression):
+    if compression == "gzip":
+        return gzip.compress(data, mtime=0)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+# Text rows of a report file, whatever its compression
+def read_report_rows(file_name):
+    if file_name.endswith(".gz"):
+        file = gzip.open(file_name, mode="rt", newline="", encoding="utf-8")
+    elif file_name.endswith(".zst"):
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_name, mode="rb"), read_across_frames=True, closefd=True)
+        file = io.TextIOWrapper(reader, newline="", encoding="utf-8")
+    else:
+        file = open(file_name, newline="", encoding="utf-8")
+    with file:
+        return list(csv.reader(file))
+
+
+def write_report_rows(file_name, rows):
+    text = io.StringIO(newline="")
+    csv.writer(text).writerows(rows)
+    compression = "gzip" if file_name.endswith(".gz") else "zstd" if file_name.endswith(".zst") else "none"
+    with open(f"{file_name}.tmp", mode="wb") as file:
+        file.write(compress(text.getvalue().encode("utf-8"), compression))
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+def get_arrow_schema(header, types):
+    arrow_types = {
+        "int64": pyarrow.int64(),
+        "string": pyarrow.string(),
+        "dictionary": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+        "timestamp": pyarrow.timestamp("ms", tz="UTC"),
+    }
+    return pyarrow.schema([(name, arrow_types[column_type]) for name, column_type in zip(header, types)])
+
+
+def get_arrow_table(rows, schema, types):
+    columns = list(zip(*rows))
+    arrays = []
+    for values, column_type, field in zip(columns, types, schema):
+        if column_type in ("int64", "timestamp"):
+            arrays.append(pyarrow.array([int(value) for value in values], pyarrow.int64()).cast(field.type))
+        elif column_type == "dictionary":
+            arrays.append(pyarrow.array(values, pyarrow.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pyarrow.array(values, pyarrow.string()))
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def remove_deals_from_parquet(file_name, deal_ids):
+    parquet_file = pyarrow.parquet.ParquetFile(file_name)
+    table = parquet_file.read()
+    removed = pyarrow.compute.is_in(table["Deal ID"], value_set=pyarrow.array([int(deal_id) for deal_id in deal_ids], pyarrow.int64()))
+    if not pyarrow.compute.any(removed).as_py():
+        return
+
+    codec = parquet_file.metadata.row_group(0).column(0).compression.lower()
+    pyarrow.parquet.write_table(table.filter(pyarrow.compute.invert(removed)), f"{file_name}.tmp", compression=codec)
+    os.replace(f"{file_name}.tmp", file_name)
+
+
+class ReportWriter:
+    # max_rows, max_bytes and max_seconds: a file is complete once it holds that many rows or bytes, or has been
+    # open for that many seconds, checked after each page. With none of them, every page gets its own file.
+
+    def __init__(self, report_name, header, types, max_rows=0, max_bytes=0, compression="none", output_format="csv", row_group_size=100000, max_seconds=0):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression}, use one of: {', '.join(EXTENSIONS)}")
+        if output_format not in ("csv", "parquet"):
+            raise ValueError(f"Unknown output format {output_format}, use csv, parquet or sqlite")
+        if compression == "zstd" and output_format == "csv" and zstandard is None:
+            raise ImportError("HUBSPOT_OUTPUT_COMPRESSION=zstd needs zstandard, install it with: pip install zstandard")
+        if output_format == "parquet" and pyarrow is None:
+            raise ImportError("HUBSPOT_OUTPUT_FORMAT=parquet needs pyarrow, install it with: pip install pyarrow")
+        self.report_name = report_name
+        self.header = header
+        self.types = types
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compression = compression
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.file_counter = 1
+        self.file = None
+        # Parquet output: the writer of the .part file and the rows of its next row group
+        self.parquet_writer = None
+        self.row_group = []
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.opened_at = 0
+
+    def get_file_name(self):
+        extension = ".parquet" if self.output_format == "parquet" else EXTENSIONS[self.compression]
+        return f"extract/{self.report_name}_{self.file_counter}{extension}"
+
+    # Where the writer stands after the last page, saved in the checkpoints
+    def get_state(self):
+        return {"file_counter": self.file_counter, "part_rows": self.part_rows, "part_bytes": self.part_bytes}
+
+    # The file the pages are appended to: the .part file, or the .rows journal of a Parquet file
+    def get_spool_name(self):
+        return f"{self.get_file_name()}.rows" if self.output_format == "parquet" else f"{self.get_file_name()}.part"
+
+    # Continue from a checkpoint: the pages written after it are cut from the file being written
+    def resume(self, state):
+        self.file_counter = state["file_counter"]
+        file_name = self.get_file_name()
+        if self.output_format == "parquet":
+            self.remove_finished_parts()
+        if not state["part_bytes"]:
+            return
+
+        if self.output_format == "parquet" and os.path.exists(file_name):
+            # The file was completed by a page written after the checkpoint, its journal is still there
+            os.remove(file_name)
+        elif not os.path.exists(f"{file_name}.part") and os.path.exists(file_name):
+            # The file was completed by a page written after the checkpoint
+            os.replace(file_name, f"{file_name}.part")
+        self.file = open(self.get_spool_name(), mode="r+b")
+        self.opened_at = time.time()
+        self.file.truncate(state["part_bytes"])
+        self.file.seek(state["part_bytes"])
+        self.part_rows = state["part_rows"]
+        self.part_bytes = state["part_bytes"]
+
+        if self.output_format == "parquet":
+            # The .part file of the interrupted run has no footer, it is written again from the journal
+            self.open_parquet_writer()
+            with open(self.get_spool_name(), newline="", encoding="utf-8") as journal:
+                for row in csv.reader(journal):
+                    self.add_parquet_rows([row])
+
+    def open_parquet_writer(self):
+        schema = get_arrow_schema(self.header, self.types)
+        self.parquet_writer = pyarrow.parquet.ParquetWriter(f"{self.get_file_name()}.part", schema, compression=PARQUET_CODECS[self.compression])
+        self.row_group = []
+
+    # The rows are converted and written to the .part file one row group at a time
+    def add_parquet_rows(self, rows):
+        self.row_group += rows
+        while len(self.row_group) >= self.row_group_size:
+            self.write_row_group(self.row_group[:self.row_group_size])
+            self.row_group = self.row_group[self.row_group_size:]
+
+    def write_row_group(self, rows):
+        self.parquet_writer.write_table(get_arrow_table(rows, self.parquet_writer.schema, self.types))
+
+    def write_page(self, rows):
+        if self.output_format == "parquet":
+            self.remove_finished_parts()
+
+        text = io.StringIO(newline="")
+        writer = csv.writer(text)
+        if self.file is None:
+            self.file = open(self.get_spool_name(), mode="wb")
+            self.opened_at = time.time()
+            if self.output_format == "csv":
+                writer.writerow(self.header)
+            else:
+                self.open_parquet_writer()
+
+        # The Parquet journal keeps the epoch milliseconds, the CSV files get readable dates
+        if self.output_format == "csv" and "timestamp" in self.types:
+            rows = [
+                [format_timestamp(value) if column_type == "timestamp" else value for value, column_type in zip(row, self.types)]
+                for row in rows
+            ]
+        writer.writerows(rows)
+
+        data = text.getvalue().encode("utf-8")
+        self.file.write(compress(data, self.compression) if self.output_format == "csv" else data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.part_rows += len(rows)
+        self.part_bytes = self.file.tell()
+        if self.output_format == "parquet":
+            # The values as read back from the journal, so a resumed file gets the same rows
+            self.add_parquet_rows([["" if value is None else str(value) for value in row] for row in rows])
+
+        if (not self.max_rows and not self.max_bytes and not self.max_seconds) or (self.max_rows and self.part_rows >= self.max_rows) or (self.max_bytes and self.part_bytes >= self.max_bytes):
+            self.finish_file()
+        else:
+            self.finish_expired()
+
+    # Complete the file being written once it is max_seconds old, also called without new pages by hubspot_webhook.py
+    def finish_expired(self):
+        if self.file is not None and self.max_seconds and time.time() - self.opened_at >= self.max_seconds:
+            self.finish_file()
+
+    def finish_file(self):
+        file_name = self.get_file_name()
+        self.file.close()
+        if self.output_format == "parquet":
+            if self.row_group:
+                self.write_row_group(self.row_group)
+            self.parquet_writer.close()
+            self.parquet_writer = None
+            # The journal is only removed once the checkpoint after this file is saved (next page or close)
+        os.replace(f"{file_name}.part", file_name)
+        print(f"File saved : {file_name}")
+        self.file = None
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.file_counter += 1
+
+    # A page that failed half way (hubspot_webhook.py): back to the state before it, the page is written again later
+    def rollback(self, state):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        self.row_group = []
+        self.part_rows = 0
+        self.part_bytes = 0
+        if not state["part_bytes"]:
+            # The file was started, or started and completed, by the failed page
+            self.file_counter = state["file_counter"]
+            for file_name in (self.get_file_name(), f"{self.get_file_name()}.part", self.get_spool_name()):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+        self.resume(state)
+
+    def remove_finished_parts(self):
+        for file_number, file_name in get_report_files(self.report_name):
+            if file_number < self.file_counter and os.path.exists(f"{file_name}.rows"):
+                os.remove(f"{file_name}.rows")
+
+    def close(self):
+        if self.file is not None:
+            self.finish_file()
+        if self.output_format == "parquet":
+            self.remove_finished_parts()
+
+
+# Output settings of the .env file, shared by all the scripts.
+# append: the pages add rows to the deals instead of replacing their rows (only changes the SQLite output)
+def get_report_writer(report_name, header, types, append=False, max_seconds=0):
+    output_format = os.environ.get("HUBSPOT_OUTPUT_FORMAT", "csv").lower()
+    if output_format == "sqlite":
+        return DatabaseWriter(os.environ.get("HUBSPOT_DATABASE", "extract/history.db"), report_name, header, types, append=append)
+
+    # A Parquet file per page would be tiny, they hold up to a million rows by default
+    default_max_rows = "1000000" if output_format == "parquet" else "0"
+    return ReportWriter(
+        report_name,
+        header,
+        types,
+        max_rows=int(os.environ.get("HUBSPOT_OUTPUT_MAX_ROWS", default_max_rows)),
+        max_bytes=int(float(os.environ.get("HUBSPOT_OUTPUT_MAX_MB", "0")) * 1024 * 1024),
+        compression=os.environ.get("HUBSPOT_OUTPUT_COMPRESSION", "none").lower(),
+        output_format=output_format,
+        row_group_size=int(os.environ.get("HUBSPOT_PARQUET_ROW_GROUP", "100000")),
+        max_seconds=max_seconds,
+    )
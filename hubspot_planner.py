@@ -0,0 +1,311 @@
+import os
+import io
+import csv
+import sys
+import json
+import math
+import random
+import argparse
+from datetime import datetime
+from dotenv import load_dotenv
+from termcolor import colored
+from hubspot_extract import (
+    SEARCH_MAX_RESULTS,
+    SEARCH_PAGE_SIZE,
+    STAGE_HISTORY_HEADER,
+    STAGE_CHANGES_HEADER,
+    PIPELINE_HISTORY_HEADER,
+    get_api,
+    close_api,
+    api_request,
+    choose_pipeline,
+    choose_all_dates,
+    get_all_pipeline_stages,
+    get_deals,
+    get_deal_windows,
+    PROPERTY_HISTORY_PARAMS,
+    parse_property_history,
+    get_batch_read_json,
+    stage_history_rows,
+    stage_changes_rows,
+    pipeline_history_rows,
+)
+from hubspot_metrics import get_endpoint
+from hubspot_output import format_timestamp
+
+
+print(r"""
+  _    _       _                     _     ______      _                  _
+ | |  | |     | |                   | |   |  ____|    | |                | |
+ | |__| |_   _| |__  ___ _ __   ___ | |_  | |__  __  _| |_ _ __ __ _  ___| |_
+ |  __  | | | | '_ \/ __| '_ \ / _ \| __| |  __| \ \/ / __| '__/ _` |/ __| __|
+ | |  | | |_| | |_) \__ \ |_) | (_) | |_  | |____ >  <| |_| | | (_| | (__| |_
+ |_|  |_|\__,_|_.__/|___/ .__/ \___/ \__| |______/_/\_\\__|_|  \__,_|\___|\__|
+                        | |
+                        |_|
+    """)
+
+print(colored("HubSpot Deal History Extractor - cost and duration of an extraction", "green"))
+print(colored("Par Jean-Baptiste Ronssin - @jbronssin", "blue"))
+print(colored("https://github.com/jbronssin/Hubspot_Extract_Deal_History", "blue"))
+print("###############################################")
+print(colored("You can interupt the script when you want by pressing Ctrl+C", "red"))
+print("###############################################")
+
+# Estimates an extraction before running it: the searches of the extraction give the number of deals and their
+# createdate windows, the histories of a random sample of deals are fetched with both engines to measure their size, their versions and the time HubSpot takes
+# to answer. The requests, the daily quota, the megabytes downloaded and written and the duration of the whole
+# extraction are projected from them, for each engine and number of connections (HUBSPOT_CONCURRENCY).
+# The history cache is left aside: a run reusing it costs less.
+
+# Properties fetched and rows written by each script
+REPORTS = {
+    "deal_stage_history": (["dealstage"], STAGE_HISTORY_HEADER),
+    "deal_stage_changes": (["dealstage"], STAGE_CHANGES_HEADER),
+    "deal_pipeline_history": (["pipeline"], PIPELINE_HISTORY_HEADER),
+}
+REPORT_SCRIPTS = {
+    "hubspot_history.py": ["deal_stage_history"],
+    "hubspot_history_all_pipes.py": ["deal_stage_changes"],
+    "hubspot_history_date_pipeline.py": ["deal_pipeline_history"],
+    "hubspot_history_combined.py": ["deal_stage_history", "deal_stage_changes", "deal_pipeline_history"],
+}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Estimates the requests, quota, size and duration of an extraction")
+    parser.add_argument("--script", choices=list(REPORT_SCRIPTS), default="hubspot_history_combined.py", help="extraction to estimate")
+    parser.add_argument("--sample", type=int, default=50, help="deals whose history is fetched to measure it")
+    parser.add_argument("--concurrency", default="1,4,8,16,32,64", help="numbers of connections to compare")
+    parser.add_argument("--since", help="only count the deals modified since this date (YYYY-MM-DD), as --incremental does")
+    parser.add_argument("--save", help="save the estimates to this JSON file")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+# The search requests of an extraction: the counts finding the createdate windows, made by the planner too,
+# then a page per SEARCH_PAGE_SIZE deals with a last page not full in each window
+def estimate_search_requests(total, windows, window_requests):
+    return window_requests + math.ceil(total / SEARCH_PAGE_SIZE) + len(windows)
+
+
+# Deals from every part of the portal, not only the oldest ones the search reaches: the first page of a window
+# gives its number of deals, a second one is read at a random place of it. The deals are then drawn from the
+# windows in proportion to their number of deals.
+def sample_deals(api, pipeline_id, windows, sample, modified_after, rng):
+    pools = []
+    for window in rng.sample(windows, min(len(windows), sample)):
+        page = get_deals(api, pipeline_id, limit=SEARCH_PAGE_SIZE, modified_after=modified_after, window=window)
+        pool = page["results"]
+        reachable = min(page["total"], SEARCH_MAX_RESULTS)
+        if reachable > SEARCH_PAGE_SIZE:
+            after = str(rng.randrange(SEARCH_PAGE_SIZE, reachable))
+            pool += get_deals(api, pipeline_id, after=after, limit=SEARCH_PAGE_SIZE, modified_after=modified_after, window=window)["results"]
+        pools.append((page["total"], pool))
+
+    deals = []
+    while len(deals) < sample and any(pool for total, pool in pools):
+        pools = [(total, pool) for total, pool in pools if pool]
+        total, pool = rng.choices(pools, weights=[total for total, pool in pools])[0]
+        deals.append(pool.pop(rng.randrange(len(pool))))
+    return deals
+
+
+# Requests, bytes and seconds until the headers of the answers of an endpoint, from the metrics of the run
+def get_endpoint_usage(api, method, path):
+    metrics = api["metrics"].get_endpoint_metrics(get_endpoint(method, f"{api['url']}{path}"))
+    requests = max(1, metrics["requests"])
+    return {"requests": metrics["requests"], "bytes": metrics["bytes"] / requests, "seconds": metrics["seconds"] / requests}
+
+
+# The histories come from HubSpot even when they are in the cache, to measure them
+def fetch_sample_histories(api, deals, property_names):
+    # v1: one request per deal, read whole to measure it
+    histories = []
+    for deal in deals:
+        response = api_request(api, "GET", f"{api['url']}/deals/v1/deal/{deal['id']}", params=PROPERTY_HISTORY_PARAMS)
+        histories.append(parse_property_history(response.json(), property_names))
+
+    # v3: the same deals by batches of HUBSPOT_BATCH_SIZE
+    deal_ids = [deal["id"] for deal in deals]
+    for start in range(0, len(deal_ids), api["batch_size"]):
+        api_request(api, "POST", f"{api['url']}/crm/v3/objects/deals/batch/read", json=get_batch_read_json(deal_ids[start:start + api["batch_size"]], property_names))
+    return histories
+
+
+# Bytes and rows written per deal for each report, as CSV
+def measure_output(deals, all_histories, reports, all_dates, stage_dict, pipeline_dict):
+    get_rows = {
+        "deal_stage_history": lambda deal, histories: stage_history_rows(deal, histories["dealstage"], all_dates, stage_dict, pipeline_dict),
+        "deal_stage_changes": lambda deal, histories: stage_changes_rows(deal, histories["dealstage"]),
+        "deal_pipeline_history": lambda deal, histories: pipeline_history_rows(deal, histories["pipeline"], all_dates, pipeline_dict),
+    }
+    output = {}
+    for report_name in reports:
+        header = REPORTS[report_name][1]
+        file = io.StringIO()
+        writer = csv.writer(file)
+        rows = 0
+        for deal, histories in zip(deals, all_histories):
+            for row in get_rows[report_name](deal, histories):
+                if header[-1] == "Timestamp":
+                    row = row[:-1] + [format_timestamp(row[-1])]
+                writer.writerow(row)
+                rows += 1
+        output[report_name] = {"rows_per_deal": rows / len(deals), "bytes_per_deal": len(file.getvalue().encode("utf-8")) / len(deals)}
+    return output
+
+
+def format_duration(seconds):
+    return f"{int(seconds // 3600)}:{int(seconds % 3600 // 60):02d}:{int(seconds % 60):02d}"
+
+
+def format_size(size):
+    return f"{size / 1048576:.1f} MB" if size < 1024 ** 3 else f"{size / 1024 ** 3:.2f} GB"
+
+
+# Duration of the extraction with concurrency connections: the histories go at the pace of the answers or of the
+# rate limit, the search at its own limit of 5 requests per second, both at the same time
+def estimate_duration(api, history_requests, history_seconds, search_requests, search_seconds, concurrency):
+    rate_limiter = api["rate_limiter"]
+    history_rate = concurrency / max(history_seconds, 0.001)
+    rate_limited = False
+    if rate_limiter.max_requests:
+        rate_budget = max(1, int(rate_limiter.max_requests * rate_limiter.safety)) / rate_limiter.interval
+        rate_limited = history_rate > rate_budget
+        history_rate = min(history_rate, rate_budget)
+    search_limiter = api["search_rate_limiter"]
+    search_rate = min(api["search_concurrency"] / max(search_seconds, 0.001), max(1, int(search_limiter.max_requests * search_limiter.safety)) / search_limiter.interval)
+    return max(history_requests / history_rate, search_requests / search_rate), rate_limited
+
+
+def main():
+
+    # Folder creation if not exist
+    if not os.path.exists("extract"):
+        os.makedirs("extract")
+
+    load_dotenv()
+    arguments = get_arguments()
+    TOKEN = os.environ["HUBSPOT_TOKEN"]
+
+    # Check if the .env file is present and if the API key is set
+    if not TOKEN:
+        print(" ")
+        print(" ")
+        print("###############################################")
+        print(" ")
+        print("¯\_(ツ)_/¯")
+        print(" ")
+        print(colored("It seems you have not set your Hubspot API key in the .env file or the .env file is missing.", "red", attrs=["blink"]))
+        print(colored("Please read the README and follow the process to set up your Hubspot API key.", "blue"))
+        sys.exit(0)
+
+    api = get_api(TOKEN)
+    reports = REPORT_SCRIPTS[arguments.script]
+    property_names = sorted({property_name for report_name in reports for property_name in REPORTS[report_name][0]})
+    concurrencies = [int(concurrency) for concurrency in arguments.concurrency.split(",")]
+    modified_after = int(datetime.strptime(arguments.since, "%Y-%m-%d").timestamp() * 1000) if arguments.since else None
+
+    # Make the user choose a pipeline
+    PIPELINE_ID = choose_pipeline(api)
+
+    all_dates = False
+    if reports != ["deal_stage_changes"]:
+        # The number of rows depends on it
+        all_dates = choose_all_dates("Do you want to extract the full history of your deals (enter 'all') or exclusively the first oldest date for each stage and pipeline? (press ENTER)")
+
+    stage_dict, pipeline_dict = get_all_pipeline_stages(api)
+
+    # The same searches as the extraction, for its total and its createdate windows
+    windows = get_deal_windows(api, PIPELINE_ID, modified_after)
+    if not windows:
+        print(colored("No deal to extract.", "yellow"))
+        close_api(api)
+        return
+    total = api["metrics"].deals_total
+    window_requests = get_endpoint_usage(api, "POST", "/crm/v3/objects/deals/search")["requests"]
+
+    print(f"{total} deals to extract in {len(windows)} createdate windows, measuring the histories of {min(arguments.sample, total)} of them...")
+    deals = sample_deals(api, PIPELINE_ID, windows, arguments.sample, modified_after, random.Random(arguments.seed))
+    all_histories = fetch_sample_histories(api, deals, property_names)
+    planner_requests = sum(metrics["requests"] for metrics in api["metrics"].endpoints.values())
+
+    search = get_endpoint_usage(api, "POST", "/crm/v3/objects/deals/search")
+    v1 = get_endpoint_usage(api, "GET", "/deals/v1/deal/0")
+    v3 = get_endpoint_usage(api, "POST", "/crm/v3/objects/deals/batch/read")
+    search_requests = estimate_search_requests(total, windows, window_requests)
+    # The search pages hold all the deals, at the size of the sampled results
+    search_bytes = sum(len(json.dumps(deal)) for deal in deals) / len(deals) * total
+    versions = sum(len(histories[property_name]) for histories in all_histories for property_name in property_names) / len(deals)
+    output = measure_output(deals, all_histories, reports, all_dates, stage_dict, pipeline_dict)
+
+    engines = {
+        "v1": {"history_requests": total, "seconds": v1["seconds"], "bytes": v1["bytes"] * total},
+        "v3": {
+            # The batches are filled across the pages of the scripts
+            "history_requests": math.ceil(total / api["batch_size"]),
+            "seconds": v3["seconds"],
+            "bytes": v3["bytes"] * v3["requests"] / len(deals) * total,
+        },
+    }
+    daily_remaining = api["metrics"].daily_remaining
+
+    print("###############################################")
+    print(f"{total} deals, {versions:.1f} versions of {' and '.join(property_names)} per deal")
+    for report_name, report_output in output.items():
+        print(f"{report_name}: about {report_output['rows_per_deal'] * total:.0f} rows, {format_size(report_output['bytes_per_deal'] * total)} of CSV (less once compressed or in Parquet)")
+    print(f"Search: about {search_requests} requests, {search['seconds'] * 1000:.0f} ms each")
+    print(f"This estimate made {planner_requests} requests ({search['requests']} searches)")
+    if api["rate_limiter"].max_requests:
+        print(f"Rate limit: {api['rate_limiter'].max_requests} requests every {api['rate_limiter'].interval:g} s")
+
+    plan = {
+        "script": arguments.script,
+        "pipeline_id": PIPELINE_ID,
+        "all_dates": all_dates,
+        "modified_after": modified_after,
+        "deals": total,
+        "sample": len(deals),
+        "planner_requests": planner_requests,
+        "versions_per_deal": round(versions, 2),
+        "output": {report_name: {"rows": round(report_output["rows_per_deal"] * total), "bytes": round(report_output["bytes_per_deal"] * total)} for report_name, report_output in output.items()},
+        "daily_remaining": daily_remaining,
+        "engines": {},
+    }
+    for engine, estimate in engines.items():
+        requests = estimate["history_requests"] + search_requests
+        downloaded = estimate["bytes"] + search_bytes
+        print("###############################################")
+        print(colored(f"HUBSPOT_ENGINE={engine}: {requests} requests, {format_size(downloaded)} downloaded, {estimate['seconds'] * 1000:.0f} ms per history request", "green"))
+        if daily_remaining is not None:
+            share = requests / max(daily_remaining, 1)
+            if share <= 1:
+                print(f"  {share:.1%} of the {daily_remaining} requests left for today")
+            else:
+                print(colored(f"  {share:.1f} times the {daily_remaining} requests left for today: the extraction will wait for the next days (HUBSPOT_DAILY_RESERVE)", "red"))
+
+        durations = {}
+        for concurrency in concurrencies:
+            seconds, rate_limited = estimate_duration(api, estimate["history_requests"], estimate["seconds"], search_requests, search["seconds"], concurrency)
+            durations[concurrency] = round(seconds)
+            print(f"  HUBSPOT_CONCURRENCY={concurrency}: {format_duration(seconds)}" + (" (held by the rate limit, more connections will not help)" if rate_limited else ""))
+        plan["engines"][engine] = {"requests": requests, "bytes": round(downloaded), "seconds": durations}
+
+    if arguments.save:
+        with open(arguments.save, mode="w", encoding="utf-8") as file:
+            json.dump(plan, file, indent=2)
+        print(f"File saved : {arguments.save}")
+
+    close_api(api)
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import argparse
+import subprocess
+from dotenv import load_dotenv
+from termcolor import colored
+from hubspot_extract import (
+    SEARCH_MAX_RESULTS,
+    get_api,
+    close_api,
+    choose_pipeline,
+    choose_all_dates,
+    get_all_pipeline_stages,
+    get_deal_windows,
+    iter_deal_pages,
+    iter_page_histories,
+    clear_checkpoint,
+    DeadLetter,
+    save_state,
+    get_reports,
+)
+from hubspot_output import get_report_writer, remove_report_files, lock_reports
+from hubspot_shards import ShardQueue
+
+
+print(r"""
+  _    _       _                     _     ______      _                  _
+ | |  | |     | |                   | |   |  ____|    | |                | |
+ | |__| |_   _| |__  ___ _ __   ___ | |_  | |__  __  _| |_ _ __ __ _  ___| |_
+ |  __  | | | | '_ \/ __| '_ \ / _ \| __| |  __| \ \/ / __| '__/ _` |/ __| __|
+ | |  | | |_| | |_) \__ \ |_) | (_) | |_  | |____ >  <| |_| | | (_| | (__| |_
+ |_|  |_|\__,_|_.__/|___/ .__/ \___/ \__| |______/_/\_\\__|_|  \__,_|\___|\__|
+                        | |
+                        |_|
+    """)
+
+print(colored("HubSpot Deal History Extractor - sharded extraction with several workers", "green"))
+print(colored("Par Jean-Baptiste Ronssin - @jbronssin", "blue"))
+print(colored("https://github.com/jbronssin/Hubspot_Extract_Deal_History", "blue"))
+print("###############################################")
+print(colored("You can interupt the script when you want by pressing Ctrl+C", "red"))
+print("###############################################")
+print(colored("This script will create a folder named 'extract' in the same folder as the script", "yellow"))
+print("###############################################")
+
+# The same extraction as hubspot_history_combined.py, split over several processes and hosts:
+#   plan    splits the deals into shards (createdate windows of HUBSPOT_SHARD_DEALS deals) in extract/shards.db
+#   work    claims shards until none is left and writes each one to extract/shards/shard_N.jsonl
+#   merge   writes the shards in their order to the usual report files, the same ones as hubspot_history_combined.py
+#   status  shows the shards and their workers, retry gives the failed shards another chance
+#   run     plan, work with --processes workers on this host, then merge
+# The workers of other hosts run "python3 hubspot_sharded.py work" in the same folder, on a shared filesystem.
+
+QUEUE_PATH = "extract/shards.db"
+SHARDS_FOLDER = "extract/shards"
+
+# Deals per page of the reports, as in hubspot_history_combined.py
+PAGE_SIZE = 20
+
+
+def get_shard_path(shard):
+    return os.path.join(SHARDS_FOLDER, f"shard_{shard:05d}.jsonl")
+
+
+def plan(api, queue):
+    # Make the user choose a pipeline
+    PIPELINE_ID = choose_pipeline(api)
+
+    # Ask the user if he wants to extract all the history or only the oldest date (used by the stage and the pipeline reports)
+    all_dates = choose_all_dates("Do you want to extract the full history of your deals (enter 'all') or exclusively the first oldest date for each stage and pipeline? (press ENTER)")
+
+    # Number of deals per shard (HUBSPOT_SHARD_DEALS in the .env file)
+    shard_deals = min(int(os.environ.get("HUBSPOT_SHARD_DEALS", "5000")), SEARCH_MAX_RESULTS)
+    started_at = int(time.time() * 1000)
+    windows = get_deal_windows(api, PIPELINE_ID, max_deals=shard_deals)
+
+    # The shards of the previous sharded extraction
+    shutil.rmtree(SHARDS_FOLDER, ignore_errors=True)
+    queue.create({"pipeline_id": PIPELINE_ID, "all_dates": all_dates, "started_at": started_at}, windows)
+    print(colored(f"{api['metrics'].deals_total} deals split into {len(windows)} shards of at most {shard_deals} deals.", "green"))
+
+
+# Extracts a shard to its file, returns its number of deals or None if another worker claimed it in the meantime
+def extract_shard(api, queue, worker, shard, window, job, reports, lease_seconds):
+    shard_path = get_shard_path(shard)
+    part_path = f"{shard_path}.{worker}.part"
+    dead_letter = DeadLetter(f"shards/shard_{shard:05d}")
+    dead_letter.clear()
+    deals_processed = 0
+    try:
+        with open(part_path, mode="w", encoding="utf-8") as file:
+            # The last shard has no end: it also gets the deals created since the plan
+            pages = iter_deal_pages(api, job["pipeline_id"], [window], limit=PAGE_SIZE)
+            for deals, all_histories, cursor in iter_page_histories(api, pages, ["dealstage", "pipeline"], dead_letter=dead_letter):
+                started = time.perf_counter()
+                # One line per deal: its id and its rows for each report
+                for deal, histories in zip(deals, all_histories):
+                    file.write(json.dumps([deal["id"], [get_rows(deal, histories) for report_name, header, types, get_rows in reports]]) + "\n")
+                api["metrics"].record_page(len(deals), time.perf_counter() - started)
+                deals_processed += len(deals)
+
+                if not queue.renew(shard, worker, lease_seconds):
+                    return None
+            file.flush()
+            os.fsync(file.fileno())
+        # The shard file only appears complete, a killed worker leaves its .part file behind
+        os.replace(part_path, shard_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return deals_processed
+
+
+def work(api, queue):
+    job = queue.get_job()
+    if not job:
+        print(colored("No sharded extraction is planned, start one with python3 hubspot_sharded.py plan", "red"))
+        return
+
+    # Each worker saves its own metrics
+    worker = f"{socket.gethostname()}-{os.getpid()}"
+    api["metrics"].script = f"hubspot_sharded_{worker}"
+    # Seconds a shard stays with a worker that stopped renewing it (HUBSPOT_SHARD_LEASE in the .env file)
+    lease_seconds = int(os.environ.get("HUBSPOT_SHARD_LEASE", "300"))
+    os.makedirs(SHARDS_FOLDER, exist_ok=True)
+
+    stage_dict, pipeline_dict = get_all_pipeline_stages(api)
+    reports = get_reports(job["all_dates"], stage_dict, pipeline_dict)
+
+    while True:
+        claimed = queue.claim(worker, lease_seconds)
+        if claimed is None:
+            counts = queue.get_counts()
+            if "pending" not in counts and "leased" not in counts:
+                break
+            # The other shards are with other workers, one of them may stop before finishing its shard
+            time.sleep(min(10, lease_seconds / 4))
+            continue
+
+        shard, window = claimed
+        print(f"Worker {worker}: extracting shard {shard}...")
+        started = time.perf_counter()
+        try:
+            deals_processed = extract_shard(api, queue, worker, shard, window, job, reports, lease_seconds)
+        except BaseException as error:
+            queue.release(shard, worker, f"{type(error).__name__}: {error}")
+            if not isinstance(error, Exception):
+                raise
+            print(colored(f"Shard {shard} failed ({type(error).__name__}: {error}), it goes back to the queue.", "red"))
+            continue
+
+        if deals_processed is None:
+            print(colored(f"Shard {shard} was given to another worker, its lease expired.", "yellow"))
+        elif queue.complete(shard, worker, deals_processed):
+            counts = queue.get_counts()
+            print(f"Shard {shard} done: {deals_processed} deals in {time.perf_counter() - started:.1f} s, {counts.get('done', (0, 0))[0]}/{sum(count[0] for count in counts.values())} shards done ({api['metrics'].get_progress()})")
+
+    print(colored(f"Worker {worker}: no shard left.", "green"))
+
+
+# Starts processes workers on this host and waits for them. They share the connections and the search limit of
+# the portal, with the workers of the other hosts if HUBSPOT_PROCESSES counts them.
+def start_workers(processes):
+    environment = dict(os.environ, HUBSPOT_PROCESSES=str(max(processes, int(os.environ.get("HUBSPOT_PROCESSES", "1")))))
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "work"], env=environment) for _ in range(processes)]
+    try:
+        for process in workers:
+            process.wait()
+    except KeyboardInterrupt:
+        # The workers got the Ctrl+C too, their shards go back to the queue
+        for process in workers:
+            process.wait()
+        raise
+
+
+def merge(queue):
+    job = queue.get_job()
+    shards = queue.get_shards()
+    not_done = [shard for shard, status, worker, attempts, deals, error in shards if status != "done"]
+    if not job or not shards or not_done:
+        print(colored(f"{len(shards) - len(not_done)}/{len(shards)} shards are done, the merge needs all of them (python3 hubspot_sharded.py status).", "red"))
+        return
+
+    # Only the names, headers and types of the reports are needed, the rows are in the shard files
+    reports = get_reports(job["all_dates"], {}, {})
+    busy_reports = lock_reports([report_name for report_name, header, types, get_rows in reports])
+    if busy_reports:
+        print(colored(f"{', '.join(busy_reports)} is being written by hubspot_webhook.py or another extraction, stop it first: the receiver continues where it stopped once restarted.", "red"))
+        return
+    for report_name, header, types, get_rows in reports:
+        remove_report_files(report_name)
+    clear_checkpoint("combined")
+    report_writers = {report_name: get_report_writer(report_name, header, types) for report_name, header, types, get_rows in reports}
+
+    def save_page(page):
+        for index, (report_name, header, types, get_rows) in enumerate(reports):
+            report_writers[report_name].write_page([row for deal_id, deal_rows in page for row in deal_rows[index]])
+
+    # The shards in their createdate order, by pages of PAGE_SIZE deals: the files do not depend on the workers
+    total_deals_processed = 0
+    page = []
+    for shard, status, worker, attempts, deals, error in shards:
+        with open(get_shard_path(shard), encoding="utf-8") as file:
+            for line in file:
+                page.append(json.loads(line))
+                if len(page) == PAGE_SIZE:
+                    save_page(page)
+                    total_deals_processed += len(page)
+                    page = []
+    if page:
+        save_page(page)
+        total_deals_processed += len(page)
+
+    for report_writer in report_writers.values():
+        report_writer.close()
+
+    # The deals the workers could not extract are retried by python3 hubspot_history_combined.py --incremental
+    dead_letter = DeadLetter("combined")
+    dead_letter.deals = {}
+    for dead_letter_path in sorted(glob.glob(os.path.join(SHARDS_FOLDER, "*.dead_letter.json"))):
+        with open(dead_letter_path, encoding="utf-8") as file:
+            dead_letter.deals.update(json.load(file))
+    dead_letter.save()
+
+    # hubspot_history_combined.py --incremental continues after this extraction
+    save_state("combined", {
+        "pipeline_id": job["pipeline_id"],
+        "all_dates": job["all_dates"],
+        "last_modified": job["started_at"],
+        "file_counters": {report_name: report_writer.file_counter for report_name, report_writer in report_writers.items()},
+    })
+    print(colored(f"{total_deals_processed} deals of {len(shards)} shards merged.", "green"))
+    if dead_letter.deals:
+        print(colored(f"{len(dead_letter.deals)} deals could not be extracted, they are listed in {dead_letter.path} and will be retried by python3 hubspot_history_combined.py --incremental.", "red"))
+
+
+def show_status(queue):
+    job = queue.get_job()
+    if not job:
+        print(colored("No sharded extraction is planned.", "yellow"))
+        return
+    for shard, status, worker, attempts, deals, error in queue.get_shards():
+        color = {"done": "green", "leased": "yellow", "failed": "red"}.get(status)
+        line = f"Shard {shard}: {status}" + (f" ({worker})" if status == "leased" else "") + (f", {deals} deals" if deals is not None else "") + (f", {attempts} attempts" if attempts > 1 else "")
+        print(colored(line, color) if color else line)
+        if error and status != "done":
+            print(colored(f"    {error}", "red"))
+    counts = queue.get_counts()
+    print(", ".join(f"{shards} {status}" for status, (shards, deals) in sorted(counts.items())) + f", {sum(deals for shards, deals in counts.values())} deals extracted")
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Extracts the deal histories with several worker processes")
+    parser.add_argument("command", choices=["plan", "work", "merge", "status", "retry", "run"])
+    parser.add_argument("--processes", type=int, default=1, help="worker processes started on this host by work and run")
+    return parser.parse_args()
+
+
+def main():
+
+    # Folder creation if not exist
+    if not os.path.exists("extract"):
+        os.makedirs("extract")
+
+    load_dotenv()
+    arguments = get_arguments()
+    queue = ShardQueue(QUEUE_PATH)
+
+    if arguments.command == "status":
+        show_status(queue)
+        return
+    if arguments.command == "retry":
+        print(f"{queue.retry_failed()} failed shards are back in the queue.")
+        return
+    if arguments.command == "merge":
+        merge(queue)
+        return
+    if arguments.command == "work" and arguments.processes > 1:
+        start_workers(arguments.processes)
+        return
+
+    TOKEN = os.environ["HUBSPOT_TOKEN"]
+
+    # Check if the .env file is present and if the API key is set
+    if not TOKEN:
+        print(" ")
+        print(" ")
+        print("###############################################")
+        print(" ")
+        print("¯\_(ツ)_/¯")
+        print(" ")
+        print(colored("It seems you have not set your Hubspot API key in the .env file or the .env file is missing.", "red", attrs=["blink"]))
+        print(colored("Please read the README and follow the process to set up your Hubspot API key.", "blue"))
+        sys.exit(0)
+
+    api = get_api(TOKEN)
+    if arguments.command == "work":
+        work(api, queue)
+        close_api(api)
+        return
+
+    plan(api, queue)
+    close_api(api)
+    if arguments.command == "run":
+        start_workers(arguments.processes)
+        merge(queue)
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import sqlite3
+
+# Work queue of hubspot_sharded.py (extract/shards.db): the deals to extract are split into shards, createdate
+# windows of at most HUBSPOT_SHARD_DEALS deals, claimed by the worker processes of one or several hosts.
+# A worker holds a lease on its shard and renews it after each page. The shard of a worker that stopped
+# answering is claimed again by another worker once its lease expires.
+# The database uses the default rollback journal: WAL needs memory shared by the processes, the workers of other
+# hosts reach it through the shared filesystem. The leases compare the clocks of the hosts, keep them in sync.
+
+# A shard that failed that many times is left aside until "python3 hubspot_sharded.py retry"
+MAX_ATTEMPTS = 3
+
+
+class ShardQueue:
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Autocommit, the claims open their own transaction. A worker waits for the lock of another one.
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS shards ("
+            "shard INTEGER PRIMARY KEY, window_start INTEGER, window_end INTEGER, status TEXT, worker TEXT, "
+            "lease_until REAL, attempts INTEGER, deals INTEGER, error TEXT)"
+        )
+
+    # A new extraction: job holds its settings, windows its shards in createdate order
+    def create(self, job, windows):
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.execute("DELETE FROM job")
+        self.connection.execute("DELETE FROM shards")
+        self.connection.executemany("INSERT INTO job VALUES (?, ?)", [(key, json.dumps(value)) for key, value in job.items()])
+        self.connection.executemany(
+            "INSERT INTO shards VALUES (?, ?, ?, 'pending', NULL, 0, 0, NULL, NULL)",
+            [(shard, window[0], window[1]) for shard, window in enumerate(windows, start=1)],
+        )
+        self.connection.execute("COMMIT")
+
+    def get_job(self):
+        return {key: json.loads(value) for key, value in self.connection.execute("SELECT key, value FROM job")}
+
+    # The first shard waiting for a worker, or whose lease expired: (shard, window), None if there is none
+    def claim(self, worker, lease_seconds):
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT shard, window_start, window_end FROM shards "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) ORDER BY shard LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row:
+                self.connection.execute(
+                    "UPDATE shards SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE shard = ?",
+                    (worker, now + lease_seconds, row[0]),
+                )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return (row[0], [row[1], row[2]]) if row else None
+
+    # False once the shard was claimed again by another worker, which then owns it
+    def renew(self, shard, worker, lease_seconds):
+        cursor = self.connection.execute(
+            "UPDATE shards SET lease_until = ? WHERE shard = ? AND worker = ? AND status = 'leased'",
+            (time.time() + lease_seconds, shard, worker),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, shard, worker, deals):
+        cursor = self.connection.execute(
+            "UPDATE shards SET status = 'done', lease_until = 0, deals = ?, error = NULL WHERE shard = ? AND worker = ? AND status = 'leased'",
+            (deals, shard, worker),
+        )
+        return cursor.rowcount == 1
+
+    def release(self, shard, worker, error):
+        self.connection.execute(
+            "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL, lease_until = 0, error = ? "
+            "WHERE shard = ? AND worker = ? AND status = 'leased'",
+            (MAX_ATTEMPTS, error, shard, worker),
+        )
+
+    def retry_failed(self):
+        return self.connection.execute("UPDATE shards SET status = 'pending', attempts = 0 WHERE status = 'failed'").rowcount
+
+    # {status: (shards, deals)}
+    def get_counts(self):
+        return {
+            status: (shards, deals or 0)
+            for status, shards, deals in self.connection.execute("SELECT status, COUNT(*), SUM(deals) FROM shards GROUP BY status")
+        }
+
+    def get_shards(self):
+        return self.connection.execute("SELECT shard, status, worker, attempts, deals, error FROM shards ORDER BY shard").fetchall()
+
+    def close(self):
+        self.connection.close()
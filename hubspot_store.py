@@ -0,0 +1,117 @@
+import os
+import json
+import mmap
+import time
+import array
+import bisect
+
+# Columnar copy of the history cache, rebuilt by hubspot_analytics.py when the cache got new histories since.
+# One row per version, sorted by deal, property and date, in one binary file per column:
+#   deal_id.bin    int64  deal id
+#   property.bin   int8   index in meta.json "properties"
+#   value.bin      int32  index in values.json, the stage and pipeline ids are interned
+#   timestamp.bin  int64  epoch milliseconds
+# The files are memory-mapped when opened, so a multi-million-row history opens instantly
+# (numpy.frombuffer() reads the columns without a copy, see hubspot_analytics.py).
+
+COLUMNS = [("deal_id", "q"), ("property", "b"), ("value", "i"), ("timestamp", "q")]
+
+# Rows kept in memory before they are appended to the column files
+CHUNK_ROWS = 65536
+
+
+# entries: (deal_id, {property_name: versions}) for every deal in the order of the deal ids, like HistoryCache.iter_all().
+# The rows are written as they come, by chunks, the store never has to fit in memory. account: the portal of the entries.
+def write_history_store(path, entries, property_names, account):
+    os.makedirs(path, exist_ok=True)
+    # Cache entries added while the store is written are newer than it
+    built_at = time.time()
+    columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+    files = {name: open(os.path.join(path, f"{name}.bin.tmp"), mode="wb") for name, typecode in COLUMNS}
+    value_codes = {}
+    rows = 0
+
+    try:
+        for deal_id, histories in entries:
+            for property_code, property_name in enumerate(property_names):
+                versions = [version for version in histories.get(property_name, []) if "value" in version]
+                for version in sorted(versions, key=lambda version: int(version["timestamp"])):
+                    columns["deal_id"].append(int(deal_id))
+                    columns["property"].append(property_code)
+                    columns["value"].append(value_codes.setdefault(version["value"], len(value_codes)))
+                    columns["timestamp"].append(int(version["timestamp"]))
+            if len(columns["deal_id"]) >= CHUNK_ROWS:
+                rows += write_chunk(columns, files)
+        rows += write_chunk(columns, files)
+    finally:
+        for file in files.values():
+            file.close()
+
+    # meta.json is replaced last: until then, readers still open the previous store
+    with open(os.path.join(path, "values.json.tmp"), mode="w", encoding="utf-8") as file:
+        json.dump(list(value_codes), file)
+    for name, typecode in COLUMNS:
+        os.replace(os.path.join(path, f"{name}.bin.tmp"), os.path.join(path, f"{name}.bin"))
+    os.replace(os.path.join(path, "values.json.tmp"), os.path.join(path, "values.json"))
+
+    meta = {"rows": rows, "properties": list(property_names), "built_at": built_at, "account": account}
+    with open(os.path.join(path, "meta.json.tmp"), mode="w", encoding="utf-8") as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(path, "meta.json.tmp"), os.path.join(path, "meta.json"))
+    return meta["rows"]
+
+
+def write_chunk(columns, files):
+    rows = len(columns["deal_id"])
+    for name, typecode in COLUMNS:
+        columns[name].tofile(files[name])
+        del columns[name][:]
+    return rows
+
+
+# meta.json of the store, None when it was never built
+def read_store_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+class HistoryStore:
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        with open(os.path.join(path, "values.json"), encoding="utf-8") as file:
+            self.values = json.load(file)
+        self.rows = meta["rows"]
+        self.properties = meta["properties"]
+
+        # One read-only memoryview per column, backed by the mapped file
+        self.maps = []
+        for name, typecode in COLUMNS:
+            column = memoryview(array.array(typecode))
+            if self.rows:
+                with open(os.path.join(path, f"{name}.bin"), mode="rb") as file:
+                    file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps.append(file_map)
+                column = memoryview(file_map).cast(typecode)[:self.rows]
+            setattr(self, name, column)
+
+    # Versions of a deal in the format of get_property_history(), found by binary search on the deal_id column
+    def get_versions(self, deal_id, property_name):
+        property_code = self.properties.index(property_name)
+        start = bisect.bisect_left(self.deal_id, int(deal_id))
+        end = bisect.bisect_right(self.deal_id, int(deal_id), start)
+        return [
+            {"value": self.values[self.value[row]], "timestamp": self.timestamp[row]}
+            for row in range(end - 1, start - 1, -1)
+            if self.property[row] == property_code
+        ]
+
+    def close(self):
+        for name, typecode in COLUMNS:
+            getattr(self, name).release()
+        for file_map in self.maps:
+            file_map.close()
@@ -0,0 +1,378 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from dotenv import load_dotenv
+from termcolor import colored
+from hubspot_extract import (
+    STAGE_HISTORY_HEADER,
+    STAGE_HISTORY_TYPES,
+    PIPELINE_HISTORY_HEADER,
+    PIPELINE_HISTORY_TYPES,
+    get_api,
+    close_api,
+    get_pipeline_index,
+    get_all_pipeline_stages,
+    get_deals_by_id,
+    fetch_property_histories,
+    get_deal_windows,
+    iter_deal_pages,
+    iter_page_histories,
+    stage_history_rows,
+    pipeline_history_rows,
+    load_state,
+)
+from hubspot_events import WEBHOOK_PROPERTIES, CHANGE_TOLERANCE, EventJournal, verify_signature, get_changes
+from hubspot_output import get_report_writer, get_next_file_number, lock_reports
+import sys
+
+
+print(r"""
+  _    _       _                     _     ______      _                  _
+ | |  | |     | |                   | |   |  ____|    | |                | |
+ | |__| |_   _| |__  ___ _ __   ___ | |_  | |__  __  _| |_ _ __ __ _  ___| |_
+ |  __  | | | | '_ \/ __| '_ \ / _ \| __| |  __| \ \/ / __| '__/ _` |/ __| __|
+ | |  | | |_| | |_) \__ \ |_) | (_) | |_  | |____ >  <| |_| | | (_| | (__| |_
+ |_|  |_|\__,_|_.__/|___/ .__/ \___/ \__| |______/_/\_\\__|_|  \__,_|\___|\__|
+                        | |
+                        |_|
+    """)
+
+print(colored("HubSpot Deal History Live Capture", "green"))
+print(colored("Par Jean-Baptiste Ronssin - @jbronssin", "blue"))
+print(colored("https://github.com/jbronssin/Hubspot_Extract_Deal_History", "blue"))
+print("###############################################")
+print(colored("You can stop the receiver when you want by pressing Ctrl+C, the changes received are kept", "red"))
+print("###############################################")
+
+# The receiver appends the dealstage and pipeline changes sent by the HubSpot webhooks to the reports of the
+# extraction scripts, one row per change like an extraction with all the dates. The changes are saved in
+# extract/webhook_events.db before HubSpot gets its answer, then written by pages every HUBSPOT_WEBHOOK_FLUSH seconds.
+# A reconciliation crawl searches the deals modified since its last run and adds the versions no webhook brought.
+
+REPORTS = [
+    ("deal_stage_history", STAGE_HISTORY_HEADER, STAGE_HISTORY_TYPES),
+    ("deal_pipeline_history", PIPELINE_HISTORY_HEADER, PIPELINE_HISTORY_TYPES),
+]
+
+# Changes written per page of the reports
+WRITE_BATCH = 500
+
+# The reconciliation leaves the last minutes to the webhooks still on their way, and searches a little before
+# its previous run as hs_lastmodifieddate is set shortly after the change (milliseconds)
+RECONCILE_DELAY = 5 * 60 * 1000
+RECONCILE_MARGIN = 10 * 60 * 1000
+
+# HubSpot delivers a webhook again for a day at most, the written changes are kept 3 days to spot the duplicates
+KEEP_WRITTEN = 3 * 24 * 3600 * 1000
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # HubSpot waits a few seconds for the answer: the changes are only saved in the journal here
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_status(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/webhook":
+            return self.send_status(404)
+
+        # HubSpot signs the target URL of the app, behind a proxy it is not the address of this server
+        if server.public_url:
+            uri = server.public_url + (f"?{url.query}" if url.query else "")
+        else:
+            uri = f"http://{self.headers.get('Host', '')}{self.path}"
+        if not verify_signature(server.secret, "POST", uri, body, self.headers):
+            server.count("refused")
+            print(colored(f"Webhook refused, its signature does not match HUBSPOT_WEBHOOK_SECRET for {uri}", "red"))
+            return self.send_status(401)
+
+        try:
+            changes = get_changes(json.loads(body))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.send_status(400)
+
+        # An error answer makes HubSpot deliver the webhook again later
+        try:
+            added = server.journal.add(changes, "webhook")
+        except sqlite3.Error as error:
+            print(colored(f"Webhook not saved ({error}), HubSpot will deliver it again.", "red"))
+            return self.send_status(500)
+        server.count("received", len(changes))
+        server.count("duplicates", len(changes) - added)
+        self.send_status(200)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, journal, secret, public_url):
+        super().__init__(address, WebhookHandler)
+        self.journal = journal
+        self.secret = secret
+        self.public_url = public_url
+        self.stats = {"received": 0, "duplicates": 0, "refused": 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, name, number=1):
+        with self.stats_lock:
+            self.stats[name] += number
+
+
+# The writers continue the files they were writing when the receiver stopped, else start after the last file
+# of each report. The files are completed every HUBSPOT_WEBHOOK_ROTATE minutes.
+def get_report_writers(journal, rotate_seconds):
+    writers = {}
+    for report_name, header, types in REPORTS:
+        report_writer = get_report_writer(report_name, header, types, append=True, max_seconds=rotate_seconds)
+        state = journal.get_meta(f"writer:{report_name}")
+        try:
+            if state and state["part_bytes"]:
+                report_writer.resume(state)
+            else:
+                report_writer.file_counter = max(state["file_counter"] if state else 1, get_next_file_number(report_name))
+        except FileNotFoundError:
+            # A full extraction removed the report files meanwhile
+            report_writer.file_counter = get_next_file_number(report_name)
+        writers[report_name] = report_writer
+    return writers
+
+
+# The last extraction of each report wrote the whole history of its deals until it started: the changes received
+# before are already in the files. {report_name: (started_at, pipeline_id, all_dates)}, from the states of the
+# extraction scripts. The changes are written with the dates of the extraction: all of them, or the first ones.
+def get_extractions():
+    extractions = {}
+    for report_name, header, types in REPORTS:
+        states = [state for state in (load_state(report_name), load_state("combined")) if state]
+        if states:
+            state = max(states, key=lambda state: state["last_modified"])
+            extractions[report_name] = (state["last_modified"], state["pipeline_id"], state["all_dates"] is not False)
+    return extractions
+
+
+def get_writer_states(writers):
+    return {report_name: report_writer.get_state() for report_name, report_writer in writers.items()}
+
+
+def get_report_name(property_name):
+    return "deal_stage_history" if property_name == "dealstage" else "deal_pipeline_history"
+
+
+# With the first dates, a change is only written if the deal never had that stage (or any pipeline) before it.
+# The histories are read from HubSpot, not from the cache: hs_lastmodifieddate may not be updated yet.
+def is_first_date(histories, property_name, value, occurred_at):
+    return not any(
+        version["timestamp"] < occurred_at - CHANGE_TOLERANCE and (property_name == "pipeline" or version["value"] == value)
+        for version in histories.get(property_name, [])
+    )
+
+
+# Append the oldest changes not written yet to the reports, returns the number of changes handled
+def write_changes(api, journal, writers, pipeline_id, extractions):
+    events = journal.get_pending(WRITE_BATCH)
+    if not events:
+        return 0
+
+    # The webhooks only carry ids: the deal names and current pipelines come from a batch read
+    deals = get_deals_by_id(api, list(dict.fromkeys(event[1] for event in events)), ["dealname", "pipeline"])
+    stage_dict, pipeline_dict = get_all_pipeline_stages(api)
+    if any(value not in (stage_dict if property_name == "dealstage" else pipeline_dict) for rowid, deal_id, property_name, value, occurred_at in events):
+        # A stage or a pipeline created since the pipelines were downloaded
+        get_pipeline_index(api, refresh=True)
+        stage_dict, pipeline_dict = get_all_pipeline_stages(api)
+    stages = get_pipeline_index(api)["stages"]
+    pipeline_names = dict({event[3]: event[3] for event in events if event[2] == "pipeline"}, **pipeline_dict)
+
+    # The histories of the deals changed in a first dates report, a deal that cannot be read gets its change written
+    first_date_deals = list(dict.fromkeys(
+        event[1] for event in events if not extractions.get(get_report_name(event[2]), (0, None, True))[2]
+    ))
+    all_histories = fetch_property_histories(api, [{"id": deal_id} for deal_id in first_date_deals], WEBHOOK_PROPERTIES) if first_date_deals else []
+    histories_by_deal = {deal_id: histories for deal_id, histories in zip(first_date_deals, all_histories) if not isinstance(histories, Exception)}
+
+    pages = {report_name: ([], []) for report_name in writers}
+    for rowid, deal_id, property_name, value, occurred_at in events:
+        report_name = get_report_name(property_name)
+        rows, rowids = pages[report_name]
+        rowids.append(rowid)
+        # A deleted deal has no name anymore, its stage gives its pipeline
+        deal = deals.get(deal_id) or {
+            "id": deal_id,
+            "properties": {"dealname": "", "pipeline": stages.get(value, ("",))[0] if property_name == "dealstage" else value},
+        }
+        if pipeline_id and deal["properties"]["pipeline"] != pipeline_id:
+            continue
+        extracted_until, extracted_pipeline, all_dates = extractions.get(report_name, (0, None, True))
+        if occurred_at < extracted_until and extracted_pipeline in (None, deal["properties"]["pipeline"]):
+            continue
+        if not all_dates and not is_first_date(histories_by_deal.get(deal_id, {}), property_name, value, occurred_at):
+            continue
+        versions = [{"value": value, "timestamp": occurred_at}]
+        if property_name == "dealstage":
+            rows.extend(stage_history_rows(deal, versions, all_dates, stage_dict, pipeline_dict))
+        else:
+            rows.extend(pipeline_history_rows(deal, versions, all_dates, pipeline_names))
+
+    # Each report is committed with its own changes: a report that fails is cut back to its previous page and tried
+    # again, without writing the page of the other report twice
+    for report_name, (rows, rowids) in pages.items():
+        report_writer = writers[report_name]
+        state = report_writer.get_state()
+        try:
+            if rows:
+                report_writer.write_page(rows)
+            journal.commit_written(rowids, {report_name: report_writer.get_state()})
+        except Exception:
+            report_writer.rollback(state)
+            raise
+    return len(events)
+
+
+def run_writer(api, journal, writers, pipeline_id, flush_seconds, server, stopped):
+    # No extraction runs next to the receiver (lock_reports), they are read once
+    extractions = get_extractions()
+    while True:
+        stopping = stopped.wait(flush_seconds)
+        try:
+            written = 0
+            while True:
+                count = write_changes(api, journal, writers, pipeline_id, extractions)
+                written += count
+                if count < WRITE_BATCH:
+                    break
+
+            # A file open for HUBSPOT_WEBHOOK_ROTATE minutes is completed even without new changes
+            for report_writer in writers.values():
+                report_writer.finish_expired()
+            journal.commit_written([], get_writer_states(writers))
+
+            if written:
+                with server.stats_lock:
+                    stats = dict(server.stats)
+                print(f"{written} changes written ({stats['received']} received, {stats['duplicates']} duplicates, {stats['refused']} refused since the start)")
+        except Exception as error:
+            print(colored(f"The changes could not be written ({error}), trying again in {flush_seconds:g} seconds.", "red"))
+        if stopping:
+            return
+
+
+# Search the deals modified since the last reconciliation and add the dealstage and pipeline versions no webhook brought
+def reconcile(api, journal, pipeline_id, stopped):
+    reconciled_until = journal.get_meta("reconciled_until")
+    until = int(time.time() * 1000) - RECONCILE_DELAY
+    if until <= reconciled_until:
+        return 0
+
+    modified_after = reconciled_until - RECONCILE_MARGIN
+    windows = get_deal_windows(api, pipeline_id, modified_after)
+    pages = iter_deal_pages(api, pipeline_id, windows, limit=100, modified_after=modified_after)
+    added = 0
+    for deals, all_histories, cursor in iter_page_histories(api, pages, WEBHOOK_PROPERTIES):
+        changes = [
+            (deal["id"], property_name, version["value"], int(version["timestamp"]), "")
+            for deal, histories in zip(deals, all_histories)
+            for property_name in WEBHOOK_PROPERTIES
+            for version in histories[property_name]
+            if "value" in version and reconciled_until <= int(version["timestamp"]) < until
+        ]
+        added += journal.add(changes, "reconciliation")
+        # Stopped in the middle: the next run starts the same crawl again
+        if stopped.is_set():
+            return added
+
+    journal.set_meta("reconciled_until", until)
+    return added
+
+
+def run_reconciler(api, journal, pipeline_id, reconcile_seconds, stopped):
+    while True:
+        try:
+            added = reconcile(api, journal, pipeline_id, stopped)
+            journal.prune(int(time.time() * 1000) - KEEP_WRITTEN)
+            print(colored(f"Reconciliation done, {added} changes were missing from the webhooks.", "yellow" if added else "green"))
+        except Exception as error:
+            print(colored(f"The reconciliation failed ({error}), trying again in {reconcile_seconds / 60:g} minutes.", "red"))
+        if stopped.wait(reconcile_seconds):
+            return
+
+
+def main():
+
+    # Folder creation if not exist
+    if not os.path.exists("extract"):
+        os.makedirs("extract")
+
+    load_dotenv()
+    TOKEN = os.environ["HUBSPOT_TOKEN"]
+
+    # Client secret of the HubSpot app sending the webhooks, it signs every request
+    SECRET = os.environ.get("HUBSPOT_WEBHOOK_SECRET")
+    if not SECRET:
+        print(colored("Set HUBSPOT_WEBHOOK_SECRET in the .env file to the client secret of your HubSpot app.", "red"))
+        sys.exit(0)
+
+    port = int(os.environ.get("HUBSPOT_WEBHOOK_PORT", "8080"))
+    pipeline_id = os.environ.get("HUBSPOT_WEBHOOK_PIPELINE", "all")
+    pipeline_id = None if pipeline_id.lower() == "all" else pipeline_id
+    flush_seconds = float(os.environ.get("HUBSPOT_WEBHOOK_FLUSH", "10"))
+    rotate_seconds = float(os.environ.get("HUBSPOT_WEBHOOK_ROTATE", "60")) * 60
+    reconcile_seconds = float(os.environ.get("HUBSPOT_WEBHOOK_RECONCILE", "60")) * 60
+
+    # An extraction writing the same reports would take the same file numbers
+    busy_reports = lock_reports([report_name for report_name, header, types in REPORTS])
+    if busy_reports:
+        print(colored(f"An extraction is writing {', '.join(busy_reports)}, start the receiver once it is done.", "red"))
+        sys.exit(1)
+
+    api = get_api(TOKEN)
+    journal = EventJournal("extract/webhook_events.db")
+    if journal.get_meta("reconciled_until") is None:
+        # The changes before the first start are in the reports of the extraction scripts
+        journal.set_meta("reconciled_until", int(time.time() * 1000))
+    writers = get_report_writers(journal, rotate_seconds)
+
+    server = WebhookServer(("0.0.0.0", port), journal, SECRET, os.environ.get("HUBSPOT_WEBHOOK_URL"))
+    stopped = threading.Event()
+    threads = [threading.Thread(target=run_writer, args=(api, journal, writers, pipeline_id, flush_seconds, server, stopped))]
+    if reconcile_seconds:
+        threads.append(threading.Thread(target=run_reconciler, args=(api, journal, pipeline_id, reconcile_seconds, stopped)))
+    for thread in threads:
+        thread.start()
+
+    print(colored(f"Waiting for the HubSpot webhooks on http://0.0.0.0:{port}/webhook...", "green"))
+    try:
+        server.serve_forever()
+    finally:
+        # Write what was received, then complete the files being written
+        server.server_close()
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        for report_writer in writers.values():
+            report_writer.close()
+        journal.commit_written([], get_writer_states(writers))
+        journal.close()
+        close_api(api)
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
+
+print("This is it! Well done!")
@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import urllib.error
+import urllib.request
+from dotenv import load_dotenv
+from termcolor import colored
+from hubspot_events import get_signature
+
+# Sends signed deal.propertyChange webhooks to hubspot_webhook.py, the way HubSpot delivers them:
+#   --events FILE         replays the events of a file (a JSON list, for example saved by --save)
+#   --mock URL --changes  moves random deals of the hubspot_mock.py portal to their next stage and sends their events
+# --duplicates delivers some batches twice and --shuffle mixes their order, the receiver has to write each change once.
+# --drop never sends some events, the next reconciliation of the receiver has to find them in the mock portal.
+# The requests are signed with HUBSPOT_WEBHOOK_SECRET of the .env file (X-HubSpot-Signature-v3).
+
+
+def post_json(url, data, headers=None):
+    body = json.dumps(data).encode("utf-8")
+    request = urllib.request.Request(url, data=body, method="POST", headers=dict({"Content-Type": "application/json"}, **(headers or {})))
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+# Moves random deals of the mock portal to their next stage, returns the webhook events of these changes
+def get_mock_events(mock_url, changes, rng):
+    total = post_json(f"{mock_url}/crm/v3/objects/deals/search", {"limit": 1})["total"]
+    events = []
+    for _ in range(changes):
+        # The mock numbers its deals from 100000
+        deal_id = 100000 + rng.randrange(total)
+        change = post_json(f"{mock_url}/mock/touch/{deal_id}", {})
+        events.append({
+            "eventId": rng.randrange(10 ** 9),
+            "subscriptionId": 1,
+            "portalId": 1,
+            "appId": 1,
+            "occurredAt": change["timestamp"],
+            "subscriptionType": "deal.propertyChange",
+            "attemptNumber": 0,
+            "objectId": deal_id,
+            "propertyName": change["propertyName"],
+            "propertyValue": change["propertyValue"],
+            "changeSource": "CRM_UI",
+            "sourceId": "userId:1",
+        })
+    return events
+
+
+def send_batch(url, secret, events):
+    body = json.dumps(events).encode("utf-8")
+    timestamp = str(int(time.time() * 1000))
+    headers = {
+        "Content-Type": "application/json",
+        "X-HubSpot-Signature-v3": get_signature(secret, "POST", url, body, timestamp),
+        "X-HubSpot-Request-Timestamp": timestamp,
+    }
+    request = urllib.request.Request(url, data=body, method="POST", headers=headers)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description="Sends signed HubSpot webhooks to hubspot_webhook.py")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook", help="webhook URL of the receiver")
+    parser.add_argument("--events", help="JSON file of the webhook events to send")
+    parser.add_argument("--mock", help="URL of a hubspot_mock.py portal to change deals in, for example http://127.0.0.1:8765")
+    parser.add_argument("--changes", type=int, default=100, help="deals moved to their next stage with --mock")
+    parser.add_argument("--batch-size", type=int, default=100, help="events per request, HubSpot sends at most 100")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="fraction of the batches delivered twice")
+    parser.add_argument("--drop", type=float, default=0, help="fraction of the events never delivered")
+    parser.add_argument("--shuffle", action="store_true", help="deliver the batches in a random order")
+    parser.add_argument("--save", help="save the events to this JSON file before sending them")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    load_dotenv()
+    arguments = get_arguments()
+    secret = os.environ.get("HUBSPOT_WEBHOOK_SECRET")
+    if not secret:
+        print(colored("Set HUBSPOT_WEBHOOK_SECRET in the .env file, the receiver checks the signatures with it.", "red"))
+        sys.exit(0)
+    if not arguments.events and not arguments.mock:
+        print(colored("Give the events to send with --events FILE or --mock URL.", "red"))
+        sys.exit(0)
+
+    rng = random.Random(arguments.seed)
+    if arguments.events:
+        with open(arguments.events, encoding="utf-8") as file:
+            events = json.load(file)
+    else:
+        events = get_mock_events(arguments.mock, arguments.changes, rng)
+    if arguments.save:
+        with open(arguments.save, mode="w", encoding="utf-8") as file:
+            json.dump(events, file)
+        print(f"File saved : {arguments.save}")
+
+    delivered = [rng.random() >= arguments.drop for event in events]
+    sent = [event for event, is_delivered in zip(events, delivered) if is_delivered]
+    dropped = len(events) - len(sent)
+    batches = [sent[start:start + arguments.batch_size] for start in range(0, len(sent), arguments.batch_size)]
+    # A batch delivered again is the same events with the next attempt number
+    batches += [[dict(event, attemptNumber=event["attemptNumber"] + 1) for event in batch] for batch in batches if rng.random() < arguments.duplicates]
+    if arguments.shuffle:
+        rng.shuffle(batches)
+
+    statuses = {}
+    for batch in batches:
+        status = send_batch(arguments.url, secret, batch)
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print(f"{len(sent)} events sent in {len(batches)} requests, answers: {', '.join(f'{count} x {status}' for status, count in sorted(statuses.items()))}")
+    if dropped:
+        print(colored(f"{dropped} events were not sent, the next reconciliation of the receiver should add them.", "yellow"))
+
+pass
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nYou chose to interrupt the script. Good bye!")
+        sys.exit(0)
@@ -0,0 +1,141 @@
+import os
+import re
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+import urllib.request
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from hubspot_mock import Portal, RateLimit, MockServer
+from hubspot_output import read_report_rows
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# The tests run the scripts against hubspot_mock.py, started in the test process on a free port:
+#   pip install pytest
+#   python -m pytest
+
+
+def start_mock(deals=60, rate_limit=0, rate_interval=1.0, search_rate_limit=0, latency=0):
+    portal = Portal(deals, pipelines=2, stages=7, history=5, extra_properties=2, seed=1)
+    server = MockServer(
+        ("127.0.0.1", 0),
+        portal,
+        latency=latency / 1000,
+        rate_limit=RateLimit(rate_limit, rate_interval, 1000000),
+        search_rate_limit=RateLimit(search_rate_limit, 1.0, float("inf")),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+# The same mock in its own process, for the tests measuring time
+def start_mock_process(*arguments):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    command = [sys.executable, os.path.join(ROOT, "hubspot_mock.py"), "--port", str(port), "--deals", "60", "--latency", "0", "--search-rate-limit", "0", *arguments]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    process.url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"{process.url}/mock/stats").close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("hubspot_mock.py did not start")
+
+
+@pytest.fixture
+def mock():
+    server = start_mock()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def mock_post(server, path):
+    request = urllib.request.Request(f"{server.url}{path}", data=b"", method="POST")
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def get_environment(server, **options):
+    environment = dict(os.environ)
+    environment.update({
+        "HUBSPOT_API_URL": server.url,
+        "HUBSPOT_TOKEN": "test",
+        "HUBSPOT_PIPELINE": "all",
+        "HUBSPOT_DATES": "all",
+        "HUBSPOT_CACHE": "off",
+        "HUBSPOT_METRICS": "off",
+        "PYTHONUNBUFFERED": "1",
+    })
+    environment.update(options)
+    return environment
+
+
+# Runs a script in folder (its extract folder goes there), returns its output
+def run_script(server, folder, script, *arguments, **options):
+    command = [sys.executable, os.path.join(ROOT, script), *arguments]
+    result = subprocess.run(command, cwd=folder, env=get_environment(server, **options), stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result.stdout
+
+
+# Runs a script stopped by a Ctrl+C while it commits its checkpoint number checkpoint: the deal ids of that page
+# are saved, its json file is not (the previous checkpoint is kept)
+INTERRUPT = """
+import sys, runpy, hubspot_extract
+checkpoint = int(sys.argv.pop(1))
+save_json = hubspot_extract.save_json
+saved = []
+
+def interrupt(path, data):
+    if path.endswith(".checkpoint.json"):
+        saved.append(path)
+        if len(saved) == checkpoint:
+            raise KeyboardInterrupt
+    save_json(path, data)
+
+hubspot_extract.save_json = interrupt
+sys.argv.pop(0)
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def run_script_interrupted(server, folder, script, checkpoint, *arguments, **options):
+    command = [sys.executable, "-c", INTERRUPT, str(checkpoint), os.path.join(ROOT, script), *arguments]
+    environment = get_environment(server, PYTHONPATH=ROOT, **options)
+    result = subprocess.run(command, cwd=folder, env=environment, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "You chose to interrupt the script" in result.stdout, result.stdout + result.stderr
+    return result.stdout
+
+
+# Rows of all the files of a report (.csv, .csv.gz, .csv.zst or .parquet), in the order of the files, without their headers
+def read_report(folder, report_name):
+    extract = os.path.join(folder, "extract")
+    files = []
+    for name in os.listdir(extract):
+        match = re.fullmatch(rf"{report_name}_(\d+)\.(csv|csv\.gz|csv\.zst|parquet)", name)
+        if match:
+            files.append((int(match.group(1)), os.path.join(extract, name)))
+    rows = []
+    for file_number, file_name in sorted(files):
+        if file_name.endswith(".parquet"):
+            rows += [[str(value) for value in row.values()] for row in pyarrow.parquet.read_table(file_name).to_pylist()]
+        else:
+            rows += read_report_rows(file_name)[1:]
+    return rows
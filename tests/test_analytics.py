@@ -0,0 +1,31 @@
+import os
+import csv
+import pytest
+from conftest import run_script
+
+np = pytest.importorskip("numpy")
+
+from hubspot_analytics import group_stats
+
+
+# Percentiles interpolated between the two closest values, like numpy.percentile
+def test_group_stats_on_a_known_array():
+    groups = np.array([2, 0, 0, 2, 0, 0], dtype=np.int32)
+    values = np.array([20.0, 4.0, 1.0, 10.0, 3.0, 2.0])
+    counts, means, percentiles = group_stats(groups, values, 3)
+    assert counts.tolist() == [4, 0, 2]
+    assert means[0] == 2.5 and np.isnan(means[1]) and means[2] == 15
+    assert percentiles[0].tolist() == pytest.approx([1.75, 2.5, 3.25, 3.7])
+    assert np.isnan(percentiles[1]).all()
+    assert percentiles[2].tolist() == pytest.approx([12.5, 15, 17.5, 19])
+
+
+# The analytics read the cache and the pipelines saved by the extraction, without the token nor the network
+def test_analytics_run_offline(mock, tmp_path):
+    run_script(mock, tmp_path, "hubspot_history_combined.py", HUBSPOT_CACHE="extract/history_cache.db")
+    run_script(mock, tmp_path, "hubspot_analytics.py", HUBSPOT_CACHE="extract/history_cache.db", HUBSPOT_TOKEN="", HUBSPOT_API_URL="http://127.0.0.1:9")
+
+    with open(os.path.join(tmp_path, "extract", "analytics_time_in_stage.csv"), encoding="utf-8", newline="") as file:
+        rows = list(csv.reader(file))[1:]
+    assert rows
+    assert all(row[0] != "Unknown pipeline" and row[1].startswith("Stage ") for row in rows)
@@ -0,0 +1,28 @@
+from hubspot_batch import load_portals, check_pipeline
+
+
+def get_manifest(**portal):
+    return {"portals": [{"name": "acme", "token_env": "HUBSPOT_TOKEN_ACME"}, dict({"name": "globex", "token_env": "HUBSPOT_TOKEN_GLOBEX"}, **portal)]}
+
+
+# The bad values are reported with the name of their portal before any portal starts
+def test_manifest_errors_name_their_portal(monkeypatch, capsys):
+    monkeypatch.setenv("HUBSPOT_TOKEN_ACME", "acme")
+    monkeypatch.setenv("HUBSPOT_TOKEN_GLOBEX", "globex")
+    assert load_portals(get_manifest(pipeline="default", dates="all", concurrency="8"), None)[1]["pipeline"] == "default"
+    assert load_portals(get_manifest(pipeline=2), None)[1]["pipeline"] == "2"
+
+    assert load_portals(get_manifest(pipeline=["default"], dates="last", concurrency="many"), None) is None
+    errors = capsys.readouterr().out
+    assert 'globex: pipeline must be "all", a pipeline id or the number of the pipeline, not ["default"]' in errors
+    assert 'globex: dates must be "all" or "first", not "last"' in errors
+    assert 'globex: concurrency must be a number of connections, not "many"' in errors
+    assert "acme" not in errors
+
+
+def test_pipeline_must_be_one_of_the_portal(mock):
+    portal = {"name": "globex", "token": "globex", "pipeline": "all", "env": {"HUBSPOT_API_URL": mock.url}}
+    for pipeline in ("all", "default", "1001", "2"):
+        assert check_pipeline(dict(portal, pipeline=pipeline)) is None
+    assert check_pipeline(dict(portal, pipeline="sales")) == "globex: the pipeline sales is not one of its pipelines (default, 1001) nor their number (1 to 2)"
+    assert check_pipeline(dict(portal, pipeline="3")).startswith("globex: the pipeline 3 ")
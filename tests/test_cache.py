@@ -0,0 +1,39 @@
+import sqlite3
+from hubspot_cache import HistoryCache
+
+KEY = ("100001", "2024-01-01T00:00:00.000Z")
+HISTORIES = {"dealstage": [{"value": "closedwon", "timestamp": 1700000000000}], "pipeline": []}
+
+
+def open_cache(path, account):
+    return HistoryCache(str(path), account, max_bytes=1024 * 1024, max_age=3600)
+
+
+# The same deal id in two portals is two deals
+def test_cache_keeps_the_deals_of_each_account(tmp_path):
+    portal = open_cache(tmp_path / "cache.db", "portal-a")
+    other_portal = open_cache(tmp_path / "cache.db", "portal-b")
+    portal.set_many([(KEY, HISTORIES)])
+
+    assert other_portal.get_many([KEY]) == {}
+    assert list(other_portal.iter_all()) == []
+    assert other_portal.get_last_fetched() == 0
+    assert portal.get_many([KEY]) == {KEY: HISTORIES}
+    assert list(portal.iter_all()) == [("100001", HISTORIES)]
+    portal.close()
+    other_portal.close()
+
+
+# A cache without the accounts may hold the deals of another portal, it starts again empty
+def test_cache_without_accounts_is_dropped(tmp_path):
+    connection = sqlite3.connect(tmp_path / "cache.db")
+    connection.execute("CREATE TABLE history (deal_id TEXT PRIMARY KEY, last_modified TEXT, fetched_at REAL, accessed_at REAL, size INTEGER, data BLOB)")
+    connection.execute("INSERT INTO history VALUES ('100001', '2024-01-01T00:00:00.000Z', 0, 0, 0, x'')")
+    connection.commit()
+    connection.close()
+
+    cache = open_cache(tmp_path / "cache.db", "portal-a")
+    assert cache.get_many([KEY]) == {}
+    cache.set_many([(KEY, HISTORIES)])
+    assert cache.get_many([KEY]) == {KEY: HISTORIES}
+    cache.close()
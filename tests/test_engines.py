@@ -0,0 +1,69 @@
+import requests
+import pytest
+from conftest import run_script, read_report, mock_post
+from hubspot_extract import get_api, close_api, get_deals, get_property_histories
+
+REPORTS = ["deal_stage_history", "deal_stage_changes", "deal_pipeline_history"]
+
+
+def test_v1_and_v3_write_the_same_reports(mock, tmp_path):
+    for engine in ("v1", "v3"):
+        (tmp_path / engine).mkdir()
+        # Batches of 7 deals span the pages of 20 deals of the script
+        run_script(mock, tmp_path / engine, "hubspot_history_combined.py", HUBSPOT_ENGINE=engine, HUBSPOT_BATCH_SIZE="7")
+
+    for report_name in REPORTS:
+        v1_rows = read_report(tmp_path / "v1", report_name)
+        assert v1_rows
+        assert read_report(tmp_path / "v3", report_name) == v1_rows
+
+
+# The asyncio engine (HUBSPOT_ASYNC=on) writes the reports of the threads
+@pytest.mark.parametrize("engine", ["v1", "v3"])
+@pytest.mark.parametrize("dates", ["all", "first"])
+def test_async_and_threads_write_the_same_reports(mock, tmp_path, engine, dates):
+    pytest.importorskip("aiohttp")
+    for use_async in ("off", "on"):
+        (tmp_path / use_async).mkdir()
+        run_script(mock, tmp_path / use_async, "hubspot_history_combined.py", HUBSPOT_ENGINE=engine, HUBSPOT_DATES=dates, HUBSPOT_ASYNC=use_async, HUBSPOT_BATCH_SIZE="7")
+
+    for report_name in REPORTS:
+        rows = read_report(tmp_path / "off", report_name)
+        assert rows
+        assert read_report(tmp_path / "on", report_name) == rows
+
+
+@pytest.mark.parametrize("engine", ["v1", "v3"])
+def test_deleted_deal_is_a_not_found_error(mock, tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HUBSPOT_API_URL", mock.url)
+    monkeypatch.setenv("HUBSPOT_CACHE", "off")
+    monkeypatch.setenv("HUBSPOT_METRICS", "off")
+    monkeypatch.setenv("HUBSPOT_ENGINE", engine)
+    mock_post(mock, "/mock/delete/100003")
+
+    api = get_api("test")
+    deals = get_deals(api, None, limit=10)["results"]
+    histories = get_property_histories(api, deals, ["dealstage"])
+    close_api(api)
+
+    assert len(histories) == len(deals)
+    for deal, deal_histories in zip(deals, histories):
+        if deal["id"] == "100003":
+            assert isinstance(deal_histories, requests.HTTPError)
+            assert deal_histories.response.status_code == 404
+        else:
+            assert deal_histories["dealstage"]
+
+
+def test_deleted_deal_is_skipped_by_both_engines(mock, tmp_path):
+    mock_post(mock, "/mock/delete/100003")
+    for engine in ("v1", "v3"):
+        (tmp_path / engine).mkdir()
+        output = run_script(mock, tmp_path / engine, "hubspot_history_combined.py", HUBSPOT_ENGINE=engine, HUBSPOT_MAX_RETRIES="0")
+        assert "The deal 100003 no longer exists in HubSpot, it is skipped." in output
+
+    for report_name in REPORTS:
+        v1_rows = read_report(tmp_path / "v1", report_name)
+        assert "100003" not in [row[0] for row in v1_rows]
+        assert read_report(tmp_path / "v3", report_name) == v1_rows
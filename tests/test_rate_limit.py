@@ -0,0 +1,74 @@
+import time
+import json
+import urllib.request
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.structures import CaseInsensitiveDict
+from conftest import start_mock_process
+from hubspot_extract import RateLimiter, get_api, close_api, api_request
+
+
+def get_response(status_code=200, **headers):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    return response
+
+
+def test_limits_come_from_the_rate_limit_headers():
+    rate_limiter = RateLimiter()
+    rate_limiter.update(get_response(**{"X-HubSpot-RateLimit-Max": "10", "X-HubSpot-RateLimit-Interval-Milliseconds": "2000", "X-HubSpot-RateLimit-Remaining": "7"}))
+    assert rate_limiter.max_requests == 10
+    assert rate_limiter.interval == 2.0
+
+    rate_limiter.update(get_response(**{"X-HubSpot-RateLimit-Secondly": "4", "X-HubSpot-RateLimit-Secondly-Remaining": "3"}))
+    assert rate_limiter.max_requests == 4
+    assert rate_limiter.interval == 1.0
+
+
+def test_requests_stay_under_the_limit():
+    rate_limiter = RateLimiter(max_requests=10, interval=1.0)
+    for _ in range(9):
+        assert rate_limiter.reserve() == 0
+    # 90% of the limit is used, the next request waits for the oldest one to leave the interval
+    assert 0 < rate_limiter.reserve() <= 1.0
+
+
+def test_429_pauses_for_its_retry_after():
+    rate_limiter = RateLimiter(max_requests=10, interval=1.0)
+    rate_limiter.update(get_response(429, **{"Retry-After": "2"}))
+    assert 1.5 < rate_limiter.reserve() <= 2.0
+
+
+def test_no_remaining_request_pauses_for_the_interval():
+    rate_limiter = RateLimiter()
+    rate_limiter.update(get_response(**{"X-HubSpot-RateLimit-Max": "10", "X-HubSpot-RateLimit-Interval-Milliseconds": "1000", "X-HubSpot-RateLimit-Remaining": "0"}))
+    assert 0.5 < rate_limiter.reserve() <= 1.0
+
+
+# The mock answers 429 past 10 requests per second: the requests are paced by its headers and all of them succeed.
+# It runs in its own process here, so its clock is not held by the threads of the test.
+def test_calls_are_paced_by_the_portal_limits(tmp_path, monkeypatch):
+    server = start_mock_process("--rate-limit", "10", "--rate-interval", "1")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HUBSPOT_API_URL", server.url)
+    monkeypatch.setenv("HUBSPOT_CACHE", "off")
+    monkeypatch.setenv("HUBSPOT_METRICS", "off")
+    api = get_api("test")
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(lambda deal_id: api_request(api, "GET", f"{server.url}/deals/v1/deal/{deal_id}"), range(100000, 100036)))
+        seconds = time.perf_counter() - started
+        with urllib.request.urlopen(f"{server.url}/mock/stats") as answer:
+            stats = json.load(answer)
+    finally:
+        close_api(api)
+        server.terminate()
+        server.wait()
+
+    assert all(response.status_code == 200 for response in responses)
+    # 36 requests at 9 per second
+    assert seconds > 2.5
+    # The 8 first requests, sent before the limits were known, stay under them too
+    assert stats.get("429", 0) == 0
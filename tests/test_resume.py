@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import pytest
+from conftest import start_mock, run_script, run_script_interrupted, read_report, mock_post
+
+SCRIPT_REPORTS = {
+    "hubspot_history.py": ["deal_stage_history"],
+    "hubspot_history_all_pipes.py": ["deal_stage_changes"],
+    "hubspot_history_date_pipeline.py": ["deal_pipeline_history"],
+    "hubspot_history_combined.py": ["deal_stage_history", "deal_stage_changes", "deal_pipeline_history"],
+}
+
+
+# 120 deals: 6 pages of 20 deals
+@pytest.fixture
+def big_mock():
+    server = start_mock(deals=120)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# Pages of 20 deals: the 60 deals of the mock are saved in 3 checkpoints
+@pytest.mark.parametrize("script", list(SCRIPT_REPORTS))
+@pytest.mark.parametrize("dates", ["all", "first"])
+def test_resume_writes_the_reports_of_a_full_run(mock, tmp_path, script, dates):
+    (tmp_path / "full").mkdir()
+    (tmp_path / "resumed").mkdir()
+    run_script(mock, tmp_path / "full", script, HUBSPOT_DATES=dates)
+    run_script_interrupted(mock, tmp_path / "resumed", script, 2, HUBSPOT_DATES=dates)
+    # The combined script saves one checkpoint for its reports
+    name = "combined" if len(SCRIPT_REPORTS[script]) > 1 else SCRIPT_REPORTS[script][0]
+    assert os.path.exists(tmp_path / "resumed" / "extract" / f"{name}.checkpoint.json")
+    # The answers of the interrupted run are kept
+    run_script(mock, tmp_path / "resumed", script, "--resume", HUBSPOT_DATES="none")
+
+    for report_name in SCRIPT_REPORTS[script]:
+        rows = read_report(tmp_path / "full", report_name)
+        assert rows
+        assert read_report(tmp_path / "resumed", report_name) == rows
+
+
+# The modified deals are written again after the other ones, their old rows are removed. With the first dates,
+# the rows of a modified deal are its first dates again, not the dates of its changes.
+@pytest.mark.parametrize("script", ["hubspot_history.py", "hubspot_history_combined.py"])
+@pytest.mark.parametrize("dates", ["all", "first"])
+def test_incremental_gives_the_rows_of_a_full_run(mock, tmp_path, script, dates):
+    (tmp_path / "incremental").mkdir()
+    (tmp_path / "full").mkdir()
+    run_script(mock, tmp_path / "incremental", script, HUBSPOT_DATES=dates)
+    before = {report_name: read_report(tmp_path / "incremental", report_name) for report_name in SCRIPT_REPORTS[script]}
+    for deal_id in ("100005", "100021", "100042"):
+        mock_post(mock, f"/mock/touch/{deal_id}")
+    run_script(mock, tmp_path / "incremental", script, "--incremental", HUBSPOT_DATES="none")
+    run_script(mock, tmp_path / "full", script, HUBSPOT_DATES=dates)
+
+    for report_name in SCRIPT_REPORTS[script]:
+        rows = read_report(tmp_path / "incremental", report_name)
+        assert rows != before[report_name]
+        assert sorted(rows) == sorted(read_report(tmp_path / "full", report_name))
+
+
+# Files of 50 rows at most, the pages of a file and the files completed after the checkpoint are cut on resume
+OUTPUTS = {
+    "gzip": {"HUBSPOT_OUTPUT_COMPRESSION": "gzip"},
+    "zstd": {"HUBSPOT_OUTPUT_COMPRESSION": "zstd"},
+    "parquet": {"HUBSPOT_OUTPUT_FORMAT": "parquet", "HUBSPOT_PARQUET_ROW_GROUP": "30"},
+}
+
+
+@pytest.mark.parametrize("output", list(OUTPUTS))
+@pytest.mark.parametrize("checkpoint", [2, 4])
+def test_resume_writes_the_files_of_a_full_run(big_mock, tmp_path, output, checkpoint):
+    if output == "zstd":
+        pytest.importorskip("zstandard")
+    if output == "parquet":
+        pytest.importorskip("pyarrow")
+    options = dict(OUTPUTS[output], HUBSPOT_OUTPUT_MAX_ROWS="50")
+    (tmp_path / "full").mkdir()
+    (tmp_path / "resumed").mkdir()
+    run_script(big_mock, tmp_path / "full", "hubspot_history_combined.py", **options)
+    run_script_interrupted(big_mock, tmp_path / "resumed", "hubspot_history_combined.py", checkpoint, **options)
+    run_script(big_mock, tmp_path / "resumed", "hubspot_history_combined.py", "--resume", **options)
+
+    full_files = sorted(os.listdir(tmp_path / "full" / "extract"))
+    assert sorted(os.listdir(tmp_path / "resumed" / "extract")) == full_files
+    for report_name in SCRIPT_REPORTS["hubspot_history_combined.py"]:
+        rows = read_report(tmp_path / "full", report_name)
+        assert rows
+        assert read_report(tmp_path / "resumed", report_name) == rows
+
+
+def count_rows(folder):
+    connection = sqlite3.connect(folder / "extract" / "history.db")
+    counts = {report_name: connection.execute(f"SELECT COUNT(*) FROM {report_name}").fetchone()[0] for report_name in SCRIPT_REPORTS["hubspot_history_combined.py"]}
+    connection.close()
+    return counts
+
+
+# The rows of the deals extracted again replace their previous rows
+def test_sqlite_run_again_keeps_the_rows(big_mock, tmp_path):
+    (tmp_path / "csv").mkdir()
+    (tmp_path / "sqlite").mkdir()
+    run_script(big_mock, tmp_path / "csv", "hubspot_history_combined.py")
+    run_script(big_mock, tmp_path / "sqlite", "hubspot_history_combined.py", HUBSPOT_OUTPUT_FORMAT="sqlite")
+    counts = count_rows(tmp_path / "sqlite")
+    assert counts == {report_name: len(read_report(tmp_path / "csv", report_name)) for report_name in counts}
+
+    run_script(big_mock, tmp_path / "sqlite", "hubspot_history_combined.py", HUBSPOT_OUTPUT_FORMAT="sqlite")
+    assert count_rows(tmp_path / "sqlite") == counts
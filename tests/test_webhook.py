@@ -0,0 +1,173 @@
+import json
+import time
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from conftest import run_script, read_report
+from hubspot_extract import get_api, close_api, get_deals_by_id, get_pipeline_index, fetch_property_histories
+from hubspot_events import EventJournal, get_signature, verify_signature
+from hubspot_webhook import WebhookServer, get_report_writers, get_extractions, write_changes
+
+SECRET = "app-secret"
+URI = "https://example.com/webhook"
+
+
+def get_events(*changes):
+    return [
+        {"eventId": index, "subscriptionType": "deal.propertyChange", "objectId": int(deal_id), "propertyName": property_name, "propertyValue": value, "occurredAt": occurred_at}
+        for index, (deal_id, property_name, value, occurred_at) in enumerate(changes)
+    ]
+
+
+def get_v3_headers(body, timestamp=None, uri=URI):
+    timestamp = str(timestamp or int(time.time() * 1000))
+    return {"X-HubSpot-Signature-v3": get_signature(SECRET, "POST", uri, body, timestamp), "X-HubSpot-Request-Timestamp": timestamp}
+
+
+def test_v3_signature():
+    body = b'[{"objectId": 1}]'
+    assert verify_signature(SECRET, "POST", URI, body, get_v3_headers(body))
+    assert not verify_signature("other-secret", "POST", URI, body, get_v3_headers(body))
+    assert not verify_signature(SECRET, "POST", URI, b'[{"objectId": 2}]', get_v3_headers(body))
+    assert not verify_signature(SECRET, "POST", f"{URI}?other", body, get_v3_headers(body))
+    # A signature older than 5 minutes is a replayed request
+    assert not verify_signature(SECRET, "POST", URI, body, get_v3_headers(body, int(time.time() * 1000) - 301000))
+    assert not verify_signature(SECRET, "POST", URI, body, {})
+
+
+def test_v1_and_v2_signatures():
+    body = b'[{"objectId": 1}]'
+    v1 = hashlib.sha256(SECRET.encode("utf-8") + body).hexdigest()
+    v2 = hashlib.sha256(f"{SECRET}POST{URI}".encode("utf-8") + body).hexdigest()
+    assert verify_signature(SECRET, "POST", URI, body, {"X-HubSpot-Signature": v1, "X-HubSpot-Signature-Version": "v1"})
+    assert verify_signature(SECRET, "POST", URI, body, {"X-HubSpot-Signature": v2, "X-HubSpot-Signature-Version": "v2"})
+    assert not verify_signature(SECRET, "POST", URI, body, {"X-HubSpot-Signature": v1, "X-HubSpot-Signature-Version": "v2"})
+
+
+# A webhook delivered again, or a change found again by the reconciliation a few seconds off, is stored once
+def test_journal_keeps_each_change_once(tmp_path):
+    journal = EventJournal(str(tmp_path / "events.db"))
+    changes = [("100001", "dealstage", "appointmentscheduled", 1700000000000, "1"), ("100001", "dealstage", "closedwon", 1700000100000, "2")]
+    assert journal.add(changes, "webhook") == 2
+    assert journal.add(changes, "webhook") == 0
+    assert journal.add([("100001", "dealstage", "closedwon", 1700000130000, "")], "reconcile") == 0
+    assert journal.add([("100001", "dealstage", "closedwon", 1700000200000, "")], "reconcile") == 1
+    assert len(journal.get_pending(10)) == 3
+    journal.close()
+
+
+def post_webhook(server, body, headers):
+    request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/webhook", data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def test_receiver_checks_the_signatures_and_the_duplicates(tmp_path):
+    journal = EventJournal(str(tmp_path / "events.db"))
+    server = WebhookServer(("127.0.0.1", 0), journal, SECRET, URI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    body = json.dumps(get_events(("100001", "dealstage", "closedwon", 1700000000000), ("100002", "pipeline", "default", 1700000000000))).encode("utf-8")
+    try:
+        assert post_webhook(server, body, get_v3_headers(body)) == 200
+        # HubSpot delivers it again when the answer was lost
+        assert post_webhook(server, body, get_v3_headers(body)) == 200
+        assert post_webhook(server, body, {"X-HubSpot-Signature-v3": "forged", "X-HubSpot-Request-Timestamp": str(int(time.time() * 1000))}) == 401
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert server.stats == {"received": 4, "duplicates": 2, "refused": 1}
+    assert len(journal.get_pending(10)) == 2
+    journal.close()
+
+
+def start_writer(mock, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HUBSPOT_API_URL", mock.url)
+    monkeypatch.setenv("HUBSPOT_CACHE", "off")
+    monkeypatch.setenv("HUBSPOT_METRICS", "off")
+    api = get_api("test")
+    journal = EventJournal("extract/webhook_events.db")
+    return api, journal, get_report_writers(journal, 0)
+
+
+def stop_writer(api, journal, writers):
+    for report_writer in writers.values():
+        report_writer.close()
+    journal.close()
+    close_api(api)
+
+
+# A deal and a stage of its pipeline it never had, with the versions of its dealstage
+def get_deal_with_new_stage(api):
+    deal_ids = [str(100000 + index) for index in range(60)]
+    deals = get_deals_by_id(api, deal_ids, ["dealstage", "dealname", "pipeline"])
+    all_histories = fetch_property_histories(api, [{"id": deal_id} for deal_id in deal_ids], ["dealstage"])
+    stages = get_pipeline_index(api)["stages"]
+    for deal_id, histories in zip(deal_ids, all_histories):
+        seen = {version["value"] for version in histories["dealstage"]}
+        new_stages = [stage_id for stage_id, stage in stages.items() if stage[0] == deals[deal_id]["properties"]["pipeline"] and stage_id not in seen]
+        if new_stages:
+            return deal_id, deals[deal_id]["properties"]["dealstage"], new_stages[0]
+
+
+# The changes made before the last extraction are already in its reports. With the first dates, a deal entering
+# a stage it had before gets no new row.
+@pytest.mark.parametrize("dates", ["all", "first"])
+def test_changes_are_written_like_the_extraction(mock, tmp_path, monkeypatch, dates):
+    run_script(mock, tmp_path, "hubspot_history_combined.py", HUBSPOT_DATES=dates)
+    extracted_rows = read_report(tmp_path, "deal_stage_history")
+    api, journal, writers = start_writer(mock, tmp_path, monkeypatch)
+    extractions = get_extractions()
+    extracted_until, pipeline_id, all_dates = extractions["deal_stage_history"]
+    assert pipeline_id is None
+    assert all_dates == (dates == "all")
+
+    try:
+        deal_id, stage, new_stage = get_deal_with_new_stage(api)
+        journal.add([
+            (deal_id, "dealstage", stage, extracted_until - 60000, "1"),
+            (deal_id, "dealstage", stage, extracted_until + 60000, "2"),
+            (deal_id, "dealstage", new_stage, extracted_until + 120000, "3"),
+        ], "webhook")
+        assert write_changes(api, journal, writers, None, extractions) == 3
+    finally:
+        stop_writer(api, journal, writers)
+
+    new_rows = read_report(tmp_path, "deal_stage_history")[len(extracted_rows):]
+    assert [row[0] for row in new_rows] == [deal_id] * (2 if dates == "all" else 1)
+    assert new_rows[-1][2] == f"Stage {new_stage}"
+
+
+# A report that fails is written again without the rows of the other report being written twice
+def test_failed_report_is_written_once(mock, tmp_path, monkeypatch):
+    api, journal, writers = start_writer(mock, tmp_path, monkeypatch)
+    deal = get_deals_by_id(api, ["100005"], ["dealstage", "pipeline"])["100005"]
+    journal.add([
+        ("100005", "dealstage", deal["properties"]["dealstage"], 1700000000000, "1"),
+        ("100005", "pipeline", deal["properties"]["pipeline"], 1700000000000, "2"),
+    ], "webhook")
+    pipeline_writer = writers["deal_pipeline_history"]
+    write_page = pipeline_writer.write_page
+
+    def fail_once(rows):
+        write_page(rows)
+        pipeline_writer.write_page = write_page
+        raise OSError("No space left on device")
+
+    pipeline_writer.write_page = fail_once
+    try:
+        with pytest.raises(OSError):
+            write_changes(api, journal, writers, None, {})
+        assert write_changes(api, journal, writers, None, {}) == 1
+        assert write_changes(api, journal, writers, None, {}) == 0
+    finally:
+        stop_writer(api, journal, writers)
+
+    assert len(read_report(tmp_path, "deal_stage_history")) == 1
+    assert len(read_report(tmp_path, "deal_pipeline_history")) == 1
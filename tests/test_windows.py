@@ -0,0 +1,69 @@
+import pytest
+import hubspot_mock
+import hubspot_extract
+from conftest import start_mock
+from hubspot_extract import get_api, close_api, get_deals, get_deal_windows, iter_deal_pages, iso_to_timestamp, get_search_rate_limiter
+
+
+@pytest.fixture
+def big_mock():
+    server = start_mock(deals=300)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def api(big_mock, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HUBSPOT_API_URL", big_mock.url)
+    monkeypatch.setenv("HUBSPOT_CACHE", "off")
+    monkeypatch.setenv("HUBSPOT_METRICS", "off")
+    api = get_api("test")
+    yield api
+    close_api(api)
+
+
+def count_deals(api, window):
+    return get_deals(api, None, limit=1, window=window)["total"]
+
+
+# Shards bigger than the results of a search are split like the windows of an extraction
+def test_windows_stay_under_the_search_limit(api, monkeypatch):
+    monkeypatch.setattr(hubspot_extract, "SEARCH_MAX_RESULTS", 50)
+    monkeypatch.setattr(hubspot_mock, "SEARCH_MAX_RESULTS", 50)
+    totals = [count_deals(api, window) for window in get_deal_windows(api, None, max_deals=100)]
+    assert max(totals) <= 50
+    assert sum(totals) == 300
+
+
+
+# The pages of the windows give every deal once, in the createdate order of a single search
+@pytest.mark.parametrize("max_deals", [100, 30])
+def test_windows_give_every_deal_once_in_createdate_order(api, max_deals):
+    windows = get_deal_windows(api, None, max_deals=max_deals)
+    assert len(windows) >= 300 // max_deals
+    deals = [deal for page, cursor in iter_deal_pages(api, None, windows, limit=20) for deal in page]
+    assert sorted(deal["id"] for deal in deals) == [str(100000 + index) for index in range(300)]
+    createdates = [iso_to_timestamp(deal["properties"]["createdate"]) for deal in deals]
+    assert createdates == sorted(createdates)
+
+
+def test_no_window_when_the_deals_are_deleted_while_counted(api, monkeypatch):
+    search = hubspot_extract.get_deals
+
+    def get_deals_deleted(api, pipeline_id, window=None, **options):
+        deals = search(api, pipeline_id, window=window, **options)
+        return dict(deals, results=[], total=0) if window else deals
+
+    monkeypatch.setattr(hubspot_extract, "get_deals", get_deals_deleted)
+    assert get_deal_windows(api, None, max_deals=100) == []
+
+
+# The workers of hubspot_sharded.py send one search in turn, 4.5 per second together
+def test_processes_share_the_search_limit():
+    assert get_search_rate_limiter(1).max_requests == 5
+    rate_limiter = get_search_rate_limiter(4)
+    assert rate_limiter.reserve() == 0
+    rate_limiter.update(None)
+    assert 0.8 < rate_limiter.reserve() <= 4 / 4.5